@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+配置渲染基准测试：渲染 10k 个小时级作业的配置，并将每个作业展开为 24 个小时的作业。
+- legacy: 原来的方式，每个选项每次都调用 env.from_string 重新编译模板，通过修改 env.globals 传递变量，
+          _escape_vars 每次调用都重新编译正则表达式；
+- cached: 模板按源文本缓存（LRU），变量在渲染时传入，正则表达式预编译。
+作业的 sql 各不相同，其余选项（如继承自 DEFAULT 的日期变量）在作业之间相同。
+
+用法：python benchmarks/bench_render.py [--jobs 10000] [--hours 24]
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_monitor import config
+from data_monitor.config import (DEPENDING_OPTIONS, DEPENDING_VARS, _unescape_vars, compile_depending_job_conf,
+                                 env, render_depending_job_conf, render_job_conf)
+
+
+def make_job_conf(i):
+    return {
+        '_name': 'job{}'.format(i),
+        'TODAY': "{BASETIME | dt_format('%Y%m%d')}",
+        'YESTERDAY': "{BASETIME | dt_add(days=-1) | dt_format('%Y%m%d')}",
+        'TODAY_ISO': "{BASETIME | dt_format('%Y-%m-%d')}",
+        'YESTERDAY_ISO': "{BASETIME | dt_add(days=-1) | dt_format('%Y-%m-%d')}",
+        'due_time': '{BASETIME | dt_set(hour=0, minute=10)}',
+        'period': 'hour',
+        'sql': ("SELECT COUNT(*) FROM table_{} WHERE stat_date = {{BASETIME | dt_format('%Y%m%d')}} "
+                "AND stat_hour = '{{DUETIME | dt_add(hours=-1) | dt_format('%H')}}'").format(i),
+        'validator': 'claim(result, gt(0))',
+    }
+
+
+def legacy_render_job_conf(job_conf):
+    """原来的 render_job_conf"""
+    today = datetime.date.today()
+    basetime = datetime.datetime.combine(today, datetime.time.min)
+    env.globals = dict(BASETIME=basetime)
+    t = '|'.join(DEPENDING_VARS)
+    for k, v in job_conf.items():
+        if isinstance(v, basestring) and '{' in v:
+            v = re.sub(r'{([^{}]*?(%s)[^{}]*?)}' % t, '\x01' + r'\1' + '\x02', v)
+            v = env.from_string(v).render()
+            job_conf[k] = _unescape_vars(v, DEPENDING_VARS)
+    return job_conf
+
+
+def legacy_compile_depending_job_conf(job_conf):
+    """原来的 compile_depending_job_conf"""
+    templates = {}
+    for op in DEPENDING_OPTIONS:
+        v = job_conf[op]
+        if '{' in v:
+            templates[op] = env.from_string(v)
+    return templates
+
+
+VARIANTS = {
+    'legacy': (legacy_render_job_conf, legacy_compile_depending_job_conf),
+    'cached': (render_job_conf, compile_depending_job_conf),
+}
+
+
+def run_variant(variant, njobs, nhours):
+    """返回 载入渲染耗时、展开渲染耗时"""
+    render, compile_depending = VARIANTS[variant]
+    config._templates.clear()
+    job_confs = [make_job_conf(i) for i in range(njobs)]
+
+    start = time.time()
+    for job_conf in job_confs:
+        render(job_conf)
+    load_elapsed = time.time() - start
+
+    start = time.time()
+    one_hour = datetime.timedelta(hours=1)
+    for job_conf in job_confs:
+        due_time = datetime.datetime.strptime(job_conf['due_time'], '%Y-%m-%d %H:%M:%S')
+        templates = compile_depending(job_conf)
+        for h in range(nhours):
+            render_depending_job_conf(dict(job_conf, due_time=due_time + h * one_hour), templates)
+    expand_elapsed = time.time() - start
+    return load_elapsed, expand_elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=10000)
+    parser.add_argument('--hours', type=int, default=24)
+    args = parser.parse_args()
+
+    print('jobs: {}, hours: {}'.format(args.jobs, args.hours))
+    print('{:<8} {:>10} {:>12} {:>10}'.format('variant', 'load(s)', 'expand(s)', 'total(s)'))
+    for variant in ('legacy', 'cached'):
+        load_elapsed, expand_elapsed = run_variant(variant, args.jobs, args.hours)
+        print('{:<8} {:>10.2f} {:>12.2f} {:>10.2f}'.format(
+            variant, load_elapsed, expand_elapsed, load_elapsed + expand_elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""
+查询结果表示方式基准测试：对比 1M 行查询结果的两种表示方式的耗时和内存占用。
+- namedtuple: 原来的方式，fetchall 后为每一行创建 namedtuple 对象，校验函数再将其转换为 DataFrame；
+- columnar:   列式结果 ResultSet，分批读取并直接转置为列，校验函数直接使用其 DataFrame。
+每种方式在独立子进程中运行，以便分别统计内存峰值。数据存放在临时的 sqlite 数据库中。
+
+用法：python benchmarks/bench_result.py [--rows 1000000]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+from data_monitor.db import _fetch_columns, _get_col_names
+from data_monitor.result import ResultSet
+
+
+SQL = 'SELECT event_day, k, name, num FROM t'
+
+
+def rss_mb():
+    """当前进程的常驻内存（MB）"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024.0 / 1024
+
+
+def peak_rss_mb():
+    """当前进程的常驻内存峰值（MB），Linux 下 ru_maxrss 的单位为 KB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def build_db(path, nrows):
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE t (event_day TEXT, k INTEGER, name TEXT, num REAL)')
+    conn.executemany(
+        'INSERT INTO t VALUES (?, ?, ?, ?)',
+        (('2026-{:02d}-{:02d}'.format(i % 12 + 1, i % 28 + 1), i, 'name{}'.format(i % 1000), i * 0.5)
+         for i in range(nrows)))
+    conn.commit()
+    conn.close()
+
+
+def fetch_namedtuple(cursor):
+    res = cursor.fetchall()
+    RowType = namedtuple('RowType', _get_col_names(cursor))
+    rows = [RowType(*tp) for tp in res]
+    del res
+    return rows, pd.DataFrame(rows, columns=rows[0]._fields)
+
+
+def fetch_columnar(cursor):
+    col_names = _get_col_names(cursor)
+    result = ResultSet.from_columns(col_names, _fetch_columns(cursor, len(col_names)))
+    return result, result.df
+
+
+def run_variant(path, variant):
+    """子进程入口：执行一次查询并输出 耗时、内存峰值增量、保留内存增量"""
+    fetch = {'namedtuple': fetch_namedtuple, 'columnar': fetch_columnar}[variant]
+    conn = sqlite3.connect(path)
+    base = rss_mb()
+    start = time.time()
+    cursor = conn.cursor()
+    cursor.execute(SQL)
+    result, df = fetch(cursor)
+    elapsed = time.time() - start
+    print(elapsed, peak_rss_mb() - base, rss_mb() - base, len(df.index))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--variant', help=argparse.SUPPRESS)
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        run_variant(args.db, args.variant)
+        return
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'bench.db')
+        build_db(path, args.rows)
+        print('rows: {}'.format(args.rows))
+        print('{:<12} {:>10} {:>16} {:>16}'.format('variant', 'time(s)', 'peak mem(MB)', 'retained(MB)'))
+        for variant in ('namedtuple', 'columnar'):
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), '--variant', variant, '--db', path])
+            elapsed, peak, retained, nrows = output.split()
+            print('{:<12} {:>10.2f} {:>16.1f} {:>16.1f}'.format(variant, float(elapsed), float(peak), float(retained)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
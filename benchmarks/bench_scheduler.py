@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+"""
+调度器基准测试：在 10k 个排队作业下，测量作业分发延迟（实际提交时刻 - 到期时刻）
+以及调度线程空闲等待时的 CPU 占用。
+
+用法：python benchmarks/bench_scheduler.py [--jobs 10000] [--spread 2.0] [--idle 3.0]
+"""
+
+from __future__ import print_function
+
+import argparse
+import concurrent.futures
+import datetime
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_monitor.scheduler import Scheduler
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def cpu_seconds():
+    t = os.times()
+    return t[0] + t[1]
+
+
+def bench_dispatch(njobs, spread):
+    """njobs 个作业均匀分布在 spread 秒内到期，统计分发延迟"""
+    scheduler = Scheduler()
+    start = datetime.datetime.now() + datetime.timedelta(seconds=0.5)
+    for i in range(njobs):
+        due_time = start + datetime.timedelta(seconds=random.uniform(0, spread))
+        scheduler.push(due_time, {'_name': 'job%d' % i, 'due_time': due_time})
+
+    latencies = []
+    cpu_begin = cpu_seconds()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        while scheduler.npending or scheduler.nrunning:
+            now = datetime.datetime.now()
+            for job in scheduler.pop_due(now):
+                latencies.append((now - job['due_time']).total_seconds())
+                scheduler.track(executor.submit(lambda: None), job)
+            scheduler.wait()
+    cpu_used = cpu_seconds() - cpu_begin
+
+    print('dispatch: {} jobs over {:.1f}s'.format(njobs, spread))
+    print('  latency p50={:.3f}ms p99={:.3f}ms max={:.3f}ms'.format(
+        percentile(latencies, 50) * 1e3, percentile(latencies, 99) * 1e3, max(latencies) * 1e3))
+    print('  cpu time: {:.3f}s'.format(cpu_used))
+
+
+def bench_idle(njobs, idle):
+    """njobs 个作业均在一小时后到期，统计调度线程等待 idle 秒期间的 CPU 占用"""
+    scheduler = Scheduler()
+    due_time = datetime.datetime.now() + datetime.timedelta(hours=1)
+    for i in range(njobs):
+        scheduler.push(due_time, {'_name': 'job%d' % i})
+
+    cpu_begin = cpu_seconds()
+    scheduler.wait(until=datetime.datetime.now() + datetime.timedelta(seconds=idle))
+    cpu_used = cpu_seconds() - cpu_begin
+
+    print('idle: {} jobs queued, waited {:.1f}s'.format(njobs, idle))
+    print('  cpu time: {:.3f}s ({:.2f}% of one core)'.format(cpu_used, cpu_used / idle * 100))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--jobs', type=int, default=10000)
+    parser.add_argument('--spread', type=float, default=2.0)
+    parser.add_argument('--idle', type=float, default=3.0)
+    args = parser.parse_args()
+
+    bench_dispatch(args.jobs, args.spread)
+    bench_idle(args.jobs, args.idle)
@@ -8,8 +8,14 @@
 """
 
 
+import datetime
+import gzip
 import logging
 import os
+import re
+import stat
+import tempfile
+import time
 
 
 cur_dir = os.path.dirname(os.path.abspath(__file__))
@@ -17,6 +23,91 @@ template_dir = os.path.join(cur_dir, 'templates')
 
 logger = logging.getLogger(__name__)
 
+# 默认的邮件服务器及发件人。报警分发器使用的服务器可通过命令行参数 --smtp-server 指定
+SMTP_HOST = 'smtp.163.com'
+SMTP_PORT = 25
+SMTP_TIMEOUT = 30
+FROM_ADDR = 'example_user@163.com'
+
+# 报警正文中最多列出的不合格数据行数，可通过作业的 alarm_max_rows 选项修改
+ALARM_MAX_ROWS = 100
+# 不合格数据超出正文上限时，完整数据写入 gzip 压缩的 CSV 文件作为附件。
+# 附件超过 ATTACHMENT_MAX_MB 时不随邮件发送，只在正文中给出其路径；超过 ATTACHMENT_KEEP_DAYS 天的附件被清理。
+# 附件含有业务数据，每个用户使用自己的目录，目录只允许本人访问（0700），附件只允许本人读写（0600）
+ATTACHMENT_DIR = os.path.join(tempfile.gettempdir(), 'data_monitor_attachments_{}'.format(os.getuid()))
+ATTACHMENT_MAX_MB = 10
+ATTACHMENT_KEEP_DAYS = 7
+
+# 消息模板只从文件读取一次
+_templates = {}
+
+
+def load_template(name):
+    """读取 templates 目录下的消息模板"""
+    template = _templates.get(name)
+    if template is None:
+        with open(os.path.join(template_dir, name), 'r') as f:
+            template = _templates[name] = f.read()
+    return template
+
+
+def _nrows(content):
+    """content 为 DataFrame 时返回其行数，否则返回 None"""
+    index = getattr(content, 'index', None)
+    return len(index) if index is not None and hasattr(content, 'to_csv') else None
+
+
+def _to_unicode(v):
+    if isinstance(v, str):
+        return v.decode('utf8', 'replace')
+    return unicode(v)
+
+
+def _total_rows(df):
+    """不合格数据的总行数。在数据库中执行的校验（见 pushdown 模块）只取回前若干行，总行数记录在 total_rows 中"""
+    return getattr(df, 'total_rows', None) or len(df.index)
+
+
+def _summarize(df):
+    """不合格数据的摘要：行数，以及第一列（通常为键）在首行和末行的值。列名和值可能含有中文，返回 utf8 编码的字符串"""
+    total = _total_rows(df)
+    s = u'不合格的数据共 {} 行'.format(total)
+    if total > len(df.index):
+        s += u'（仅取回了前 {} 行）'.format(len(df.index))
+    return (s + u'，第一列 `{}` 的首行值为 {}，末行值为 {}'.format(
+        _to_unicode(df.columns[0]), _to_unicode(df.iloc[0, 0]), _to_unicode(df.iloc[-1, 0]))).encode('utf8')
+
+
+def _format_frame_text(df):
+    try:
+        s = df.to_string(max_rows=10).encode('utf8')
+    except AttributeError:
+        return str(df)
+    if _total_rows(df) > 10:
+        s = _summarize(df) + '：\n' + s
+    return s
+
+
+def _format_frame_html(job, df, attachment=None):
+    """生成不合格数据的 html 表格，最多列出 alarm_max_rows 行，超出时附上摘要并说明完整数据的位置"""
+    max_rows = job.get('alarm_max_rows') or ALARM_MAX_ROWS
+    if _nrows(df) is None:
+        return str(df)
+    if len(df.index) <= max_rows:
+        if _total_rows(df) > len(df.index):
+            return '<p>{}。</p>'.format(_summarize(df)) + df.to_html().encode('utf8')
+        return df.to_html().encode('utf8')
+
+    note = '{}，以下仅列出前 {} 行'.format(_summarize(df), max_rows)
+    if attachment is not None:
+        # 只取回了部分数据时，附件中也只有这部分数据
+        data = '完整数据' if _total_rows(df) <= len(df.index) else '取回的数据'
+        if os.path.getsize(attachment) <= ATTACHMENT_MAX_MB * 1024 * 1024:
+            note += '，{}见附件 {}'.format(data, os.path.basename(attachment))
+        else:
+            note += '，{}已保存在监控服务器上：{}'.format(data, attachment)
+    return '<p>{}。</p>'.format(note) + df.head(max_rows).to_html().encode('utf8')
+
 
 def format_text(job, info):
     """生成文本消息，可用于即时通信工具。
@@ -46,10 +137,7 @@ def format_text(job, info):
 
     if type_ == 'claim':
         # claim 类型对应的 content 为 pandas.DataFrame
-        try:
-            content_s = content.to_string(max_rows=10).encode('utf8')
-        except:
-            content_s = str(content)
+        content_s = _format_frame_text(content)
         msg += [
             '报警原因：数据缺失或不符合要求',
             '校验表达式：`{}`'.format(job['validator'].encode('utf8')),
@@ -59,10 +147,7 @@ def format_text(job, info):
 
     elif type_ == 'diff':
         # diff 类型对应的 content 为 pandas.DataFrame
-        try:
-            content_s = content.to_string(max_rows=10).encode('utf8')
-        except:
-            content_s = str(content)
+        content_s = _format_frame_text(content)
         msg += [
             '报警原因：数据diff超出阈值',
             '校验表达式：`{}`'.format(job['validator'].encode('utf8')),
@@ -89,9 +174,10 @@ def format_text(job, info):
     return msg
 
 
-def format_html(job, info):
+def format_html(job, info, attachment=None):
     """生成 html 邮件。对不同的消息类型使用不同的消息模板。
     info 是一个 2-tuple (见 util.ValidateFailInfo)，两个字段的含义分别为：type、content。
+    attachment 为保存了完整不合格数据的附件路径（见 render_email）。
     """
     try:
         type_, content = info
@@ -100,66 +186,217 @@ def format_html(job, info):
         content = info
 
     if type_ == 'config_error':
-        template_file = os.path.join(template_dir, 'config_error.html')
         content = str(content).replace('\t', ' '*4).replace(' ', '&nbsp;').replace('\n', '</p><p>')
         content = '<p>' + content + '</p>'
-        with open(template_file, 'r') as f:
-            msg = f.read().format(job=job, content=content)
-            return msg
+        return load_template('config_error.html').format(job=job, content=content)
 
     if type_ == 'claim':
-        template_file = os.path.join(template_dir, 'claim.html')
-        try:
-            content = content.to_html().encode('utf8')
-        except AttributeError:
-            content = str(content)
+        template = load_template('claim.html')
+        content = _format_frame_html(job, content, attachment)
 
     elif type_ == 'diff':
-        template_file = os.path.join(template_dir, 'diff.html')
-        try:
-            content = content.to_html().encode('utf8')
-        except AttributeError:
-            content = str(content)
+        template = load_template('diff.html')
+        content = _format_frame_html(job, content, attachment)
 
     elif type_ == 'exception':
-        template_file = os.path.join(template_dir, 'exception.html')
+        template = load_template('exception.html')
         content = content.replace('\t', ' '*4).replace(' ', '&nbsp;').replace('\n', '</p><p>')
         content = '<p>' + content + '</p>'
 
     else:
-        template_file = os.path.join(template_dir, 'default.html')
+        template = load_template('default.html')
 
     htmled_sql = '<hr/>'.join('<p>' + s.replace('\n', '</p><p>') + '</p>' for s in job['sql'])
-    with open(template_file, 'r') as f:
-        msg = f.read().format(
-            job=dict(job, validator=job['validator'].encode('utf8')),
-            content=content,
-            sql=htmled_sql,
-            database=', '.join(db['_name'] for db in job['db_conf'])
-            )
+    msg = template.format(
+        job=dict(job, validator=job['validator'].encode('utf8')),
+        content=content,
+        sql=htmled_sql,
+        database=', '.join(db['_name'] for db in job['db_conf'])
+        )
 
     return msg
 
 
-def send_email(to_users, msg):
-    """向邮箱发送信息"""
+def _check_attachment_dir():
+    """检查附件目录：必须是当前用户所有的目录（不能是符号链接），其他用户无权访问。
+    目录由其他用户预先创建时抛出 OSError，不使用该目录
+    """
+    st = os.lstat(ATTACHMENT_DIR)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise OSError('attachment dir {} is not a directory owned by the current user'.format(ATTACHMENT_DIR))
+    if stat.S_IMODE(st.st_mode) & 0o077:
+        os.chmod(ATTACHMENT_DIR, 0o700)
+
+
+def write_attachment(job, df):
+    """把完整的不合格数据写入 gzip 压缩的 CSV 文件并返回其路径。数据分块写入文件，不在内存中生成完整的文本"""
+    try:
+        os.makedirs(ATTACHMENT_DIR, 0o700)
+    except OSError:
+        if not os.path.isdir(ATTACHMENT_DIR):
+            raise
+    _check_attachment_dir()
+    name = '{}_{}.csv.gz'.format(
+        re.sub(r'[^\w.-]', '_', job['_name']), datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'))
+    path = os.path.join(ATTACHMENT_DIR, name)
+    # O_EXCL：不覆盖（也不跟随）已存在的文件
+    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as raw:
+        with gzip.GzipFile(filename=name[:-3], mode='wb', fileobj=raw) as f:
+            df.to_csv(f, index=False, encoding='utf8', chunksize=10000)
+    return path
+
+
+def prune_attachments():
+    """清理超过 ATTACHMENT_KEEP_DAYS 天的附件"""
+    if not os.path.isdir(ATTACHMENT_DIR):
+        return
+    try:
+        _check_attachment_dir()
+    except OSError as e:
+        logger.error(e)
+        return
+    expire = time.time() - ATTACHMENT_KEEP_DAYS * 86400
+    for name in os.listdir(ATTACHMENT_DIR):
+        path = os.path.join(ATTACHMENT_DIR, name)
+        try:
+            if os.path.getmtime(path) < expire:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def render_email(job, info):
+    """生成报警邮件，返回 (html, 附件路径列表)。
+    不合格数据的行数超出正文上限时，完整数据写入附件，附件过大时只在正文中给出其路径。
+    """
+    attachment = None
+    nrows = _nrows(info.content) if info.type in ('claim', 'diff') else None
+    if nrows is not None and nrows > (job.get('alarm_max_rows') or ALARM_MAX_ROWS):
+        try:
+            attachment = write_attachment(job, info.content)
+        except (IOError, OSError) as e:
+            logger.error('failed writing alarm attachment of job [{}]: {}'.format(job['_name'], e))
+    msg = format_html(job, info, attachment)
+    if attachment is None or os.path.getsize(attachment) > ATTACHMENT_MAX_MB * 1024 * 1024:
+        return msg, []
+    return msg, [attachment]
+
 
+def make_email(to_users, msg, attachments=()):
+    """生成邮件，返回 (发件人, 收件人列表, 邮件内容)。attachments 为附件路径列表"""
     from email.header import Header
+    from email.mime.application import MIMEApplication
+    from email.mime.multipart import MIMEMultipart
     from email.mime.text import MIMEText
-    import smtplib
 
     msg = str(msg)
-    from_addr = 'example_user@163.com'
     to_users = [s.strip() if '@' in s else s.strip() + '@163.com' for s in to_users]
 
     mail_type = 'plain'
     if '</' in msg and '>' in msg:
         mail_type = 'html'
     mail = MIMEText(msg, mail_type, 'utf-8')
-    mail['From'] = from_addr
+    if attachments:
+        body, mail = mail, MIMEMultipart()
+        mail.attach(body)
+        for path in attachments:
+            with open(path, 'rb') as f:
+                part = MIMEApplication(f.read(), 'gzip')
+            part.add_header('Content-Disposition', 'attachment', filename=os.path.basename(path))
+            mail.attach(part)
+    mail['From'] = FROM_ADDR
     mail['To'] = ','.join(to_users)
     mail['Subject'] = Header('数据监控警报', 'utf-8').encode()
+    return FROM_ADDR, to_users, mail.as_string()
+
+
+def parse_smtp_server(s):
+    """解析 HOST[:PORT] 格式的邮件服务器地址，返回 (host, port)"""
+    host, _, port = s.rpartition(':') if ':' in s else (s, None, '')
+    try:
+        return host, int(port) if port else SMTP_PORT
+    except ValueError:
+        raise ValueError('invalid smtp server {!r}, should be in format of HOST[:PORT]'.format(s))
+
+
+def connect_smtp(host=None, port=None, timeout=SMTP_TIMEOUT):
+    """连接邮件服务器，host、port 为空时使用默认的服务器"""
+    import smtplib
+    return smtplib.SMTP(host or SMTP_HOST, port or SMTP_PORT, timeout=timeout)
+
+
+def send_email(to_users, msg, server=None, attachments=()):
+    """向邮箱发送信息。server 为已连接的 smtplib.SMTP，不提供时新建一个连接，发送后关闭"""
+    from_addr, to_users, mail = make_email(to_users, msg, attachments)
+    if server is not None:
+        server.sendmail(from_addr, to_users, mail)
+        return
+
+    server = connect_smtp()
+    try:
+        server.sendmail(from_addr, to_users, mail)
+    finally:
+        server.quit()
+
+
+class SinkError(IOError):
+    """webhook 类报警渠道返回了错误"""
+
+
+class WebhookSink(object):
+    """通用 webhook 报警渠道，以 JSON 格式 POST 报警：{"title": ..., "job": ..., "text": ...}。
+    同一渠道的所有请求共享一个 requests.Session，复用 keep-alive 连接；每个请求最多等待 timeout 秒。
+    """
+
+    timeout = 10
+    pool_size = 16
+
+    def __init__(self, timeout=None):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        if timeout is not None:
+            self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def payload(self, text, job=None):
+        """生成请求体，job 为空时为报警摘要"""
+        return {
+            'title': '数据监控警报',
+            'job': job['_name'] if job else None,
+            'text': text,
+        }
+
+    def send(self, url, payload):
+        response = self.session.post(url, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+
+class ChatBotSink(WebhookSink):
+    """聊天机器人报警渠道（如钉钉、企业微信的群机器人），以文本消息的格式发送：
+    {"msgtype": "text", "text": {"content": ...}}。这类接口出错时通常仍返回 200，错误码在响应的 errcode 中。
+    """
+
+    def payload(self, text, job=None):
+        return {'msgtype': 'text', 'text': {'content': text}}
+
+    def send(self, url, payload):
+        response = super(ChatBotSink, self).send(url, payload)
+        try:
+            errcode = response.json().get('errcode')
+        except (ValueError, AttributeError):
+            errcode = None
+        if errcode:
+            raise SinkError('chatbot {} returned errcode {}: {}'.format(url, errcode, response.text))
+        return response
+
 
-    server = smtplib.SMTP('smtp.163.com', 25)
-    server.sendmail(from_addr, to_users, mail.as_string())
-    server.quit()
+# webhook 类报警渠道，作业的 alarm_channels 选项中除 email 外可以使用的渠道
+ALARM_SINKS = {
+    'webhook': WebhookSink,
+    'chatbot': ChatBotSink,
+}
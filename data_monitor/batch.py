@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""
+@Author:      zhuhe212
+@Email:       zhuhe212@163.com
+@Description: 单值查询批处理。同一轮分发中、同一数据库上的 count 查询作业合并为一条 UNION ALL 语句执行，
+              每个作业只需取出自己的值，节省连接借出、网络往返和查询解析的开销。
+@CreateAt:    2026-10-18
+"""
+
+
+from collections import OrderedDict
+import concurrent.futures
+import logging
+import re
+import threading
+
+from .db import query
+
+
+logger = logging.getLogger(__name__)
+
+# 一条合并语句中最多包含的查询数
+MAX_BATCH_SIZE = 100
+
+# 可以合并的查询：只有一个 count 聚合、没有 GROUP BY 的 SELECT 语句，结果总是恰好一个整数。
+# HAVING 可能滤掉这唯一的一行，LIMIT 同理，因此不合并。
+# 其他聚合函数的结果类型各异，合并到同一列中可能被数据库转换类型，因此不合并
+re_count = re.compile(r'^\s*select\s+count\s*\([^()]*\)\s*(?:(?:as\s+)?\w+\s+)?from\s', re.I)
+re_not_scalar = re.compile(r'\b(group\s+by|having|union|limit|into)\b|;\s*\S', re.I)
+
+
+def is_batchable(job):
+    """作业是否可以与其他作业合并执行"""
+    if not job.get('batch', True) or job.get('stream') or len(job['sql']) != 1:
+        return False
+    sql = job['sql'][0]
+    return bool(re_count.match(sql)) and not re_not_scalar.search(sql)
+
+
+def _db_key(job):
+    db_conf = job['db_conf'][0]
+    return db_conf['_name'], db_conf.get('database')
+
+
+class ScalarBatch(object):
+    """一批合并执行的单值查询。第一个取值的作业执行合并语句，其余作业等待并共享其结果；
+    合并语句执行失败时，每个作业各自单独执行自己的查询，因此一条查询的错误不会影响其他作业。
+    resources 为批次占用的并发名额（由第一个作业占用），批次中所有作业完成后释放。
+    """
+
+    def __init__(self, db_conf, resources=None):
+        self.db_conf = db_conf
+        self.resources = resources
+        # sql -> 标签，相同的查询只执行一次
+        self._sqls = OrderedDict()
+        self._jobs = []
+        self._future = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def add(self, job):
+        self._jobs.append(job)
+        self._sqls.setdefault(job['sql'][0], len(self._sqls))
+        job['_batch'] = self
+
+    def dissolve(self):
+        """解散批次，作业恢复为单独执行"""
+        for job in self._jobs:
+            job.pop('_batch', None)
+
+    def release(self, job):
+        """作业完成时调用，返回该作业是否为批次中最后一个完成的作业"""
+        job.pop('_batch', None)
+        self._jobs.remove(job)
+        return not self._jobs
+
+    def _build_sql(self):
+        # SQL 末尾可能有分号或行注释，因此去掉分号并在括号前换行
+        return '\nUNION ALL\n'.join(
+            'SELECT {} AS tag, (\n{}\n) AS value'.format(tag, sql.strip().rstrip(';'))
+            for sql, tag in self._sqls.items())
+
+    def _execute(self):
+        """执行合并语句，返回 {sql: value}，失败时返回 None"""
+        try:
+            res = query(self.db_conf, self._build_sql())
+            values = dict(zip(res.df.iloc[:, 0].tolist(), res.df.iloc[:, 1].tolist()))
+            logger.info('batched {} scalar queries on database [{}] into one statement.'.format(
+                len(self._sqls), self.db_conf['_name']))
+            return {sql: values[tag] for sql, tag in self._sqls.items()}
+        except Exception as e:
+            logger.warning('batched scalar queries on database [{}] failed, executing them one by one: {}'.format(
+                self.db_conf['_name'], e))
+            return None
+
+    def fetch(self, sql, fallback):
+        """取出 sql 的结果。合并语句执行失败时调用 fallback() 单独执行"""
+        with self._lock:
+            owner = self._future is None
+            if owner:
+                self._future = concurrent.futures.Future()
+        if owner:
+            self._future.set_result(self._execute())
+        values = self._future.result()
+        if values is None or sql not in values:
+            return fallback()
+        return values[sql]
+
+
+class ScalarBatcher(object):
+    """在每一轮分发中把可合并的作业编入批次，仅由调度线程调用。
+    同一批次的作业只占用一个数据库并发名额：批次中第一个作业占用名额，其余作业直接加入；
+    批次中所有作业都完成后才释放名额。
+    """
+
+    def __init__(self):
+        self._open = {}
+
+    def join(self, job):
+        """尝试把作业加入本轮已有的批次，成功时返回 True（不需要再占用并发名额）"""
+        if not is_batchable(job):
+            return False
+        batch = self._open.get(_db_key(job))
+        if batch is None or len(batch) >= MAX_BATCH_SIZE:
+            return False
+        batch.add(job)
+        return True
+
+    def open(self, job, resources=None):
+        """作业已占用并发名额 resources，可合并时以其为首创建新的批次"""
+        if is_batchable(job):
+            batch = ScalarBatch(job['db_conf'][0], resources)
+            batch.add(job)
+            self._open[_db_key(job)] = batch
+
+    def close_round(self):
+        """本轮分发结束，只有一个作业的批次不必合并"""
+        for batch in self._open.values():
+            if len(batch) == 1:
+                batch.dissolve()
+        self._open = {}
+
+    def release(self, job):
+        """作业完成时调用，返回是否应释放其占用的并发名额"""
+        batch = job.get('_batch')
+        return batch is None or batch.release(job)
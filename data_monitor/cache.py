@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""
+@Author:      zhuhe212
+@Email:       zhuhe212@163.com
+@Description: 查询结果缓存。同一数据库上相同的查询在短时间内只执行一次，并发或相继到期的作业共享结果。
+@CreateAt:    2026-10-18
+"""
+
+
+import concurrent.futures
+import re
+import threading
+import time
+
+from .util import set_future_exception
+
+
+re_blank = re.compile(r'\s+')
+
+
+def normalize_sql(sql):
+    """规范化 SQL 文本：合并空白字符，去掉首尾空白和末尾的分号。
+    不改变大小写，因为字符串常量是大小写敏感的。
+    """
+    return re_blank.sub(' ', sql).strip().rstrip(';').rstrip()
+
+
+def is_cacheable(sql):
+    """只有只读查询（SELECT、SHOW）可以共享结果"""
+    return sql[:7].upper() == 'SELECT ' or sql[:5].upper() == 'SHOW '
+
+
+class QueryCache(object):
+    """查询结果缓存。
+    - 正在执行的查询：后到达的相同查询直接等待同一个 Future，不重复执行；
+    - 已完成的查询：结果保留 ttl 秒，期间到达的相同查询直接使用该结果；
+    - 执行失败的查询不缓存。
+    注意共享的结果对象会被多个作业的校验表达式同时使用，校验表达式不应修改 result。
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (future, expire_time)，查询未完成时 expire_time 为 None
+        self._entries = {}
+        self._next_sweep = time.time() + ttl
+
+    def _sweep(self, now):
+        """清理过期的缓存项，调用方需持有锁"""
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.ttl
+        for key, (_, expire_time) in list(self._entries.items()):
+            if expire_time is not None and expire_time <= now:
+                del self._entries[key]
+
+    def get(self, key, func, refresh=False):
+        """获取 key 对应的查询结果，缓存中没有时调用 func() 执行查询。
+        refresh 为真时跳过缓存，总是重新执行，并用新结果替换缓存（用于重试的作业）。
+        """
+        if self.ttl <= 0:
+            return func()
+
+        now = time.time()
+        with self._lock:
+            self._sweep(now)
+            entry = self._entries.get(key)
+            if not refresh and entry is not None and (entry[1] is None or entry[1] > now):
+                future, owner = entry[0], False
+            else:
+                future, owner = concurrent.futures.Future(), True
+                self._entries[key] = (future, None)
+
+        if not owner:
+            return future.result()
+
+        try:
+            result = func()
+        except Exception:
+            with self._lock:
+                if self._entries.get(key, (None,))[0] is future:
+                    del self._entries[key]
+            set_future_exception(future)
+            raise
+
+        with self._lock:
+            if self._entries.get(key, (None,))[0] is future:
+                self._entries[key] = (future, time.time() + self.ttl)
+        future.set_result(result)
+        return result
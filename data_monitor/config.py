@@ -12,10 +12,19 @@
 
 import datetime
 from dateutil import parser as dateparser
+from collections import OrderedDict
+import concurrent.futures
+import hashlib
+import io
 import logging
 import os
 import re
+import threading
 import traceback
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 try:
     import configparser
 except ImportError:
@@ -23,8 +32,8 @@ except ImportError:
 
 import jinja2
 
-from .alarm import format_html, send_email
-from .context import get_filter_context
+from .alarm import ALARM_SINKS, format_html, send_email
+from .context import compile_validator, get_filter_context
 from .util import AlarmInfo
 
 
@@ -53,6 +62,39 @@ def get_config(config_file, section_name=None):
     return dict(conf.items(section_name))
 
 
+re_section = re.compile(r'^\[([^]]+)\]', re.M)
+
+def read_job_configs(config_files, key=None):
+    """一次性读取并解析多个作业配置文件，每个文件只读取、解析一次。
+    返回 (configs, conflict)：configs 同 get_config 的返回值；conflict 同 detect_configs_conflict
+    的返回值，即找到的第一个名称冲突的 section 以及发生冲突的两个文件，没有冲突时为 None。
+    文件无法读取（如被删除、改名）或有语法错误时抛出 ConfigError，其中包含文件名。
+    """
+    if key is None:
+        key = lambda name: name != 'DEFAULT'
+
+    conf = configparser.ConfigParser()
+    conf.optionxform = str
+    owners = {}
+    conflict = None
+    for path in config_files:
+        try:
+            with io.open(path, encoding='utf8') as f:
+                text = f.read()
+        except (IOError, OSError, UnicodeError) as e:
+            raise ConfigError('failed reading job config file "{}": {}'.format(path, e))
+        # 行首的 [name] 即为 section 标题（缩进的行是上一个选项的续行）
+        for name in set(filter(key, re_section.findall(text))):
+            if name in owners and conflict is None:
+                conflict = name, owners[name], path
+            owners.setdefault(name, path)
+        try:
+            conf.read_string(text, source=path)
+        except configparser.Error as e:
+            raise ConfigError('failed parsing job config file "{}": {}'.format(path, e))
+    return {name: dict(conf.items(name)) for name in conf.sections()}, conflict
+
+
 def detect_configs_conflict(config_files, key=None):
     """检测多个配置文件中发生名称冲突的 section。
     如果有冲突，返回找到的第一个冲突项，以及发生冲突的两个文件。
@@ -72,17 +114,36 @@ def detect_configs_conflict(config_files, key=None):
 
 # 检查作业配置
 # ------------------------------------------------------------------------------
-def check_out_job_config(job_conf, db_configs):
-    """检查某个具体作业的配置。如果配置有误，将打印报错信息并跳过该作业。"""
+# 并行检查作业配置的线程数，检查中包含读取 sql 文件等 I/O 操作
+CHECK_WORKERS = 8
+
+
+def check_out_job_config(job_conf, db_configs, alarms=None):
+    """检查某个具体作业的配置。如果配置有误，将打印报错信息、发送报警并跳过该作业。
+    alarms 不为空时不立即发送报警，而是将 (收件人, 消息) 加入 alarms，由调用者稍后统一发送（见 send_config_alarms）。
+    """
     try:
         return _check_out_job_config(job_conf, db_configs)
     except ConfigError as e:
         logger.error('job [{}] config error: {}'.format(job_conf['_name'], e))
         info = AlarmInfo('config_error', e)
-        send_email(job_conf['alarm_email'], format_html(job_conf, info))
+        alarm = (job_conf['alarm_email'], format_html(job_conf, info))
+        if alarms is None:
+            send_email(*alarm)
+        else:
+            alarms.append(alarm)
         return None
 
 
+def send_config_alarms(alarms):
+    """依次发送配置错误报警，某个报警发送失败不影响其他报警"""
+    for to_users, msg in alarms:
+        try:
+            send_email(to_users, msg)
+        except Exception as e:
+            logger.error('failed sending config error alarm to {}: {}'.format(to_users, e))
+
+
 def _check_out_job_config(job_conf, db_configs):
     """检查用户配置"""
 
@@ -153,6 +214,68 @@ def _check_out_job_config(job_conf, db_configs):
             'can not parse retry_interval("{}") into datetime.timedelta'
             .format(job_conf['retry_interval']))
 
+    # 解析 query_cache
+    if job_conf.get('query_cache', 'true').lower() not in ('true', 'false'):
+        raise ConfigError('option "query_cache" should be in "{}"'.format(['true', 'false']))
+    job_conf['query_cache'] = job_conf.get('query_cache', 'true').lower() == 'true'
+
+    # 解析 stream。流式结果占用着数据库连接且只能读取一次，因此不能缓存，也不能交给子进程
+    if job_conf.get('stream', 'false').lower() not in ('true', 'false'):
+        raise ConfigError('option "stream" should be in "{}"'.format(['true', 'false']))
+    job_conf['stream'] = job_conf.get('stream', 'false').lower() == 'true'
+    if job_conf['stream']:
+        job_conf['query_cache'] = False
+
+    # 解析 pushdown。开启后简单的 claim、diff 校验改写为 SQL 在数据库中执行，见 pushdown 模块
+    if job_conf.get('pushdown', 'false').lower() not in ('true', 'false'):
+        raise ConfigError('option "pushdown" should be in "{}"'.format(['true', 'false']))
+    job_conf['pushdown'] = job_conf.get('pushdown', 'false').lower() == 'true'
+
+    # 解析 batch。开启后单值的 count 查询可与同时到期的其他作业合并执行，见 batch 模块
+    if job_conf.get('batch', 'true').lower() not in ('true', 'false'):
+        raise ConfigError('option "batch" should be in "{}"'.format(['true', 'false']))
+    job_conf['batch'] = job_conf.get('batch', 'true').lower() == 'true'
+
+    # 解析报警渠道。email 以外的渠道（见 alarm.ALARM_SINKS）需要在 alarm_<渠道> 选项中提供地址，多个地址以半角逗号分隔
+    job_conf['alarm_channels'] = [
+        s.strip().lower() for s in job_conf.get('alarm_channels', 'email').split(',') if s.strip()]
+    for channel in job_conf['alarm_channels']:
+        if channel == 'email':
+            continue
+        if channel not in ALARM_SINKS:
+            raise ConfigError('alarm channel {!r} should be in "{}"'.format(channel, ['email'] + sorted(ALARM_SINKS)))
+        op = 'alarm_' + channel
+        job_conf[op] = [s.strip() for s in job_conf.get(op, '').split(',') if s.strip()]
+        if not job_conf[op]:
+            raise ConfigError('option "{}" is required when using alarm channel {!r}'.format(op, channel))
+
+    # 解析查询结果的行数、大小上限，以及报警正文中最多列出的数据行数
+    for op in ('max_result_rows', 'max_result_mb', 'alarm_max_rows'):
+        try:
+            job_conf[op] = int(job_conf.get(op) or 0) or None
+        except ValueError:
+            raise ConfigError('option "{}" should be an integer, but {!r} got'.format(op, job_conf[op]))
+
+    # 解析校验进程相关选项。auto 表示仅当校验表达式调用了 CPU 密集的 claim、diff 时才使用子进程。
+    # 子进程由多线程的主进程 fork 而来，可能继承其他线程持有的锁而卡住，直到超时才被终止，因此默认不使用子进程；
+    # 设置了 CPU 或内存上限时默认使用子进程（上限只能在子进程中生效）
+    default = 'true' if job_conf.get('validator_cpu_limit') or job_conf.get('validator_mem_limit') else 'false'
+    validator_process = (job_conf.get('validator_process') or default).lower()
+    if validator_process not in ('auto', 'true', 'false'):
+        raise ConfigError('option "validator_process" should be in "{}"'.format(['auto', 'true', 'false']))
+    if job_conf['stream']:
+        job_conf['validator_process'] = False
+    elif validator_process == 'auto':
+        job_conf['validator_process'] = bool(re.search(r'\b(claim|diff)\s*\(', job_conf['validator']))
+    else:
+        job_conf['validator_process'] = validator_process == 'true'
+
+    for op in ('validator_cpu_limit', 'validator_mem_limit', 'validator_timeout'):
+        try:
+            job_conf[op] = int(job_conf.get(op) or 0) or None
+        except ValueError:
+            raise ConfigError('option "{}" should be an integer, but {!r} got'.format(op, job_conf[op]))
+
     # 将 db_conf, database, sql 分别处理成列表，并保证三者的长度等长（database 可为空）
     job_conf['db_conf'] = [s.strip() for s in job_conf['db_conf'].split(',') if s.strip()]
     if 'database' in job_conf and job_conf['database']:
@@ -173,26 +296,26 @@ def _check_out_job_config(job_conf, db_configs):
             raise ConfigError('Invalid db_conf {!r}, should be in {!r}'.format(
                 job_conf['db_conf'], db_configs.keys()))
 
-    # 如果 sql 选项是文件路径，那么从文件中读取 sql 内容，支持绝对路径与相对路径
+    # 如果 sql 选项是文件路径，那么从文件中读取 sql 内容，支持绝对路径与相对路径。
+    # 记录读取过的文件，文件修改后缓存的检查结果失效
+    job_conf['_sql_files'] = []
     for i, s in enumerate(job_conf['sql']):
         if s.startswith('/') or s.startswith('~/') or s.startswith('.') or s[-4:].lower() in ('.sql', '.hql'):
             if not os.path.isfile(s):
                 raise ConfigError('sql file not exists: {!r}'.format(s))
+            job_conf['_sql_files'].append(s)
             with open(s, 'r') as f:
                 # 文件中的 %(name)s 因为脱离了 cfg 文件，不会被自动替换，此处需手动置换
                 sql = f.read()
                 job_conf['sql'][i] = sql % job_conf
 
-    # 检查 validator 是否有语法错误，以及是否调用了不存在的变量
-    from context import get_validator_context
+    # 预编译 validator，检查是否有语法错误、是否引用了不存在的变量或不安全的属性。
+    # 编译结果会被缓存，执行作业时不必再解析
     try:
-        # 此处仅用于快速检验校验表达式有无语法错误，不执行实际计算
-        eval(job_conf['validator'], {'__builtins__': {}}, dict(get_validator_context(), result=None))
-    except (SyntaxError, NameError) as e:
+        compile_validator(job_conf['validator'])
+    except (SyntaxError, NameError, ValueError) as e:
         tb = traceback.format_exc()
         raise ConfigError('error in option "validator", traceback is: \n{}'.format(tb))
-    except:
-        pass
 
     # # 对于历史数据监控（基于 claim 校验函数），如果用户未显式设置周期参数，则使用 period 选项填充
     # # 例如：'claim(result, gt(30))' --> 'claim(result, gt(30), period="day")'
@@ -203,13 +326,17 @@ def _check_out_job_config(job_conf, db_configs):
     #             r'\1(\2, period="{}")'.format(job_conf['period']),
     #             job_conf['validator'])
 
-    # 从 db_configs 中取出对应的 db_conf 替换 db_conf 字段
+    _resolve_db_confs(job_conf, db_configs)
+    return job_conf
+
+
+def _resolve_db_confs(job_conf, db_configs):
+    """从 db_configs 中取出对应的 db_conf 替换 db_conf 字段（数据库配置名称）"""
     for i, name in enumerate(job_conf['db_conf']):
         job_conf['db_conf'][i] = db_configs[name]
+        # 复制一份再覆盖 database，不能修改其他作业共享的 db_conf
         if job_conf['database'][i]:
-            job_conf['db_conf'][i]['database'] = job_conf['database'][i]
-
-    return job_conf
+            job_conf['db_conf'][i] = dict(db_configs[name], database=job_conf['database'][i])
 
 
 # 渲染配置
@@ -220,17 +347,45 @@ env = jinja2.Environment(
     variable_end_string='}',)
 env.filters = get_filter_context()
 
+# 编译好的模板缓存（LRU），键为模板源文本。不同作业中相同的选项（如继承自 DEFAULT 的选项）只需编译一次。
+# 模板变量在渲染时通过参数传入，不修改 env.globals，因此模板可以在多个线程中同时渲染
+MAX_TEMPLATES = 4096
+_templates = OrderedDict()
+_templates_lock = threading.Lock()
+
+def get_template(source):
+    """获取 source 编译后的模板，使用 LRU 缓存"""
+    with _templates_lock:
+        template = _templates.pop(source, None)
+        if template is not None:
+            _templates[source] = template
+            return template
+
+    # 在锁外编译，编译较慢，不阻塞其他线程获取缓存的模板
+    template = env.from_string(source)
+    with _templates_lock:
+        _templates[source] = template
+        while len(_templates) > MAX_TEMPLATES:
+            _templates.popitem(last=False)
+    return template
+
 # 有些模板变量依赖其他选项，必须等其他选项渲染完成后才能渲染
 DEPENDING_VARS = ('DUETIME', )
 
+# _escape_vars 使用的正则表达式，按变量列表缓存
+_escape_patterns = {}
+
 def _escape_vars(s, variables):
     """转义指定的一些变量，使其暂时不必渲染。
     此处简单地将花括号替换成了 \x01 \x02。
     """
     if isinstance(variables, basestring):
         variables = [variables]
-    t = '|'.join(variables)
-    return re.sub(r'{([^{}]*?(%s)[^{}]*?)}' % t, '\x01' + r'\1' + '\x02', s)
+    variables = tuple(variables)
+    pattern = _escape_patterns.get(variables)
+    if pattern is None:
+        pattern = _escape_patterns[variables] = re.compile(r'{([^{}]*?(%s)[^{}]*?)}' % '|'.join(variables))
+    return pattern.sub('\x01' + r'\1' + '\x02', s)
 
 def _unescape_vars(s, variables):
     """_escape_vars 的逆操作"""
@@ -238,111 +393,387 @@ def _unescape_vars(s, variables):
 
 def render_job_conf(job_conf):
     """载入时渲染"""
-    global DEPENDING_VARS, env
-
     today = datetime.date.today()
     basetime = datetime.datetime.combine(today, datetime.time.min)
 
-    env.globals = dict(BASETIME=basetime)
-
     for k, v in job_conf.items():
         if isinstance(v, basestring) and '{' in v:
             # 把依赖性变量暂时 escape 掉，渲染完成后再还原
             v = _escape_vars(v, DEPENDING_VARS)
             try:
-                v = env.from_string(v).render()
+                v = get_template(v).render(BASETIME=basetime)
             except Exception as e:
                 raise ValueError('option `{}={}` render error: \n{}'.format(k, v, e))
             job_conf[k] = _unescape_vars(v, DEPENDING_VARS)
 
     return job_conf
 
-def render_depending_job_conf(job_conf):
+# 目前仅 sql, validator 选项为依赖性渲染，后期可能增加别的选项
+DEPENDING_OPTIONS = ('sql', 'validator')
+
+def compile_depending_job_conf(job_conf):
+    """预编译依赖性选项的模板，返回 {option: template}。
+    同一个作业的多次执行（如小时级作业）只需编译一次，不含渲染块的选项直接跳过。
+    """
+    templates = {}
+    for op in DEPENDING_OPTIONS:
+        v = job_conf[op]
+        if isinstance(v, (list, tuple)):
+            v = '\x01'.join(v)
+        if '{' in v:
+            templates[op] = get_template(v)
+    return templates
+
+def render_depending_job_conf(job_conf, templates=None):
     """有一些选项依赖其他选项，必须等其他选项渲染之后才能渲染。
     例如小时级作业的 sql 选项中可能包含的 DUETIME 变量，只有在 due_time 选项渲染完成后才能确定。
+    templates 为 compile_depending_job_conf 预编译的模板，不提供时现场编译。
     """
-    global env
+    if templates is None:
+        templates = compile_depending_job_conf(job_conf)
 
-    env.globals = dict(DUETIME=job_conf['due_time'])
-
-    # 目前仅 sql, validator 选项为依赖性渲染，后期可能增加别的选项
-    for op in ('sql', 'validator'):
+    for op, template in templates.items():
+        v = template.render(DUETIME=job_conf['due_time'])
         if isinstance(job_conf[op], (list, tuple)):
-            sep = '\x01'
-            job_conf[op] = env.from_string(sep.join(job_conf[op])).render().split(sep)
-        else:
-            job_conf[op] = env.from_string(job_conf[op]).render()
+            v = v.split('\x01')
+        job_conf[op] = v
 
     return job_conf
 
 
 # 主函数，载入、处理所有配置并返回给主程序
 # ------------------------------------------------------------------------------
-def get_job_conf_list(db_config_file, job_config_files, job_names):
-    """检查、清洗和渲染作业配置。
-    返回一个处理好的作业配置序列，其中的每个作业配置可用于生成和运行作业。
+def get_db_configs(db_config_file):
+    """读取数据库配置文件"""
+    try:
+        db_configs = get_config(db_config_file)
+    except configparser.Error as e:
+        raise ConfigError('failed parsing db config file "{}": {}'.format(db_config_file, e))
+    for name, db_conf in db_configs.items():
+        db_conf['_name'] = name
+        # sqlite 等基于文件的数据库不需要端口
+        for op in ('port', 'max_concurrency', 'pool_size', 'min_idle'):
+            if op in db_conf:
+                try:
+                    db_conf[op] = int(db_conf[op])
+                except ValueError:
+                    raise ConfigError('db-config error, {} should be an integer, but {!r} got'.format(op, db_conf[op]))
+        if 'max_cost' in db_conf:
+            try:
+                db_conf['max_cost'] = float(db_conf['max_cost'])
+            except ValueError:
+                raise ConfigError('db-config error, max_cost should be a number, but {!r} got'.format(db_conf['max_cost']))
+        for op in ('warm_up', 'ping'):
+            if op in db_conf:
+                if db_conf[op].lower() not in ('true', 'false'):
+                    raise ConfigError('db-config error, {} should be in "{}"'.format(op, ['true', 'false']))
+                db_conf[op] = db_conf[op].lower() == 'true'
+    return db_configs
+
+
+def _hash_section(section):
+    """计算一个配置 section 的内容哈希（DEFAULT 中的选项已合并在内）"""
+    return hashlib.md5(repr(sorted(section.items())).encode('utf8')).hexdigest()
+
+
+def _stamp(path):
+    """文件的 (路径, 修改时间, 大小)，用于判断文件是否被修改。文件不存在时后两项为 None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return path, None, None
+    return path, st.st_mtime, st.st_size
+
+
+def _is_fresh(entry):
+    """检查结果依赖的 sql 文件是否都没有被修改"""
+    return all(_stamp(stamp[0]) == stamp for stamp in entry[2])
+
+
+# 作业配置清单的格式版本，清单的结构改变时需要递增
+MANIFEST_VERSION = 2
+
+# 影响配置检查结果的代码文件，修改后清单失效
+_code_dir = os.path.dirname(os.path.abspath(__file__))
+_code_files = [
+    os.path.join(_code_dir, name)
+    for name in ('config.py', 'context.py', os.path.join('user', 'filters.py'), os.path.join('user', 'validators.py'))]
+
+
+class JobConfLoader(object):
+    """载入并检查作业配置。
+    检查结果按 section 内容哈希缓存，重新载入时只检查内容发生变化的 section，
+    用于常驻模式下的配置热加载。由于配置渲染依赖 BASETIME，跨天后缓存全部失效。
+    manifest_file 不为空时，检查结果还会保存到该文件（作业配置清单），下次启动时：
+    - 配置文件、sql 文件以及相关代码都未修改，且仍是同一天时，直接使用清单中的结果，不必解析配置文件；
+    - 否则只重新检查内容发生变化的 section。
+    检查未通过的 section 不保存到清单中，以便下次启动时重新检查并报警。
+    清单以 pickle 格式保存，只有当前用户可以读写；不属于当前用户的清单不会被读取，以免反序列化时执行他人构造的代码。
+    清单中不保存数据库的连接信息（如密码），只保存数据库配置名称，读取时再从数据库配置文件中取出。
+    需要检查的 section 在线程池中并行检查。defer_alarms 为真时，配置错误报警不在载入时发送，
+    由调用者通过 pop_config_alarms 取出后统一发送，以免邮件服务器较慢时推迟作业的分发。
     """
 
-    # 由于作业配置文件可以有多个，所以需要判断其中有误冲突作业。
-    # 如果作业名有冲突，报错告知具体冲突情况并退出程序。
-    res = detect_configs_conflict(
-        job_config_files,
-        key=lambda s: s!='DEFAULT' and not s.startswith('_'))
-    if res:
-        raise ConfigError('Conflicted job name "{}" in "{}" and "{}"'.format(*res))
+    def __init__(self, db_config_file, job_config_files, job_names, manifest_file=None, defer_alarms=False):
+        self.db_config_file = db_config_file
+        self.job_config_files = job_config_files
+        self.job_names = job_names
+        self.manifest_file = manifest_file
+        self.defer_alarms = defer_alarms
+        # 尚未发送的配置错误报警 [(收件人, 消息)]
+        self._alarms = []
+        self._mtimes = None
+        self._day = None
+        self._db_hash = None
+        # 上一次解析配置文件时各文件的状态，以及文件中的全部作业名称
+        self._stamps = None
+        self._names = []
+        # section name -> (content hash, checked job_conf, sql 文件状态)，检查未通过的 job_conf 为 None
+        self._checked = {}
+        # 上一次载入返回的 section，用于计算发生变化的 section
+        self._current = {}
+
+    def _get_mtimes(self):
+        files = [self.db_config_file] + list(self.job_config_files)
+        return [os.path.getmtime(f) if os.path.exists(f) else None for f in files]
+
+    def _get_stamps(self):
+        return [_stamp(f) for f in [self.db_config_file] + list(self.job_config_files) + _code_files]
+
+    def is_modified(self):
+        """配置文件自上次载入以来是否被修改过"""
+        return self._get_mtimes() != self._mtimes
+
+    def load(self):
+        """载入配置，返回 (job_confs, changed)。
+        job_confs 为 {section name: 检查通过且活跃的 job_conf}；
+        changed 为自上次载入以来内容发生变化（包括新增和删除）的 section 名称集合。
+        """
+        self._mtimes = self._get_mtimes()
+        today = datetime.date.today()
+        if today != self._day:
+            self._checked = {}
+            self._stamps = None
+            self._day = today
+            self._restore_manifest()
+
+        stamps = self._get_stamps()
+        selected = self._select_unchanged(stamps)
+        if selected is None:
+            selected = self._check_files(stamps)
+            self._save_manifest()
+            if not self.defer_alarms:
+                send_config_alarms(self.pop_config_alarms())
+        return self._collect(selected)
+
+    def add_reload_alarm(self, error):
+        """重新载入配置失败（如配置文件被删除或有语法错误）时调用。之前载入的作业仍按原配置执行，
+        报警发送给这些作业的收件人，同样暂存在 pop_config_alarms 中
+        """
+        recipients = OrderedDict()
+        for name, (_, job_conf, _) in sorted(self._current.items()):
+            if job_conf is not None:
+                recipients.setdefault(tuple(job_conf['alarm_email']), []).append(name)
+        content = 'failed reloading job configs, jobs keep running with the previous configs: {}'.format(error)
+        for to_users, names in recipients.items():
+            msg = format_html({'_name': ', '.join(names)}, AlarmInfo('config_error', content))
+            self._alarms.append((list(to_users), msg))
+
+    def pop_config_alarms(self):
+        """取出尚未发送的配置错误报警"""
+        alarms, self._alarms = self._alarms, []
+        return alarms
+
+    def _select_unchanged(self, stamps):
+        """配置文件未修改且需要的 section 都已检查过时，直接返回缓存的检查结果，否则返回 None"""
+        if stamps != self._stamps:
+            return None
+        selected = {}
+        for job_name in self.job_names or self._names:
+            entry = self._checked.get(job_name)
+            if entry is None or not _is_fresh(entry):
+                return None
+            selected[job_name] = entry
+        return selected
+
+    def _check_files(self, stamps):
+        """解析配置文件，检查需要的 section（内容未变化的 section 使用缓存的检查结果）"""
+        # 由于作业配置文件可以有多个，所以需要判断其中有误冲突作业。
+        # 如果作业名有冲突，报错告知具体冲突情况并退出程序。
+        job_configs, conflict = read_job_configs(
+            self.job_config_files,
+            key=lambda s: s!='DEFAULT' and not s.startswith('_'))
+        if conflict:
+            raise ConfigError('Conflicted job name "{}" in "{}" and "{}"'.format(*conflict))
+
+        # 读取数据库配置文件，数据库配置变化时所有作业都需要重新检查
+        db_configs = get_db_configs(self.db_config_file)
+        db_hash = _hash_section({name: _hash_section(c) for name, c in db_configs.items()})
+        if db_hash != self._db_hash:
+            self._checked = {}
+            self._db_hash = db_hash
+
+        # 如果不指定 job_names，则监控全部（但跳过 DEFAULT 和以下划线开头的作业）
+        self._names = [
+            name for name in job_configs.keys()
+            if name != 'DEFAULT' and not name.startswith('_')]
+        job_names = self.job_names or self._names
+
+        selected = {}
+        to_check = []
+        for job_name in job_names:
+            # 如果作业名称不存在，将直接报错并退出程序
+            if not job_name in job_configs:
+                raise ConfigError('Job name "{}" not exists'.format(job_name))
+
+            section_hash = _hash_section(job_configs[job_name])
+            entry = self._checked.get(job_name)
+            if entry is not None and entry[0] == section_hash and _is_fresh(entry):
+                selected[job_name] = entry
+                continue
 
-    # 读取数据库配置文件
-    db_configs = get_config(db_config_file)
-    for name, db_conf in db_configs.items():
-        db_conf['_name'] = name
+            # 获取 job_conf，并将 job 名称绑定到一个私有属性 _name 上
+            to_check.append((job_name, section_hash, dict(job_configs[job_name], _name=job_name)))
+
+        # 并行检查作业配置，如果有误将打印错误并跳过该作业，报警暂存在 self._alarms 中
+        if to_check:
+            check = lambda job_conf: check_out_job_config(job_conf, db_configs, self._alarms)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(CHECK_WORKERS, len(to_check))) as executor:
+                job_confs = list(executor.map(check, [job_conf for _, _, job_conf in to_check]))
+            for (job_name, section_hash, _), job_conf in zip(to_check, job_confs):
+                sql_stamps = [_stamp(path) for path in job_conf['_sql_files']] if job_conf is not None else []
+                selected[job_name] = (section_hash, job_conf, sql_stamps)
+
+        # 未选中的 section 的缓存结果也要按当前内容校验，内容已变化的丢弃
+        self._checked = {
+            name: entry for name, entry in self._checked.items()
+            if name not in selected and name in job_configs and entry[0] == _hash_section(job_configs[name])}
+        self._checked.update(selected)
+        self._stamps = stamps
+        return selected
+
+    def _collect(self, selected):
+        """由选中的检查结果生成 load 的返回值"""
+        changed = set(self._current) - set(selected)
+        changed.update(name for name, entry in selected.items() if self._current.get(name) is not entry)
+        self._current = selected
+
+        job_confs = {}
+        for job_name, (_, job_conf, _) in selected.items():
+            if job_conf is None:
+                continue
+            # 跳过非活跃作业
+            if not job_conf['is_active']:
+                if job_name in changed:
+                    logger.info('skiped inactive job "{}"'.format(job_name))
+                continue
+            job_confs[job_name] = job_conf
+        return job_confs, changed
+
+    def _restore_manifest(self):
+        """从清单文件恢复当天的检查结果"""
+        if not self.manifest_file or not os.path.exists(self.manifest_file):
+            return
         try:
-            db_conf['port'] = int(db_conf['port'])
-        except ValueError:
-            raise ConfigError('db-config error, port should be an integer, but {!r} got'.format(db_conf['port']))
+            with open(self.manifest_file, 'rb') as f:
+                owner = os.fstat(f.fileno()).st_uid
+                if owner != os.getuid():
+                    logger.warning('ignored job manifest "{}": owned by uid {}, not the current user'.format(
+                        self.manifest_file, owner))
+                    return
+                manifest = pickle.load(f)
+        except Exception as e:
+            logger.warning('failed reading job manifest "{}": {}'.format(self.manifest_file, e))
+            return
+        if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION \
+                or manifest.get('day') != self._day:
+            return
+
+        # 清单中只有数据库配置名称，从当前的数据库配置文件中取出连接信息，数据库配置变化时清单失效
+        try:
+            db_configs = get_db_configs(self.db_config_file)
+        except Exception as e:
+            logger.warning('failed reading db config "{}": {}'.format(self.db_config_file, e))
+            return
+        if _hash_section({name: _hash_section(c) for name, c in db_configs.items()}) != manifest['db_hash']:
+            return
+        for _, job_conf, _ in manifest['checked'].values():
+            _resolve_db_confs(job_conf, db_configs)
+        self._checked = manifest['checked']
+        self._stamps = manifest['stamps']
+        self._names = manifest['names']
+        self._db_hash = manifest['db_hash']
+
+    def _save_manifest(self):
+        """把检查通过的结果保存到清单文件。先写临时文件再重命名，避免其他进程读到不完整的清单"""
+        if not self.manifest_file:
+            return
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'day': self._day,
+            'stamps': self._stamps,
+            'names': self._names,
+            'db_hash': self._db_hash,
+            'checked': {
+                name: (section_hash, _strip_db_confs(job_conf), sql_stamps)
+                for name, (section_hash, job_conf, sql_stamps) in self._checked.items() if job_conf is not None},
+        }
+        tmp_file = '{}.{}.tmp'.format(self.manifest_file, os.getpid())
+        try:
+            # 清单只允许当前用户读写
+            with os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+                pickle.dump(manifest, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_file, self.manifest_file)
+        except Exception as e:
+            logger.warning('failed saving job manifest "{}": {}'.format(self.manifest_file, e))
 
-    # 读取监控作业配置文件（注意，可以是多个文件）
-    job_configs = get_config(job_config_files)
 
-    # 如果不指定 job_names，则监控全部（但跳过 DEFAULT 和以下划线开头的作业）
-    if not job_names:
-        job_names = (
-            name for name in job_configs.keys()
-            if name != 'DEFAULT' and not name.startswith('_'))
+def _strip_db_confs(job_conf):
+    """保存到清单中的 job_conf：db_conf 只保留数据库配置名称，不保存连接信息"""
+    return dict(job_conf, db_conf=[db_conf['_name'] for db_conf in job_conf['db_conf']])
 
-    # 遍历处理作业
-    for job_name in job_names:
-        # 如果作业名称不存在，将直接报错并退出程序
-        if not job_name in job_configs:
-            raise ConfigError('Job name "{}" not exists'.format(job_name))
 
-        # 获取 job_conf，并将 job 名称绑定到一个私有属性 _name 上
-        job_conf = dict(job_configs[job_name], _name=job_name)
+def expand_job_conf(job_conf, today=None, after=None):
+    """将检查好的作业配置展开为当天需要执行的作业，按到期时间先后惰性产生。
+    天级以上作业仅当 due_time 为当天时产生一个作业，小时级作业依次产生 24 个作业。
+    依赖 DUETIME 的选项在取出作业时才渲染，模板只编译一次。
+    after 不为空时跳过到期时间不晚于 after 的作业（不渲染）。
+    返回的作业均为新的 dict，不会修改 job_conf 本身。
+    """
+    if today is None:
+        today = datetime.date.today()
+
+    # 天级以上作业只执行一次，小时级作业每小时执行一次
+    if job_conf['period'] != 'hour':
+        # 如果 due_time 不是当天则跳过
+        if job_conf['due_time'].date() != today:
+            logger.info('skiped unscheduled job: [{}] at {}'.format(job_conf['_name'], job_conf['due_time']))
+            return
+        due_times = [job_conf['due_time']]
+    else:
+        one_hour = datetime.timedelta(hours=1)
+        due_times = [job_conf['due_time'] + i * one_hour for i in range(24)]
 
-        # 检查作业配置，如果有误将打印错误并跳过该作业
-        job_conf = check_out_job_config(job_conf, db_configs)
-        if job_conf is None:
+    templates = None
+    for due_time in due_times:
+        if after is not None and due_time <= after:
             continue
+        if templates is None:
+            templates = compile_depending_job_conf(job_conf)
 
-        # 跳过非活跃作业
-        if not job_conf['is_active']:
-            logger.info('skiped inactive job "{}"'.format(job_name))
-            continue
+        name = job_conf['_name']
+        # 为了区分不同小时的同一个作业，在作业名称中加入时间
+        if job_conf['period'] == 'hour':
+            name += '_hour' + due_time.strftime('%H')
+        new_job_conf = dict(job_conf, due_time=due_time, _name=name, _section=job_conf['_name'])
+        yield render_depending_job_conf(new_job_conf, templates)
 
-        # 天级以上作业
-        if job_conf['period'] != 'hour':
-            # 如果 due_time 不是当天则跳过
-            today = datetime.date.today()
-            if job_conf['due_time'].date() != today:
-                logger.info('skiped unscheduled job: [{}] at {}'.format(job_name, job_conf['due_time']))
-                continue
-            yield render_depending_job_conf(job_conf)
 
-        # 小时级作业复制成 24 份
-        else:
-            one_hour = datetime.timedelta(hours=1)
-            for i in range(24):
-                due_time = job_conf['due_time'] + i * one_hour
-                # 为了区分不同小时的同一个作业，在作业名称中加入时间
-                name = job_conf['_name'] + '_hour' + due_time.strftime('%H')
-                new_job_conf = dict(job_conf, due_time=due_time, _name=name)
-                yield render_depending_job_conf(new_job_conf)
+def get_job_conf_list(db_config_file, job_config_files, job_names):
+    """检查、清洗和渲染作业配置。
+    返回一个处理好的作业配置序列，其中的每个作业配置可用于生成和运行作业。
+    """
+    job_confs, _ = JobConfLoader(db_config_file, job_config_files, job_names).load()
+    for job_name in sorted(job_confs):
+        for job in expand_job_conf(job_confs[job_name]):
+            yield job
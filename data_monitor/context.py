@@ -8,6 +8,10 @@
 """
 
 
+import ast
+import threading
+
+
 # 装饰器，支持用户自定义 jinja2 过滤器
 # ------------------------------------------------------------------------------
 _filters = []
@@ -63,3 +67,72 @@ def get_validator_context():
     validator_context.update({func.__name__: func for func in _validators})
 
     return validator_context
+
+
+# 预编译校验表达式
+# ------------------------------------------------------------------------------
+_base_validator_context = None
+_compiled_validators = {}
+_lock = threading.Lock()
+
+# 编译缓存的容量。依赖 DUETIME 的校验表达式每次渲染结果都不同，常驻模式下需要限制缓存大小
+MAX_COMPILED_VALIDATORS = 4096
+
+# 校验表达式中不允许访问的属性（以双下划线开头的属性也不允许访问），防止借此逃逸出受限的上下文
+_unsafe_attrs = frozenset([
+    'func_globals', 'func_code', 'func_closure', 'gi_frame', 'gi_code',
+    'f_globals', 'f_locals', 'f_builtins', 'f_back', 'tb_frame', 'im_func', 'im_self', 'im_class',
+])
+
+
+def get_base_validator_context():
+    """获取所有校验表达式共享的基础上下文，每个进程只构建一次。
+    该字典作为校验表达式的全局命名空间被所有作业共享，调用方不能修改它。
+    """
+    global _base_validator_context
+    if _base_validator_context is None:
+        with _lock:
+            if _base_validator_context is None:
+                context = get_validator_context()
+                context['__builtins__'] = {}
+                _base_validator_context = context
+    return _base_validator_context
+
+
+def _check_validator_ast(tree):
+    """检查校验表达式的语法树：只能引用上下文中的名称、result 以及表达式内部绑定的变量
+    （如推导式、lambda 的参数），不能访问不安全的属性
+    """
+    names = set(get_base_validator_context())
+    names.add('result')
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            names.add(node.id)
+        elif type(node).__name__ == 'arg':
+            # Python 3 中 lambda 的参数
+            names.add(node.arg)
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load) and node.id not in names:
+            raise NameError('name {!r} is not defined'.format(node.id))
+        if isinstance(node, ast.Attribute) and (node.attr.startswith('__') or node.attr in _unsafe_attrs):
+            raise ValueError('access to attribute {!r} is not allowed'.format(node.attr))
+
+
+def compile_validator(validator):
+    """编译校验表达式并检查其安全性，返回代码对象，相同的表达式只编译一次。
+    表达式有语法错误时抛出 SyntaxError，引用了不存在的名称时抛出 NameError，访问了不安全的属性时抛出 ValueError。
+    """
+    code = _compiled_validators.get(validator)
+    if code is not None:
+        return code
+
+    tree = ast.parse(validator.strip(), mode='eval')
+    _check_validator_ast(tree)
+    code = compile(tree, '<validator>', 'eval')
+
+    with _lock:
+        if len(_compiled_validators) >= MAX_COMPILED_VALIDATORS:
+            _compiled_validators.clear()
+        _compiled_validators[validator] = code
+    return code
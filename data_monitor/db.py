@@ -8,29 +8,374 @@
 """
 
 
-import MySQLdb
+from contextlib import closing
+import re
+import threading
+import time
+
 from DBUtils.PooledDB import PooledDB
 
+from .metrics import registry as metrics
+from .profiler import profiler
+from .result import ResultSet
 
-# 对每个不同的数据库分别维护一个连接池
-_pools = {}
 
+# 对每个不同的数据库分别维护一个连接池，键为 (db_conf 名称, database)
+_pools = {}
+_pools_lock = threading.Lock()
 
-def _create_pool(db_conf, pool_size=10):
-    """create connection pool"""
+# 连接池默认配置，可在 database.cfg 的每个 section 中分别覆盖
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MIN_IDLE = 0
 
-    return PooledDB(
-        creator=MySQLdb, maxconnections=pool_size, blocking=True,
+# 数据库驱动。每个驱动接收 db_conf，返回 (DB-API 2.0 模块, 连接参数)，
+# 驱动模块按需导入，未使用的驱动不需要安装
+# ------------------------------------------------------------------------------
+def _mysql_driver(db_conf):
+    import MySQLdb
+    return MySQLdb, dict(
         host=db_conf['host'], port=db_conf['port'],
         user=db_conf['user'], passwd=db_conf['password'],
         db=db_conf['database'], charset=db_conf['charset'],
         )
 
+def _sqlite_driver(db_conf):
+    """sqlite 驱动，database 为数据库文件路径，主要用于本地调试和测试"""
+    import sqlite3
+    return sqlite3, dict(database=db_conf['database'], check_same_thread=False)
+
+DRIVERS = {
+    'mysql': _mysql_driver,
+    'sqlite': _sqlite_driver,
+}
+
+
+# 流式查询使用的游标。MySQL 默认游标会把全部结果读入客户端内存，需要使用服务端游标；
+# sqlite 的默认游标本身就是逐行读取的
+def _mysql_stream_cursor(conn):
+    import MySQLdb.cursors
+    return conn.cursor(MySQLdb.cursors.SSCursor)
+
+STREAM_CURSORS = {
+    'mysql': _mysql_stream_cursor,
+    'sqlite': lambda conn: conn.cursor(),
+}
+
+# 流式查询每次从游标读取的行数
+STREAM_CHUNK_SIZE = 10000
+
+
+class ResultTooLarge(ValueError):
+    """查询结果超过作业设定的行数或大小上限"""
+
+
+def get_max_concurrency(db_conf):
+    """获取数据库允许的最大并发查询数，默认与连接池大小相同，使得查询不会阻塞在等待连接上"""
+    return int(db_conf.get('max_concurrency') or db_conf.get('pool_size') or DEFAULT_POOL_SIZE)
+
+
+class _TrackedConnection(object):
+    """连接代理，归还连接时更新连接池的统计信息"""
+
+    def __init__(self, conn, pool):
+        self._conn = conn
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._pool is not None:
+            self._conn.close()
+            self._pool._on_checkin()
+            self._pool = None
+
+
+class ConnectionPool(object):
+    """数据库连接池，在 DBUtils.PooledDB 的基础上记录借出次数、等待时间等统计信息。
+    可通过 database.cfg 配置：
+    - pool_size: 最大连接数
+    - min_idle: 连接池中保持的最少空闲连接数，创建连接池时即建立这些连接
+    - ping: 借出连接时是否检查连接可用性（断开的连接会自动重连）
+    """
+
+    def __init__(self, db_conf):
+        self.name = db_conf['_name']
+        self.driver = db_conf.get('driver', 'mysql')
+        if self.driver not in DRIVERS:
+            raise ValueError('unknown database driver {!r}, should be one of {!r}'.format(self.driver, sorted(DRIVERS)))
+        creator, kwargs = DRIVERS[self.driver](db_conf)
+
+        self.size = int(db_conf.get('pool_size') or DEFAULT_POOL_SIZE)
+        min_idle = int(db_conf.get('min_idle') or DEFAULT_MIN_IDLE)
+        ping = 1 if db_conf.get('ping', True) else 0
+        self._pool = PooledDB(
+            creator=creator, mincached=min_idle, maxconnections=self.size,
+            blocking=True, ping=ping, **kwargs)
+
+        self._lock = threading.Lock()
+        self._checkouts = 0
+        self._in_use = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def connection(self):
+        """借出一个连接，连接池已满时阻塞等待"""
+        start = time.time()
+        conn = self._pool.connection()
+        wait = time.time() - start
+        with self._lock:
+            self._checkouts += 1
+            self._in_use += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+        metrics.observe('connect', wait, db=self.name)
+        return _TrackedConnection(conn, self)
+
+    def _on_checkin(self):
+        with self._lock:
+            self._in_use -= 1
+
+    def stats(self):
+        """连接池统计信息"""
+        with self._lock:
+            return {
+                'size': self.size,
+                'in_use': self._in_use,
+                'checkouts': self._checkouts,
+                'wait_time_total': self._wait_total,
+                'wait_time_max': self._wait_max,
+                'wait_time_avg': self._wait_total / self._checkouts if self._checkouts else 0.0,
+            }
+
+
+def get_pool(db_conf):
+    """获取数据库对应的连接池，不存在时创建（线程安全）"""
+
+    key = (db_conf['_name'], db_conf.get('database'))
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(db_conf)
+    return pool
+
 
 def get_connection(db_conf):
     """get a connection from the corresponding pool"""
 
-    name = db_conf['_name']
-    if name not in _pools:
-        _pools[name] = _create_pool(db_conf)
-    return _pools[name].connection()
+    return get_pool(db_conf).connection()
+
+
+def warm_up(db_conf):
+    """预先创建连接池并建立 min_idle 个连接，避免第一个查询承担建立连接的开销"""
+
+    get_pool(db_conf)
+
+
+def get_pool_stats():
+    """获取所有连接池的统计信息，返回 {(db_conf 名称, database): stats}"""
+
+    with _pools_lock:
+        pools = list(_pools.items())
+    return {key: pool.stats() for key, pool in pools}
+
+
+def _get_col_names(cursor):
+    """获取结果集的列名，列名不合法时使用 col0, col1..."""
+    return normalize_col_names([t[0] for t in cursor.description])
+
+
+def normalize_col_names(col_names):
+    """把不合法的列名替换为 col0, col1...，返回新的列表"""
+    col_names = list(col_names)
+    for i, name in enumerate(col_names):
+        if not re.match(r'^[\w_]+$', name):
+            col_names[i] = 'col' + str(i)
+    return col_names
+
+
+def _estimate_size(rows):
+    """粗略估计若干行数据占用的字节数：字符串按长度计算，其他类型按 8 字节计算"""
+    size = 0
+    for row in rows:
+        for v in row:
+            size += len(v) if isinstance(v, basestring) else 8
+    return size
+
+
+class _SizeGuard(object):
+    """累计已读取的行数和字节数，超过上限时抛出 ResultTooLarge"""
+
+    def __init__(self, max_rows=None, max_bytes=None):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.rows = 0
+        self.bytes = 0
+
+    def add(self, rows):
+        self.rows += len(rows)
+        if self.max_rows and self.rows > self.max_rows:
+            raise ResultTooLarge('query result exceeds the limit of {} rows'.format(self.max_rows))
+        if self.max_bytes:
+            self.bytes += _estimate_size(rows)
+            if self.bytes > self.max_bytes:
+                raise ResultTooLarge('query result exceeds the limit of {} bytes'.format(self.max_bytes))
+
+
+def _fetch_columns(cursor, ncols, chunk_size=STREAM_CHUNK_SIZE, guard=None):
+    """分批从游标读取数据并直接转置为列，返回各列的值的列表。
+    guard 不为空时检查结果大小，超出上限时尽早失败，不必读完全部结果
+    """
+    columns = [[] for _ in range(ncols)]
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        if guard is not None:
+            guard.add(rows)
+        for column, values in zip(columns, zip(*rows)):
+            column.extend(values)
+    return columns
+
+
+def query(db_conf, sql, max_rows=None, max_bytes=None):
+    """执行一条 SQL 并返回结果。
+    如果结果只有一个值，直接返回该值；否则返回列式存储的 ResultSet，列名不合法时使用 col0, col1...
+    max_rows, max_bytes 为结果的行数和（估计的）字节数上限，超出时立即停止读取并抛出 ResultTooLarge。
+    """
+    with closing(get_connection(db_conf)) as conn:
+        cursor = conn.cursor()
+        with metrics.timer('execute', db=db_conf['_name']):
+            cursor.execute(sql)
+
+        # querys need to commit, except SELECT or SHOW query
+        if not (sql[:7].upper() == 'SELECT ' or sql[:5].upper() == 'SHOW '):
+            conn.commit()
+
+        # 不返回结果集的语句（如 UPDATE）没有列信息
+        if cursor.description is None:
+            return ResultSet.from_columns([], [])
+
+        col_names = _get_col_names(cursor)
+        guard = _SizeGuard(max_rows, max_bytes) if max_rows or max_bytes else None
+        with metrics.timer('fetch', db=db_conf['_name']), profiler.stage('fetch'):
+            columns = _fetch_columns(cursor, len(col_names), guard=guard)
+
+        # if result is only one element, then unpack it
+        if len(columns) == 1 and len(columns[0]) == 1:
+            return columns[0][0]
+
+        return ResultSet.from_columns(col_names, columns)
+
+
+def describe(db_conf, sql):
+    """执行一条查询，只读取第一行。返回 (各列的 (原始列名, 类型代码) 列表, 第一行)，结果为空时第一行为 None。
+    列名不做任何替换，以便在改写的 SQL 中引用；类型代码即 cursor.description 的第二项，sqlite 中为 None。
+    调用方应在 SQL 中限制行数（如 LIMIT 1）。
+    """
+    with closing(get_connection(db_conf)) as conn:
+        cursor = conn.cursor()
+        with metrics.timer('execute', db=db_conf['_name']):
+            cursor.execute(sql)
+        columns = [(t[0], t[1]) for t in cursor.description]
+        return columns, cursor.fetchone()
+
+
+class StreamingResult(object):
+    """流式查询结果，通过服务端游标分批读取数据，内存中只保留当前批次。
+    - chunks(): 依次产生每一批数据（ResultSet），校验函数可逐批聚合；
+    - 迭代: 逐行产生数据；
+    - _fields: 列名，与普通查询结果中每一行的 _fields 相同。
+    结果只能被读取一次。读取完毕或调用 close() 后，连接归还连接池。
+    """
+
+    def __init__(self, conn, cursor, chunk_size=STREAM_CHUNK_SIZE, max_rows=None, max_bytes=None):
+        self._conn = conn
+        self._cursor = cursor
+        self._chunk_size = chunk_size
+        self._guard = _SizeGuard(max_rows, max_bytes)
+        self._fields = tuple(_get_col_names(cursor))
+        self._consumed = False
+        # 已读取的数据在内存中的字节数（粗略）
+        self.nbytes = 0
+
+    @property
+    def nrows(self):
+        """已读取的行数"""
+        return self._guard.rows
+
+    def chunks(self):
+        if self._consumed:
+            raise ValueError('streaming result can only be read once')
+        self._consumed = True
+        try:
+            while True:
+                rows = self._cursor.fetchmany(self._chunk_size)
+                if not rows:
+                    break
+                self._guard.add(rows)
+                chunk = ResultSet.from_columns(self._fields, zip(*rows))
+                self.nbytes += result_nbytes(chunk)
+                yield chunk
+        finally:
+            self.close()
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            for row in chunk:
+                yield row
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._cursor.close()
+            finally:
+                self._conn.close()
+                self._conn = None
+
+    def __repr__(self):
+        return '<StreamingResult fields={!r} rows read={}>'.format(self._fields, self._guard.rows)
+
+
+def stream_query(db_conf, sql, chunk_size=STREAM_CHUNK_SIZE, max_rows=None, max_bytes=None):
+    """执行一条查询，返回 StreamingResult。连接在结果读取完毕或关闭后才归还连接池"""
+    pool = get_pool(db_conf)
+    conn = pool.connection()
+    try:
+        cursor = STREAM_CURSORS[pool.driver](conn)
+        with metrics.timer('execute', db=db_conf['_name']):
+            cursor.execute(sql)
+    except Exception:
+        conn.close()
+        raise
+    return StreamingResult(conn, cursor, chunk_size, max_rows, max_bytes)
+
+
+def result_nbytes(res):
+    """查询结果在内存中的字节数（粗略，字符串等对象按指针大小计算）"""
+    return int(res.df.memory_usage(index=False).sum())
+
+
+def count_results(results):
+    """作业的查询结果的总行数和字节数，单值结果按一行计算。流式结果只计算已读取的部分"""
+    nrows = nbytes = 0
+    for res in results:
+        if isinstance(res, StreamingResult):
+            nrows += res.nrows
+            nbytes += res.nbytes
+        elif isinstance(res, ResultSet):
+            nrows += len(res)
+            nbytes += result_nbytes(res)
+        else:
+            nrows += 1
+            nbytes += 8
+    return nrows, nbytes
+
+
+def close_results(results):
+    """关闭查询结果中未读取完的流式结果，归还其占用的连接"""
+    for res in results:
+        if isinstance(res, StreamingResult):
+            res.close()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""
+@Author:      zhuhe212
+@Email:       zhuhe212@163.com
+@Description: 报警去重与汇总。报警按 (作业配置名, 报警类型, 报警内容的指纹) 去重，
+              窗口期内重复的报警不再单独发送，而是定期汇总为每个收件人一封摘要邮件。
+@CreateAt:    2026-10-18
+"""
+
+
+from collections import OrderedDict
+import datetime
+import hashlib
+import logging
+
+import pandas as pd
+
+from .alarm import load_template
+from .metrics import registry as metrics
+from .result import ResultSet
+
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(obj):
+    """计算查询结果或报警内容的指纹（md5），内容相同的对象指纹相同"""
+    h = hashlib.md5()
+    _update(h, obj)
+    return h.hexdigest()
+
+
+def _update(h, obj):
+    if isinstance(obj, ResultSet):
+        obj = obj.df
+    if isinstance(obj, pd.DataFrame):
+        h.update('DataFrame{!r}'.format([str(dtype) for dtype in obj.dtypes]))
+        h.update(repr(list(obj.columns)))
+        try:
+            h.update(pd.util.hash_pandas_object(obj, index=False).values.tobytes())
+        except TypeError:
+            # 含有无法哈希的值（如列表）时退化为比较其文本
+            h.update(obj.to_csv(index=False, encoding='utf8'))
+    elif isinstance(obj, (list, tuple)):
+        h.update('{}{}'.format(type(obj).__name__, len(obj)))
+        for item in obj:
+            _update(h, item)
+    elif isinstance(obj, unicode):
+        h.update(obj.encode('utf8'))
+    else:
+        h.update(repr(obj))
+
+
+class AlarmDigester(object):
+    """报警去重与汇总，仅由调度线程调用。
+    - 某作业的报警与 window 秒内已发送的报警相同（同一作业配置、类型和内容）时不再发送，
+      例如小时级作业各次执行、作业各次重试产生的相同报警；
+    - 被压制的报警按收件人（邮件收件人或 webhook 类渠道的地址）汇总，每隔 interval 秒为每个收件人发送一份摘要，
+      列出各报警的重复次数；
+    - window 为 0 时不去重，所有报警都直接发送。
+    报警通过报警分发器 dispatcher 发送（见 dispatcher.AlarmDispatcher）。
+    """
+
+    def __init__(self, dispatcher, window=3600, interval=3600):
+        self.dispatcher = dispatcher
+        self.window = datetime.timedelta(seconds=window)
+        self.interval = datetime.timedelta(seconds=interval)
+        # 报警指纹 -> 最近一次发送的时刻
+        self._sent = {}
+        # (渠道, 收件人) -> {报警指纹: 被压制报警的统计}
+        self._pending = OrderedDict()
+        self._next_flush = None
+        self._next_prune = None
+        self.nsuppressed = 0
+
+    def submit(self, job, info):
+        """提交一条报警，新的报警立即发送，重复的报警留待摘要中发送"""
+        now = datetime.datetime.now()
+        if not self.window:
+            self.dispatcher.send_alarm(job, info)
+            return
+
+        key = (job.get('_section', job['_name']), info.type, fingerprint(info.content))
+        last_sent = self._sent.get(key)
+        if last_sent is None or now - last_sent >= self.window:
+            self._sent[key] = now
+            self.dispatcher.send_alarm(job, info)
+            return
+
+        self.nsuppressed += 1
+        metrics.inc('data_monitor_alarms_total', result='suppressed')
+        logger.info('alarm of job [{}] is identical to the one sent at {}, rolled up into digest.'.format(
+            job['_name'], last_sent.strftime('%H:%M:%S')))
+        for recipient in _get_recipients(job):
+            entry = self._pending.setdefault(recipient, OrderedDict()).setdefault(key, {
+                'job': key[0], 'type': info.type, 'count': 0, 'first': now, 'runs': []})
+            entry['count'] += 1
+            entry['last'] = now
+            entry['runs'].append(job['_name'])
+        if self._next_flush is None:
+            self._next_flush = now + self.interval
+
+    def deadline(self):
+        """下一次发送摘要的时刻，没有待发送的摘要时为 None"""
+        return self._next_flush
+
+    def flush(self, force=False):
+        """到达摘要发送时刻（或 force 为真）时，为每个收件人发送一封摘要。
+        调度线程每一轮都会调用，同时定期清理过期的报警指纹（没有待发送的摘要时也要清理）
+        """
+        now = datetime.datetime.now()
+        self._prune(now)
+        if self._next_flush is None or (not force and now < self._next_flush):
+            return
+        pending, self._pending = self._pending, OrderedDict()
+        self._next_flush = None
+        for (channel, target), entries in pending.items():
+            if channel == 'email':
+                self.dispatcher.submit([target], format_digest(entries.values()))
+            else:
+                self.dispatcher.post(channel, [target], format_digest_text(entries.values()))
+        logger.info('sent alarm digest(s) to {} recipient(s).'.format(len(pending)))
+
+    def _prune(self, now):
+        """清理已过期的报警指纹，每个窗口期最多清理一次"""
+        if self._next_prune is not None and now < self._next_prune:
+            return
+        self._next_prune = now + self.window
+        self._sent = {key: t for key, t in self._sent.items() if now - t < self.window}
+
+
+def _get_recipients(job):
+    """作业报警的所有 (渠道, 收件人)"""
+    for channel in job.get('alarm_channels', ['email']):
+        for target in job['alarm_email' if channel == 'email' else 'alarm_' + channel]:
+            yield channel, target
+
+
+def format_digest_text(entries):
+    """生成文本摘要，用于 webhook 类渠道"""
+    msg = ['报警摘要：以下报警与已发送的报警内容相同，未再单独发送', '=' * 20]
+    for entry in entries:
+        msg.append('{job}（{type}）重复 {count} 次，{first:%H:%M:%S} ~ {last:%H:%M:%S}'.format(**entry))
+    return '\n'.join(msg)
+
+
+def format_digest(entries):
+    """生成摘要邮件，entries 为被压制报警的统计"""
+    rows = ''.join(
+        '<tr><td>{job}</td><td>{type}</td><td>{count}</td><td>{first:%Y-%m-%d %H:%M:%S}</td>'
+        '<td>{last:%Y-%m-%d %H:%M:%S}</td><td>{runs}</td></tr>'.format(
+            **dict(entry, runs=', '.join(OrderedDict.fromkeys(entry['runs']))))
+        for entry in entries)
+    return load_template('digest.html').format(rows=rows)
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+"""
+@Author:      zhuhe212
+@Email:       zhuhe212@163.com
+@Description: 报警分发器。报警消息放入队列，由后台线程通过保持打开的 SMTP 连接或 HTTP 会话发送，
+              发送失败时按指数退避重试，调度线程不会因报警服务缓慢或无响应而阻塞。
+@CreateAt:    2026-10-18
+"""
+
+
+import concurrent.futures
+import contextlib
+import logging
+import Queue
+import smtplib
+import threading
+import time
+
+from .alarm import ALARM_SINKS, connect_smtp, format_text, prune_attachments, render_email, send_email
+from .metrics import registry as metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPPool(object):
+    """SMTP 连接池。发送完成的连接放回池中供下次使用，
+    空闲超过 max_idle 秒的连接可能已被服务器断开，取出时丢弃并重新连接；发送出错的连接直接关闭。
+    """
+
+    def __init__(self, host=None, port=None, max_idle=60):
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        # [(连接, 放回时刻)]，后放回的先取出
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _get(self):
+        now = time.time()
+        with self._lock:
+            while self._idle:
+                server, since = self._idle.pop()
+                if now - since <= self.max_idle:
+                    return server
+                _close(server)
+        return connect_smtp(self.host, self.port)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """借出一个连接，正常结束后放回池中"""
+        server = self._get()
+        try:
+            yield server
+        except Exception:
+            _close(server)
+            raise
+        with self._lock:
+            self._idle.append((server, time.time()))
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _ in idle:
+            _close(server)
+
+
+def _close(server):
+    try:
+        server.quit()
+    except Exception:
+        server.close()
+
+
+def _is_permanent(e):
+    """是否为重试也无法成功的错误（如收件人被拒绝、5xx 响应、HTTP 4xx 响应）"""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return True
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 500 <= e.smtp_code < 600
+    # requests.HTTPError 带有 response，请求过于频繁（429）时可以重试
+    status = getattr(getattr(e, 'response', None), 'status_code', None)
+    return status is not None and 400 <= status < 500 and status != 429
+
+
+class AlarmDispatcher(object):
+    """报警分发器，调度线程提交报警后立即返回，报警在后台发送：
+    - 邮件报警（submit）放入队列，由 workers 个后台线程通过 SMTP 连接池发送；
+    - webhook 类报警（post）的每个地址作为一个任务提交到 http_workers 个线程的线程池，并发发送，
+      同一渠道共享一个 HTTP 会话（见 alarm.WebhookSink），每个请求的超时由渠道决定；
+    - 每条报警最多尝试 max_retries + 1 次，第 n 次重试前等待 backoff * 2 ** (n - 1) 秒；
+    - 排队的报警超过 max_queue 条时，新的报警被丢弃并记录日志，避免报警服务长时间不可用时占满内存；
+    - shutdown 时发送完剩余的报警再退出。exit_event 被设置（程序被中断）时最多再等待 drain_timeout 秒，
+      之后仍未发送的报警被放弃。
+    """
+
+    def __init__(self, pool=None, workers=2, max_retries=3, backoff=2.0, max_queue=10000,
+                 exit_event=None, drain_timeout=10, http_workers=8):
+        self.pool = pool or SMTPPool()
+        self.exit_event = exit_event
+        self.drain_timeout = drain_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_queue = max_queue
+        self._queue = Queue.Queue()
+        # 超过最长等待时间后设置，正在退避的重试立即放弃
+        self._abort = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._work, name='alarm-dispatcher-{}'.format(i)) for i in range(workers)]
+        for t in self._threads:
+            t.daemon = True
+        self._http = concurrent.futures.ThreadPoolExecutor(max_workers=http_workers)
+        # 尚未完成的 webhook 类报警
+        self._posts = set()
+        # 渠道名称 -> 渠道对象，同一渠道的请求共享 HTTP 会话
+        self._sinks = {}
+        self.nsent = 0
+        self.nfailed = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        prune_attachments()
+        for t in self._threads:
+            t.start()
+        return self
+
+    def submit(self, to_users, msg):
+        """提交一条邮件报警，立即返回"""
+        self._put(self._send, (to_users, msg), to_users)
+
+    def _put(self, send, args, to_users):
+        """把邮件报警放入队列，由后台线程调用 send(*args) 发送"""
+        if not to_users:
+            logger.warning('no recipients, alarm dropped.')
+            return
+        if self._queue.qsize() >= self.max_queue:
+            logger.error('alarm queue is full, dropped alarm to {}'.format(to_users))
+            return
+        self._queue.put((send, args, to_users))
+
+    def _get_sink(self, channel):
+        with self._lock:
+            if channel not in self._sinks:
+                self._sinks[channel] = ALARM_SINKS[channel]()
+            return self._sinks[channel]
+
+    def post(self, channel, urls, text, job=None):
+        """向 webhook 类渠道 channel 的各个地址并发发送文本报警，立即返回。job 为空时为报警摘要"""
+        sink = self._get_sink(channel)
+        payload = sink.payload(text, job)
+        for url in urls:
+            with self._lock:
+                if len(self._posts) >= self.max_queue:
+                    logger.error('alarm queue is full, dropped alarm to {}'.format(url))
+                    continue
+                future = self._http.submit(self._run, sink.send, (url, payload), url)
+                self._posts.add(future)
+            future.add_done_callback(self._on_posted)
+
+    def _on_posted(self, future):
+        with self._lock:
+            self._posts.discard(future)
+
+    def send_alarm(self, job, info):
+        """按作业的 alarm_channels 选项发送报警"""
+        for channel in job.get('alarm_channels', ['email']):
+            if channel == 'email':
+                # 邮件正文和附件在后台线程中生成，不占用调度线程
+                self._put(self._send_rendered, (job, info, []), job['alarm_email'])
+            else:
+                self.post(channel, job['alarm_' + channel], format_text(job, info), job)
+
+    def _send(self, to_users, msg, attachments=()):
+        with self.pool.connection() as server:
+            send_email(to_users, msg, server, attachments)
+
+    def _send_rendered(self, job, info, rendered):
+        """生成并发送作业的报警邮件，rendered 保存生成的邮件，重试时不必重新生成"""
+        if not rendered:
+            rendered.append(render_email(job, info))
+        msg, attachments = rendered[0]
+        self._send(job['alarm_email'], msg, attachments)
+
+    def _deliver(self, send, args, target):
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                # 退避等待，超过最长等待时间后立即放弃
+                if self._abort.wait(self.backoff * 2 ** (attempt - 1)):
+                    break
+            try:
+                send(*args)
+                return True
+            except (smtplib.SMTPException, IOError) as e:
+                # socket.error 和 requests 的异常都是 IOError 的子类
+                if _is_permanent(e):
+                    logger.error('failed sending alarm to {}: {}'.format(target, e))
+                    return False
+                logger.warning('failed sending alarm to {} (attempt {}/{}): {}'.format(
+                    target, attempt + 1, self.max_retries + 1, e))
+        logger.error('gave up sending alarm to {}'.format(target))
+        return False
+
+    def _run(self, send, args, target):
+        """发送一条报警并计数"""
+        try:
+            with metrics.timer('alarm_send'):
+                ok = self._deliver(send, args, target)
+        except Exception:
+            logger.exception('unexpected error sending alarm to {}'.format(target))
+            ok = False
+        metrics.inc('data_monitor_alarms_total', result='sent' if ok else 'failed')
+        with self._lock:
+            if ok:
+                self.nsent += 1
+            else:
+                self.nfailed += 1
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._run(*item)
+            finally:
+                self._queue.task_done()
+
+    def _drain(self, is_done, wait, deadline):
+        """分段等待直到 is_done() 为真，以便及时响应中断信号。返回新的最长等待时刻（可能为空），超时时返回 False"""
+        while not is_done():
+            if deadline is None and self.exit_event is not None and self.exit_event.is_set():
+                deadline = time.time() + self.drain_timeout
+            if deadline is not None and time.time() >= deadline:
+                return False
+            wait(0.5)
+        return deadline
+
+    def shutdown(self):
+        """发送完剩余的报警后停止后台线程"""
+        # 每个线程取到一个 None 后退出，None 排在剩余报警之后，因此报警会先被发送
+        for _ in self._threads:
+            self._queue.put(None)
+        deadline = None
+        for t in self._threads:
+            deadline = self._drain(lambda: not t.is_alive(), t.join, deadline)
+            if deadline is False:
+                break
+        if deadline is not False:
+            with self._lock:
+                posts = list(self._posts)
+            deadline = self._drain(
+                lambda: all(f.done() for f in posts),
+                lambda timeout: concurrent.futures.wait(posts, timeout=timeout), deadline)
+
+        if deadline is False:
+            self._abort.set()
+            logger.error('alarm dispatcher shutdown timed out, remaining alarms are abandoned.')
+        self._http.shutdown(wait=False)
+        self.pool.close()
+        logger.info('alarm dispatcher stopped. sent: {}, failed: {}.'.format(self.nsent, self.nfailed))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+        return False
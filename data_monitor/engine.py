@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+"""
+@Author:      zhuhe212
+@Email:       zhuhe212@163.com
+@Description: 作业执行引擎。引擎接收作业并返回一个 Future，调度器通过 Future 的完成回调回收结果。
+@CreateAt:    2026-10-18
+"""
+
+
+import concurrent.futures
+import threading
+
+from .db import close_results, get_max_concurrency
+from .util import set_future_exception
+
+
+def _transfer(source, target):
+    """把已完成的 source 的结果转交给 target"""
+    try:
+        result = source.result()
+    except Exception:
+        set_future_exception(target)
+    else:
+        target.set_result(result)
+
+
+class ThreadEngine(object):
+    """线程池引擎（默认）。每个作业在线程池中占用一个线程，依次执行所有查询和校验表达式。"""
+
+    def __init__(self, run, max_workers=16):
+        self._run = run
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, job):
+        return self._executor.submit(self._run, job)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+        return False
+
+
+class AsyncEngine(object):
+    """异步引擎。作业被拆分为查询和校验两个阶段，通过 Future 回调串联：
+    - 每条查询提交到其数据库专属的执行器，执行器的并发数由该数据库的 max_concurrency 决定，
+      因此慢数据库上的查询只会在自己的队列中排队，不会占满其他数据库的执行资源；
+    - 作业的所有查询完成后，校验表达式提交到独立的校验线程池执行；
+    - 等待中的作业只是一个未完成的 Future，不占用任何线程，在途作业数量不受线程数限制。
+    pushdown 不为空时，开启了下推的作业先作为一个整体提交到其数据库的执行器，
+    pushdown(job) 返回 None（无法下推）时再按上述方式执行。
+    """
+
+    def __init__(self, fetch, validate, max_workers=16, pushdown=None):
+        self._fetch = fetch
+        self._validate = validate
+        self._pushdown = pushdown
+        self._validators = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._executors = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self, db_conf):
+        """获取数据库专属的查询执行器"""
+        name = db_conf['_name']
+        with self._lock:
+            if name not in self._executors:
+                self._executors[name] = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=get_max_concurrency(db_conf))
+            return self._executors[name]
+
+    def submit(self, job):
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+
+        if self._pushdown is None or not job.get('pushdown'):
+            self._submit_queries(job, future)
+            return future
+
+        def on_pushdown_done(f):
+            if f.exception() is None and f.result() is None:
+                self._submit_queries(job, future)
+            else:
+                _transfer(f, future)
+
+        self._get_executor(job['db_conf'][0]).submit(self._pushdown, job).add_done_callback(on_pushdown_done)
+        return future
+
+    def _submit_queries(self, job, future):
+        """分别提交作业的各条查询，全部完成后提交校验表达式，结果转交给 future"""
+        queries = [
+            self._get_executor(db_conf).submit(self._fetch, job, db_conf, sql)
+            for db_conf, sql in zip(job['db_conf'], job['sql'])]
+        remaining = [len(queries)]
+        lock = threading.Lock()
+
+        def on_query_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            try:
+                results = [q.result() for q in queries]
+            except Exception:
+                set_future_exception(future)
+                # 归还成功的流式查询占用的连接
+                close_results(q.result() for q in queries if q.exception() is None)
+                return
+            validation = self._validators.submit(self._validate, job, results)
+            validation.add_done_callback(lambda f: _transfer(f, future))
+
+        for q in queries:
+            q.add_done_callback(on_query_done)
+
+    def shutdown(self, wait=True):
+        # 先等待查询完成，查询完成的回调可能还会提交校验任务
+        with self._lock:
+            executors = list(self._executors.values())
+        for executor in executors:
+            executor.shutdown(wait)
+        self._validators.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+        return False
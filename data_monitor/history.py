@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""
+@Author:      zhuhe212
+@Email:       zhuhe212@163.com
+@Description: 作业执行历史。每次执行的耗时、读取的行数和字节数保存在本地的 sqlite 文件中，
+              跨越多次运行保留，用于估计作业的耗时，使调度器在分发时考虑作业的开销。
+@CreateAt:    2026-10-18
+"""
+
+
+from collections import deque
+import datetime
+import logging
+import sqlite3
+
+
+logger = logging.getLogger(__name__)
+
+# 执行历史的默认文件
+HISTORY_FILE = '.data_monitor.history'
+# 估计耗时时使用的最近执行次数
+HISTORY_RUNS = 10
+# 执行记录的保留天数
+HISTORY_KEEP_DAYS = 30
+
+
+def _job_key(job):
+    """同一作业配置的各次执行（如小时级作业的各个小时）共享执行历史"""
+    return job.get('_section', job['_name'])
+
+
+def _median(values):
+    values = sorted(values)
+    n = len(values)
+    return values[n // 2] if n % 2 else (values[n // 2 - 1] + values[n // 2]) / 2.0
+
+
+class HistoryStore(object):
+    """作业执行历史，仅由调度线程调用。
+    - record 记录一次执行，flush 时批量写入文件，调度线程每一轮只提交一次事务；
+    - estimate 返回作业最近 runs 次执行耗时的中位数（秒），没有历史时返回 None。
+      执行出错的记录不参与估计，例如 SQL 错误时作业很快失败，其耗时不代表正常执行的开销。
+      调度线程每一轮都会为暂缓的作业重新估计，因此估计值按作业配置缓存，记录新的执行时才重新计算；
+    - 打开时删除 keep_days 天之前的记录。
+    """
+
+    def __init__(self, path=HISTORY_FILE, runs=HISTORY_RUNS, keep_days=HISTORY_KEEP_DAYS):
+        self.path = path
+        self.runs = runs
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS runs ('
+            'job TEXT NOT NULL, name TEXT NOT NULL, due_time TEXT, finished_at TEXT NOT NULL, '
+            'duration REAL NOT NULL, nrows INTEGER, nbytes INTEGER, status TEXT NOT NULL, retry INTEGER)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS runs_finished_at ON runs (finished_at)')
+        expire = datetime.datetime.now() - datetime.timedelta(days=keep_days)
+        self._conn.execute('DELETE FROM runs WHERE finished_at < ?', (str(expire), ))
+        self._conn.commit()
+
+        # 作业配置名 -> 最近 runs 次执行的耗时
+        self._durations = {}
+        for key, duration in self._conn.execute(
+                "SELECT job, duration FROM runs WHERE status != 'error' ORDER BY finished_at"):
+            self._durations.setdefault(key, deque(maxlen=runs)).append(duration)
+        self._pending = []
+        # 作业配置名 -> 估计的耗时
+        self._estimates = {}
+
+    def __len__(self):
+        """有执行历史的作业配置数"""
+        return len(self._durations)
+
+    def record(self, job, duration, nrows, nbytes, status):
+        """记录作业的一次执行。status 为 ok、alarm 或 error"""
+        key = _job_key(job)
+        self._pending.append((
+            key, job['_name'], str(job['due_time']), str(datetime.datetime.now()), duration, nrows, nbytes,
+            status, int(bool(job.get('_is_retry')))))
+        if status != 'error':
+            self._durations.setdefault(key, deque(maxlen=self.runs)).append(duration)
+            self._estimates.pop(key, None)
+
+    def flush(self):
+        """把记录写入文件，写入失败时丢弃这些记录（执行历史只用于估计开销，不影响作业）"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        try:
+            self._conn.executemany('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', pending)
+            self._conn.commit()
+        except sqlite3.Error as e:
+            logger.error('failed writing {} run(s) to history file {}: {}'.format(len(pending), self.path, e))
+
+    def estimate(self, job):
+        """估计作业的耗时（秒），没有历史时返回 None"""
+        key = _job_key(job)
+        try:
+            return self._estimates[key]
+        except KeyError:
+            pass
+        durations = self._durations.get(key)
+        estimate = self._estimates[key] = _median(durations) if durations else None
+        return estimate
+
+    def close(self):
+        self.flush()
+        self._conn.close()
@@ -3,25 +3,33 @@
 """发起监控程序"""
 
 import argparse
-from collections import namedtuple
-import concurrent.futures
-from contextlib import closing
 import datetime
 import glob
 import logging
 import os
-import re
-import Queue
 import signal
+import sqlite3
 import threading
 import traceback
 
 import pandas as pd
 
-from .alarm import format_text, format_html, send_email
-from .config import get_job_conf_list
-from .context import get_validator_context
-from .db import get_connection
+from .alarm import format_text, parse_smtp_server
+from .batch import ScalarBatcher
+from .cache import QueryCache, is_cacheable, normalize_sql
+from .config import ConfigError, JobConfLoader, expand_job_conf
+from .context import compile_validator, get_base_validator_context
+from .db import (ResultTooLarge, close_results, count_results, get_max_concurrency, get_pool_stats, query,
+                 stream_query, warm_up)
+from .digest import AlarmDigester, fingerprint
+from .dispatcher import AlarmDispatcher, SMTPPool
+from .engine import AsyncEngine, ThreadEngine
+from .history import HISTORY_FILE, HistoryStore
+from .metrics import registry as metrics, serve as serve_metrics
+from .profiler import PROFILE_DIR, profiler
+from .process import ProcessPool
+from .pushdown import run_pushdown
+from .scheduler import ResourceLimiter, Scheduler
 from .util import AlarmInfo, ValidatorError
 
 
@@ -37,11 +45,44 @@ pd.set_option('display.width', 120)
 # 因此采用 threading.Event 取代 time.sleep，其好处是可以随时中断。
 exit_waiter = threading.Event()
 
+# 当前运行的调度器，收到退出信号时需要将其唤醒
+_scheduler = None
+
 def quit(signo, _frame):
     exit_waiter.set()
+    if _scheduler is not None:
+        _scheduler.wakeup()
     print("Interrupted by signal %d, exit." % signo)
 
 
+# 校验进程池，用于执行 CPU 密集的校验表达式
+validator_pool = ProcessPool()
+
+# 查询结果缓存，相同的查询在有效期内只执行一次
+query_cache = QueryCache()
+
+# 指标文件的写入间隔（秒）
+METRICS_INTERVAL = 15
+
+
+def eval_validator(validator, results):
+    """执行校验表达式并返回其结果。
+    校验表达式在载入配置时已经编译，此处只需取出代码对象，以共享的基础上下文为全局命名空间、
+    以 result 为局部命名空间执行。
+    """
+    try:
+        code = compile_validator(validator)
+    except Exception as e:
+        raise ValidatorError('your validator {!r} is invalid: \n{}'.format(validator, traceback.format_exc()))
+    try:
+        return eval(code, get_base_validator_context(), {'result': results})
+    except ResultTooLarge:
+        # 校验函数读取流式结果时超出上限，不是校验表达式本身的错误
+        raise
+    except Exception as e:
+        raise ValidatorError('your validator {!r} raised an exception: \n{}'.format(validator, traceback.format_exc()))
+
+
 def run_job(job):
     """执行一个作业。
     返回一个 2-tuple，两个字段分别代表：
@@ -49,46 +90,102 @@ def run_job(job):
         2. 附加消息对象，解释校验失败的原因，用于发送警报。
     """
 
+    # 开启了下推的作业先尝试在数据库中完成校验，无法下推时再按普通方式执行
+    if job.get('pushdown'):
+        status = pushdown_job(job)
+        if status is not None:
+            return status
+
     # 一个作业可能包含多个 SQL 查询
     results = []
-    for db_conf, sql in zip(job['db_conf'], job['sql']):
-
-        with closing(get_connection(db_conf)) as conn:
-            cursor = conn.cursor()
-            cursor.execute(sql)
-
-            # querys need to commit, except SELECT or SHOW query
-            if not (sql[:7].upper() == 'SELECT ' or sql[:5].upper() == 'SHOW '):
-                conn.commit()
-
-            res = cursor.fetchall()
-            # if result is only one element, then unpack it
-            if len(res) == 1 and len(res[0]) == 1:
-                res = res[0][0]
-
-            # else return a list of namedtuples
-            else:
-                col_names = [t[0] for t in cursor.description]
-                for i, name in enumerate(col_names):
-                    if not re.match(r'^[\w_]+$', name):
-                        col_names[i] = 'col' + str(i)
-                RowType = namedtuple('RowType', col_names)
-                res = [RowType(*tp) for tp in res]
+    try:
+        for db_conf, sql in zip(job['db_conf'], job['sql']):
+            results.append(fetch_result(job, db_conf, sql))
+    except Exception:
+        # 后面的查询失败时，归还前面的流式查询占用的连接
+        close_results(results)
+        raise
+    return validate_job(job, results)
+
+
+def fetch_result(job, db_conf, sql):
+    """执行作业中的一条查询。
+    同一数据库上相同的只读查询在缓存有效期内只执行一次，多个作业共享其结果；
+    重试的作业跳过缓存，以便看到最新的数据。
+    stream 作业返回流式结果，由校验函数分批读取。
+    编入批次的单值查询作业（见 batch 模块）从批次中取值，批次执行失败时单独查询。
+    """
+    with metrics.bind(job), profiler.bind(job), metrics.timer('query'), profiler.stage('query'):
+        return _fetch_result(job, db_conf, sql)
+
+
+def _fetch_result(job, db_conf, sql):
+    max_rows = job.get('max_result_rows')
+    max_bytes = job['max_result_mb'] * 1024 * 1024 if job.get('max_result_mb') else None
+    batch = job.get('_batch')
+    if batch is not None:
+        return batch.fetch(sql, lambda: query(db_conf, sql, max_rows, max_bytes))
+    if job.get('stream'):
+        return stream_query(db_conf, sql, max_rows=max_rows, max_bytes=max_bytes)
+    if not job.get('query_cache', True) or not is_cacheable(sql):
+        return query(db_conf, sql, max_rows, max_bytes)
+    key = (db_conf['_name'], db_conf.get('database'), normalize_sql(sql), max_rows, max_bytes)
+    return query_cache.get(
+        key, lambda: query(db_conf, sql, max_rows, max_bytes), refresh=job.get('_is_retry', False))
+
+
+def validate_job(job, results):
+    """对作业的查询结果执行校验表达式，返回值同 run_job"""
+    try:
+        with metrics.bind(job), profiler.bind(job):
+            return _validate_job(job, results)
+    finally:
+        # 校验表达式可能没有读完流式结果，需要关闭以归还连接
+        close_results(results)
+        job['_fetched'] = count_results(results)
 
-            results.append(res)
 
+def _validate_job(job, results):
     # if job has only one sql, then unpack the results as one result
     if len(results) == 1:
         results = results[0]
 
-    # 执行用户的校验表达式
-    context = get_validator_context()
-    context.update({'result': results})
-    try:
-        ret = eval(job['validator'], {'__builtins__': {}}, context)
-    except Exception as e:
-        raise ValidatorError('your validator {!r} raised an exception: \n{}'.format(job['validator'], traceback.format_exc()))
-
+    # 可能重试的作业记录查询结果的指纹。重试时查询结果与上一次相同，则沿用上一次的校验结果，不再执行校验表达式。
+    # 流式结果只能读取一次，不计算指纹
+    digest = None
+    if not job.get('stream') and (job.get('retry_times') or job.get('_is_retry')):
+        digest = fingerprint(results)
+        if job.get('_is_retry') and job.get('_result_digest') == digest:
+            logger.info('job [{}] query result unchanged since last attempt, validator skipped.'.format(job['_name']))
+            return job['_status']
+
+    # 执行用户的校验表达式，CPU 密集的校验表达式在独立子进程中执行
+    with metrics.timer('validate'), profiler.stage('validate'):
+        if job.get('validator_process'):
+            ret = validator_pool.run(
+                eval_validator, (job['validator'], results),
+                cpu_limit=job.get('validator_cpu_limit'), mem_limit=job.get('validator_mem_limit'),
+                timeout=job.get('validator_timeout'))
+        else:
+            ret = eval_validator(job['validator'], results)
+
+    status = _get_status(ret, results)
+    if digest is not None:
+        job['_result_digest'], job['_status'] = digest, status
+    return status
+
+
+def pushdown_job(job):
+    """以下推方式执行作业（见 pushdown 模块），返回值同 run_job。作业无法下推时返回 None"""
+    with metrics.bind(job), profiler.bind(job), metrics.timer('pushdown'), profiler.stage('pushdown'):
+        ret = run_pushdown(job)
+    if ret is None:
+        return None
+    return _get_status(ret, None)
+
+
+def _get_status(ret, results):
+    """把校验表达式的返回值转换为 run_job 的返回值"""
     try:
         # 如果用户 validator 中同时返回了 ok 和 info，则直接使用
         ok, info = ret
@@ -108,91 +205,350 @@ def run_job(job):
     return bool(ok), info
 
 
-def main(db_config_file, job_config_files, job_names, pool_size=16, poll_interval=5):
-    """主程序，处理作业排队、分发、重试逻辑。
-    使用线程池以支持并行启动多个作业。
+def _enqueue(scheduler, job_conf, after=None):
+    """将作业配置当天的执行序列加入调度器，after 不为空时只加入到期时间晚于 after 的执行。
+    执行序列是惰性的，每次只有最近的一次执行在队列中。
+    """
+    if scheduler.push_occurrences(expand_job_conf(job_conf, after=after)):
+        logger.info('job [{}] config OK.'.format(job_conf['_name']))
+
+
+def _job_resources(job, estimate=None, heavy_job_seconds=None):
+    """作业在分发时占用的资源，用于并发控制（见 scheduler.ResourceLimiter），返回 ({资源: 上限}, {资源: 开销})：
+    - 每个数据库上同时运行的作业数不超过其 max_concurrency；
+    - 预计耗时（estimate，秒）不少于 heavy_job_seconds 的重型作业最多占用每个数据库一半的并发名额，
+      同时到期的大量重型作业分批错开运行，并为其他作业留出名额；
+    - 配置了 max_cost 的数据库，其上运行中作业的预计耗时之和不超过 max_cost 秒。
     """
+    limits, costs = {}, {}
+    heavy = estimate is not None and heavy_job_seconds and estimate >= heavy_job_seconds
+    for db_conf in job['db_conf']:
+        name = db_conf['_name']
+        limits[name] = get_max_concurrency(db_conf)
+        if heavy:
+            limits[('heavy', name)] = max(limits[name] // 2, 1)
+        if estimate and db_conf.get('max_cost'):
+            limits[('cost', name)] = db_conf['max_cost']
+            costs[('cost', name)] = estimate
+    return limits, costs
+
+
+def _warm_up_pools(job_confs):
+    """为配置了 warm_up 的数据库预先创建连接池"""
+    warmed = set()
+    for job_conf in job_confs.values():
+        for db_conf in job_conf['db_conf']:
+            key = (db_conf['_name'], db_conf.get('database'))
+            if not db_conf.get('warm_up') or key in warmed:
+                continue
+            warmed.add(key)
+            try:
+                warm_up(db_conf)
+                logger.info('connection pool of database [{}] warmed up.'.format(db_conf['_name']))
+            except Exception as e:
+                logger.error('failed warming up connection pool of database [{}]: {}'.format(db_conf['_name'], e))
+
 
-    # 任务队列，使用优先队列，优先级为作业到期时间
-    task_queue = Queue.PriorityQueue()
+def _log_pool_stats():
+    for (name, database), stats in sorted(get_pool_stats().items()):
+        logger.info(
+            'connection pool [{}] (database: {}): size {size}, in use {in_use}, checkouts {checkouts}, '
+            'wait time avg {wait_time_avg:.3f}s, max {wait_time_max:.3f}s'.format(name, database, **stats))
+
+
+def _collect_pool_metrics(registry):
+    for (name, database), stats in get_pool_stats().items():
+        registry.set('data_monitor_pool_connections_in_use', stats['in_use'], db=name, database=database)
+
+
+def _write_metrics(metrics_file):
+    try:
+        metrics.write(metrics_file)
+    except (IOError, OSError) as e:
+        logger.error('failed writing metrics file {}: {}'.format(metrics_file, e))
+
+
+def _send_config_alarms(dispatcher, loader):
+    """把载入配置时产生的配置错误报警交给报警分发器，在后台发送，不阻塞作业的分发"""
+    alarms = loader.pop_config_alarms()
+    if alarms:
+        logger.info('sending {} config error alarm(s) in background ...'.format(len(alarms)))
+    for to_users, msg in alarms:
+        dispatcher.submit(to_users, msg)
+
+
+def main(db_config_file, job_config_files, job_names, pool_size=16, daemon=False, reload_interval=60, engine='thread',
+         query_cache_ttl=60, manifest_file=None, smtp_server=None, alarm_window=3600, alarm_digest_interval=3600,
+         metrics_file=None, metrics_port=None, metrics_report=None, profile_jobs=(), profile_all=False,
+         profile_sampling=False, profile_dir=PROFILE_DIR, history_file=None, heavy_job_seconds=60):
+    """主程序，处理作业排队、分发、重试逻辑。
+    使用线程池以支持并行启动多个作业。engine 为 async 时使用异步引擎（见 engine.AsyncEngine），
+    查询按数据库分别排队，在途作业数只受各数据库的 max_concurrency 限制。
+    daemon 为真时程序常驻：每天零点重新渲染配置并加入新一天的作业；每隔 reload_interval 秒
+    检查一次配置文件，若有修改则只重新检查内容发生变化的作业。
+    query_cache_ttl 为查询结果缓存的有效期（秒），为 0 时不缓存。
+    manifest_file 为作业配置清单的缓存文件（见 config.JobConfLoader），为空时不缓存。
+    报警邮件由后台的报警分发器发送（见 dispatcher.AlarmDispatcher），smtp_server 为邮件服务器地址 HOST[:PORT]，
+    为空时使用默认的服务器。程序退出前会发送完剩余的报警。
+    同一作业在 alarm_window 秒内的相同报警只发送一次，重复的报警每隔 alarm_digest_interval 秒
+    按收件人汇总为摘要发送（见 digest.AlarmDigester）。
+    指定 metrics_file 或 metrics_port 时记录运行指标（见 metrics 模块），每隔 METRICS_INTERVAL 秒写入 metrics_file，
+    或通过 metrics_port 端口的 HTTP 端点 /metrics 提供；metrics_report 为每个作业各阶段耗时的 JSON 报告，在退出时写入。
+    profile_jobs 中的作业（profile_all 为真时为所有作业）按阶段剖析，结果输出到 profile_dir（见 profiler.JobProfiler），
+    profile_sampling 为真时使用开销较低的采样模式。
+    每次执行的耗时、读取的行数和字节数记录在执行历史 history_file 中（见 history.HistoryStore），为空时不记录。
+    分发时按历史估计作业的耗时：到期时间相同的作业中耗时长的先启动，重型作业错开运行，
+    并按数据库的 max_cost 限制运行中作业的预计耗时之和（见 _job_resources）。
+    """
+    global _scheduler
+
+    query_cache.ttl = query_cache_ttl
+
+    metrics.enabled = bool(metrics_file or metrics_port or metrics_report)
+    metrics.report = bool(metrics_report)
+    if metrics.enabled:
+        metrics.add_collector(_collect_pool_metrics)
+    if metrics_port:
+        serve_metrics(metrics, metrics_port)
+        logger.info('serving metrics on port {} ...'.format(metrics_port))
+    next_metrics_write = datetime.datetime.now()
+
+    profiler.configure(profile_jobs, all_jobs=profile_all, sampling=profile_sampling, output_dir=profile_dir)
+    if profiler.enabled:
+        logger.info('profiling {} job(s){}, output to {}'.format(
+            'all' if profile_all else len(profiler.job_names), ' by sampling' if profile_sampling else '', profile_dir))
+
+    # 执行历史不可用时不影响作业的执行，只是分发时不考虑作业的开销
+    history = None
+    if history_file:
+        try:
+            history = HistoryStore(history_file)
+            logger.info('using run history file: {} ({} job(s) with history)'.format(history_file, len(history)))
+        except sqlite3.Error as e:
+            logger.error('failed opening run history file {}: {}'.format(history_file, e))
+
+    def estimate(job):
+        return history.estimate(job) if history is not None else None
+
+    # 作业调度器，按作业到期时间排序，到期时间相同时预计耗时长的作业先出队
+    scheduler = Scheduler(exit_event=exit_waiter, priority=lambda job: estimate(job) or 0)
+    _scheduler = scheduler
 
     logger.info('using job config file(s): {}'.format(job_config_files))
     logger.info('checking job configs ...')
-    for job in get_job_conf_list(db_config_file, job_config_files, job_names):
-        logger.info('job [{}] config OK.'.format(job['_name']))
-        task_queue.put_nowait((job['due_time'], job))
-
-    # # debug ...
-    #     run_job(job)
-    # return
+    loader = JobConfLoader(db_config_file, job_config_files, job_names, manifest_file=manifest_file,
+                           defer_alarms=True)
+    job_confs, _ = loader.load()
+    for name in sorted(job_confs):
+        _enqueue(scheduler, job_confs[name])
+    _warm_up_pools(job_confs)
+    for name in sorted(profiler.job_names - set(job_confs)):
+        logger.warning('job [{}] to profile is not found or inactive.'.format(name))
+
+    # 已加入当天作业的配置名称，用于热加载时区分新增作业与修改的作业
+    day = datetime.date.today()
+    scheduled = set(job_confs)
+    reload_interval = datetime.timedelta(seconds=reload_interval)
+    next_reload = datetime.datetime.now() + reload_interval
 
     logger.info('all job configs OK.')
-    logger.info('monitor start ...')
+    logger.info('monitor start{} ...'.format(' in daemon mode' if daemon else ''))
     logger.info('=' * 60)
-    ntotal = task_queue.qsize()
+    ntotal = scheduler.npending
     ncompleted = 0
-    fs = {}
+    # 按数据库限制同时运行的作业数，超出 max_concurrency 的作业暂缓分发，不占用工作线程
+    limiter = ResourceLimiter()
+    # 同一轮分发中同一数据库上的单值查询合并执行，同一批次的作业共用一个并发名额
+    batcher = ScalarBatcher()
+
+    def admit(job):
+        if batcher.join(job):
+            return True
+        resources = _job_resources(job, estimate(job), heavy_job_seconds)
+        if not limiter.acquire(*resources):
+            return False
+        job['_resources'] = resources
+        batcher.open(job, resources)
+        return True
+
     logger.info('****** total jobs: {} ...'.format(ntotal))
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=pool_size) as executor:
-
-        # 主循环，退出条件为作业队列为空，且线程池中没有残留作业
-        while not task_queue.empty() or fs:
-            logger.info('****** pending: {}, running: {}, completed: {} ******'.format(task_queue.qsize(), len(fs), ncompleted))
-
-            # 如果任务队列非空，则轮询提取最近一个到期的作业，直到该作业到期
-            if not task_queue.empty():
-                due_time, job = task_queue.queue[0]
-                now = datetime.datetime.now()
-                if now >= due_time:
-                    _, job = task_queue.get()
-                    future = executor.submit(run_job, job)
-                    fs[future] = job
-                    logger.info('job [{}] is due. launched.'.format(job['_name']))
-                else:
-                    sleep_time = poll_interval
-                    if len(fs) == 0:
-                        sleep_time = (due_time - now).total_seconds()
-                        logger.info('sleeping until the most recent job [{}] due at ({}) ...'.format(job['_name'], due_time))
-                    exit_waiter.wait(sleep_time)
-                    if exit_waiter.is_set():
-                        break
-
-            # 收集并处理执行完成的 job
-            try:
-                for future in concurrent.futures.as_completed(fs, timeout=poll_interval if task_queue.empty() else 0.001):
-                    ncompleted += 1
-                    job = fs.pop(future)
-                    try:
-                        ok, info_obj = future.result()
-                    except Exception as e:
-                        logger.error('job [{}] raised an exception:'.format(job['_name']))
-                        logger.exception(e)
-                        ok = False
-                        info_obj = AlarmInfo('exception', traceback.format_exc())
-
-                    # job 校验成功，打印日志，此 job 完成
-                    if ok:
-                        logger.info('job [{}] returned. status: OK.'.format(job['_name']))
-                        continue
-
-                    # job 校验失败，发送报警，尝试重试 job
+    if engine == 'async':
+        executor = AsyncEngine(fetch_result, validate_job, max_workers=pool_size, pushdown=pushdown_job)
+    else:
+        executor = ThreadEngine(run_job, max_workers=pool_size)
+
+    # 报警分发器，报警在后台线程中发送，调度线程不必等待邮件服务器
+    dispatcher = AlarmDispatcher(SMTPPool(*parse_smtp_server(smtp_server)) if smtp_server else None,
+                                 exit_event=exit_waiter)
+    digester = AlarmDigester(dispatcher, window=alarm_window, interval=alarm_digest_interval)
+
+    # 先退出 executor，等待运行中的作业完成，再退出 dispatcher，发送完剩余的报警
+    with dispatcher, executor:
+        _send_config_alarms(dispatcher, loader)
+
+        # 主循环，退出条件为作业队列为空，且线程池中没有残留作业（常驻模式下不退出）
+        while daemon or scheduler.npending or scheduler.nrunning:
+            logger.info('****** pending: {}, running: {}, completed: {} ******'.format(
+                scheduler.npending, scheduler.nrunning, ncompleted))
+
+            # 分发所有已到期的作业
+            due_jobs = scheduler.pop_due(admit=admit)
+            batcher.close_round()
+            now = datetime.datetime.now()
+            for job in due_jobs:
+                job['_launched_at'] = now
+                job.pop('_fetched', None)
+                if metrics.enabled:
+                    job.pop('_timings', None)
+                    metrics.observe('dispatch_delay', max((now - job['due_time']).total_seconds(), 0))
+                scheduler.track(executor.submit(job), job)
+                logger.info('job [{}] is due. launched.'.format(job['_name']))
+
+            if scheduler.nrunning == 0 and scheduler.npending:
+                due_time, job = scheduler.peek()
+                logger.info('sleeping until the most recent job [{}] due at ({}) ...'.format(job['_name'], due_time))
+
+            # 等待直到有作业完成或下一个作业到期。常驻模式下还需要在零点和配置检查时刻醒来，
+            # 有待发送的报警摘要时还需要在摘要发送时刻醒来
+            until = digester.deadline()
+            if daemon:
+                midnight = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time.min)
+                until = min(filter(None, (midnight, next_reload, until)))
+            completed = scheduler.wait(until=until)
+            if exit_waiter.is_set():
+                break
+
+            # 处理执行完成的 job
+            for future, job in completed:
+                ncompleted += 1
+                batch = job.get('_batch')
+                resources = batch.resources if batch is not None else job['_resources']
+                if batcher.release(job):
+                    limiter.release(*resources)
+                try:
+                    ok, info_obj = future.result()
+                except ResultTooLarge as e:
+                    logger.error('job [{}] failed: {}'.format(job['_name'], e))
+                    ok = False
+                    info_obj = AlarmInfo('exception', str(e))
+                except Exception as e:
+                    logger.error('job [{}] raised an exception:'.format(job['_name']))
+                    logger.exception(e)
+                    ok = False
+                    info_obj = AlarmInfo('exception', traceback.format_exc())
+
+                status = 'ok' if ok else 'error' if info_obj.type == 'exception' else 'alarm'
+                duration = (datetime.datetime.now() - job['_launched_at']).total_seconds()
+                if history is not None:
+                    nrows, nbytes = job.get('_fetched', (0, 0))
+                    history.record(job, duration, nrows, nbytes, status)
+                if metrics.enabled:
+                    metrics.observe('job', duration)
+                    metrics.inc('data_monitor_jobs_completed_total', status=status)
+                    metrics.record_job(job, status)
+                for path in profiler.dump(job):
+                    logger.info('profile of job [{}] written to {}'.format(job['_name'], path))
+
+                # job 校验成功，打印日志，此 job 完成
+                if ok:
+                    logger.info('job [{}] returned. status: OK.'.format(job['_name']))
+                    continue
+
+                # job 校验失败，发送报警，尝试重试 job。生成报警消息出错时只记录日志，不影响其他作业
+                try:
                     text_msg = format_text(job, info_obj)
                     indented_msg = '\t' + text_msg.replace('\n', '\n\t')
-                    logger.info('job [{}] returned. status: =====> ALARM <=====\n{}'.format(job['_name'], indented_msg))
-                    send_email(job['alarm_email'], format_html(job, info_obj))
-
-                    if job['retry_times'] > 0:
-                        job['retry_times'] -= 1
-                        logger.info('job [{}] retrying. times left: {}.'.format(job['_name'], job['retry_times']))
-                        task_queue.put_nowait((datetime.datetime.now() + job['retry_interval'], job))
-
-            except concurrent.futures.TimeoutError:
-                pass
-
-        logger.info('****** pending: {}, running: {}, completed: {} ******'.format(task_queue.qsize(), len(fs), ncompleted))
-        logger.info('=' * 60)
-        logger.info('monitor exit.')
+                    logger.info('job [{}] returned. status: =====> ALARM <=====\n{}'.format(
+                        job['_name'], indented_msg))
+                    digester.submit(job, info_obj)
+                except Exception:
+                    logger.exception('failed formatting or sending alarm of job [{}]'.format(job['_name']))
+
+                if job['retry_times'] > 0:
+                    job['retry_times'] -= 1
+                    job['_is_retry'] = True
+                    metrics.inc('data_monitor_retries_total')
+                    logger.info('job [{}] retrying. times left: {}.'.format(job['_name'], job['retry_times']))
+                    scheduler.push(datetime.datetime.now() + job['retry_interval'], job)
+
+            digester.flush()
+            if history is not None:
+                history.flush()
+
+            metrics.set('data_monitor_pending_jobs', scheduler.npending)
+            metrics.set('data_monitor_running_jobs', scheduler.nrunning)
+            if metrics_file and datetime.datetime.now() >= next_metrics_write:
+                _write_metrics(metrics_file)
+                next_metrics_write = datetime.datetime.now() + datetime.timedelta(seconds=METRICS_INTERVAL)
+
+            if not daemon:
+                continue
+
+            now = datetime.datetime.now()
+            # 跨天：重新渲染所有配置（BASETIME 已改变），加入新一天的作业
+            if now.date() != day:
+                day = now.date()
+                next_reload = now + reload_interval
+                scheduled = set()
+                _log_pool_stats()
+                logger.info('a new day {} begins, reloading job configs ...'.format(day))
+                try:
+                    job_confs, _ = loader.load()
+                except ConfigError as e:
+                    logger.error('failed reloading job configs: {}'.format(e))
+                    loader.add_reload_alarm(e)
+                    _send_config_alarms(dispatcher, loader)
+                    continue
+                for name in sorted(job_confs):
+                    _enqueue(scheduler, job_confs[name])
+                scheduled = set(job_confs)
+                _send_config_alarms(dispatcher, loader)
+
+            # 配置热加载：只重新检查内容变化的作业。修改过的作业仅加入尚未到期的部分，避免重复报警
+            elif now >= next_reload:
+                next_reload = now + reload_interval
+                if not loader.is_modified():
+                    continue
+                logger.info('job config file(s) modified, reloading ...')
+                try:
+                    job_confs, changed = loader.load()
+                except ConfigError as e:
+                    # 之前载入的作业仍留在队列中，按原配置执行
+                    logger.error('failed reloading job configs: {}'.format(e))
+                    loader.add_reload_alarm(e)
+                    _send_config_alarms(dispatcher, loader)
+                    continue
+                ndiscarded = scheduler.discard(lambda job: job['_section'] in changed)
+                logger.info('{} job config(s) changed, {} pending job(s) discarded.'.format(len(changed), ndiscarded))
+                for name in sorted(changed & set(job_confs)):
+                    _enqueue(scheduler, job_confs[name], after=now if name in scheduled else None)
+                scheduled = (scheduled - changed) | set(job_confs)
+                _send_config_alarms(dispatcher, loader)
+
+        # 退出前发送剩余的报警摘要
+        digester.flush(force=True)
+        logger.info('****** pending: {}, running: {}, completed: {} ******'.format(
+            scheduler.npending, scheduler.nrunning, ncompleted))
+        _log_pool_stats()
+
+    profiler.close()
+    if history is not None:
+        history.close()
+
+    # 报警分发器退出后再输出指标，包含最后发送的报警
+    metrics.set('data_monitor_pending_jobs', scheduler.npending)
+    metrics.set('data_monitor_running_jobs', scheduler.nrunning)
+    if metrics_file:
+        _write_metrics(metrics_file)
+    if metrics_report:
+        try:
+            metrics.write_report(metrics_report)
+            logger.info('metrics report written to {}'.format(metrics_report))
+        except (IOError, OSError) as e:
+            logger.error('failed writing metrics report {}: {}'.format(metrics_report, e))
+    logger.info('=' * 60)
+    logger.info('monitor exit.')
 
 
 def execute(default_db_config_file, default_job_config_file):
@@ -217,6 +573,67 @@ def execute(default_db_config_file, default_job_config_file):
     parser.add_argument(
         '--force', dest='force', action='store_true',
         help='force to run job(s) immediately, do not wait until due time of job.')
+    parser.add_argument(
+        '--engine', dest='engine', choices=('thread', 'async'), default='thread',
+        help='job execution engine. `thread` (default) runs each job in one worker thread; '
+            '`async` queues queries per database, bounded by `max_concurrency` in database config.')
+    parser.add_argument(
+        '--query-cache-ttl', dest='query_cache_ttl', type=int, default=60, metavar='SECONDS',
+        help='identical read-only queries on the same database within this many seconds are '
+            'executed only once and share the result. 0 to disable. default 60.')
+    parser.add_argument(
+        '--manifest-cache', dest='manifest_file', metavar='PATH',
+        help='file caching checked job configs, e.g. `.data_monitor.manifest`. when config files are unchanged '
+            'on the same day, jobs are loaded from it without parsing and checking again. the file is readable '
+            'only by the current user and ignored if owned by another user. disabled by default.')
+    parser.add_argument(
+        '--smtp-server', dest='smtp_server', metavar='HOST[:PORT]',
+        help='smtp server to send alarm emails through. default `smtp.163.com:25`.')
+    parser.add_argument(
+        '--alarm-window', dest='alarm_window', type=int, default=3600, metavar='SECONDS',
+        help='identical alarms (same job, type and content) within this many seconds are sent only once, '
+            'repeats are rolled up into per-recipient digests. 0 to disable. default 3600.')
+    parser.add_argument(
+        '--alarm-digest-interval', dest='alarm_digest_interval', type=int, default=3600, metavar='SECONDS',
+        help='interval of sending alarm digests. default 3600.')
+    parser.add_argument(
+        '--metrics-file', dest='metrics_file', metavar='PATH',
+        help='record stage timings and job counters, and write them to this file in prometheus text format '
+            '(e.g. for the textfile collector of node_exporter).')
+    parser.add_argument(
+        '--metrics-port', dest='metrics_port', type=int, metavar='PORT',
+        help='record stage timings and job counters, and serve them at http://HOST:PORT/metrics.')
+    parser.add_argument(
+        '--metrics-report', dest='metrics_report', metavar='PATH',
+        help='write a json report with stage timings of every job to this file on exit.')
+    parser.add_argument(
+        '--profile', dest='profile_jobs', action='append', default=[], metavar='JOB',
+        help='profile query, result fetching and validator of the job separately with cProfile, '
+            'and record memory allocations of each stage. you can profile multiple jobs by repeating this option.')
+    parser.add_argument(
+        '--profile-all', dest='profile_all', action='store_true',
+        help='profile all jobs.')
+    parser.add_argument(
+        '--profile-sampling', dest='profile_sampling', action='store_true',
+        help='profile by sampling call stacks periodically instead, cheap enough to keep on in production. '
+            'outputs folded stacks for flame graphs.')
+    parser.add_argument(
+        '--profile-dir', dest='profile_dir', default=PROFILE_DIR, metavar='PATH',
+        help='directory of profile outputs. default `profiles` under current path.')
+    parser.add_argument(
+        '--history-file', dest='history_file', metavar='PATH',
+        help='sqlite file recording duration, rows and bytes fetched of every job run. dispatching uses it to '
+            'start long jobs first, spread heavy jobs and cap estimated cost per database (`max_cost` in database '
+            'config). disabled by default; in daemon mode defaults to `.data_monitor.history` under current path. '
+            'empty string to disable.')
+    parser.add_argument(
+        '--heavy-job-seconds', dest='heavy_job_seconds', type=float, default=60, metavar='SECONDS',
+        help='jobs estimated to take at least this many seconds are heavy, and can take at most half of '
+            'the concurrency of a database. 0 to disable. default 60.')
+    parser.add_argument(
+        '--daemon', dest='daemon', action='store_true',
+        help='keep running as a daemon. jobs of the next day are scheduled at midnight, '
+            'and modified job configs are reloaded automatically.')
 
     args = parser.parse_args()
 
@@ -250,8 +667,18 @@ def execute(default_db_config_file, default_job_config_file):
             'you may annoy other users by sending a lot of alarm messages!')
 
 
+    # 执行历史只在常驻模式下默认开启，单次运行（如临时检查某个作业）不在当前目录下留下文件
+    history_file = args.history_file
+    if history_file is None and args.daemon:
+        history_file = HISTORY_FILE
+
     # 主程序开始前，绑定中断信号，使得程序可以随时中断。
     for sig in ('HUP', 'INT', 'QUIT', 'TERM'):
         signal.signal(getattr(signal, 'SIG' + sig), quit)
 
-    main(db_config_file, job_config_files, args.job_names)
+    main(db_config_file, job_config_files, args.job_names, daemon=args.daemon, engine=args.engine,
+         query_cache_ttl=args.query_cache_ttl, manifest_file=args.manifest_file, smtp_server=args.smtp_server,
+         alarm_window=args.alarm_window, alarm_digest_interval=args.alarm_digest_interval,
+         metrics_file=args.metrics_file, metrics_port=args.metrics_port, metrics_report=args.metrics_report,
+         profile_jobs=args.profile_jobs, profile_all=args.profile_all, profile_sampling=args.profile_sampling,
+         profile_dir=args.profile_dir, history_file=history_file, heavy_job_seconds=args.heavy_job_seconds)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+"""
+@Author:      zhuhe212
+@Email:       zhuhe212@163.com
+@Description: 运行指标。记录作业各阶段（等待连接、执行查询、读取结果、校验、发送报警等）的耗时，
+              以及排队作业数、运行中作业数、重试和报警次数等计数，
+              以 Prometheus 文本格式输出到文件或 HTTP 端点，并可在程序结束时输出每个作业的 JSON 报告。
+              未开启时所有记录操作都直接返回，几乎没有开销。
+@CreateAt:    2026-10-18
+"""
+
+
+import BaseHTTPServer
+import contextlib
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# 指标说明，输出 Prometheus 文本格式时使用
+METRIC_HELP = {
+    'data_monitor_stage_seconds': ('summary', 'time spent in each stage of jobs'),
+    'data_monitor_stage_seconds_max': ('gauge', 'max time spent in each stage of jobs'),
+    'data_monitor_jobs_completed_total': ('counter', 'completed jobs by status'),
+    'data_monitor_retries_total': ('counter', 'retried jobs'),
+    'data_monitor_alarms_total': ('counter', 'alarms by result'),
+    'data_monitor_pending_jobs': ('gauge', 'jobs waiting in the scheduler queue'),
+    'data_monitor_running_jobs': ('gauge', 'jobs currently running'),
+    'data_monitor_pool_connections_in_use': ('gauge', 'database connections checked out'),
+}
+
+
+class _NullTimer(object):
+    """未开启指标时使用的计时器，什么也不做"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class _Timer(object):
+
+    __slots__ = ('_registry', '_stage', '_labels', '_start')
+
+    def __init__(self, registry, stage, labels):
+        self._registry = registry
+        self._stage = stage
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._registry.observe(self._stage, time.time() - self._start, **self._labels)
+        return False
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+class MetricsRegistry(object):
+    """指标注册表，线程安全。enabled 为假时所有记录操作直接返回。
+    耗时按 (阶段, 标签) 汇总为次数、总和与最大值；绑定了作业的线程中记录的耗时还会累加到作业的 _timings 中，
+    report 为真时每个完成的作业生成一条记录，用于输出 JSON 报告。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.report = False
+        self._lock = threading.Lock()
+        # (指标名称, 标签) -> 值，标签为排好序的 (名称, 值) 元组
+        self._counters = {}
+        self._gauges = {}
+        # (阶段, 标签) -> [次数, 总和, 最大值]
+        self._stages = {}
+        self._jobs = []
+        # 在输出指标前调用，用于采集连接池等状态
+        self._collectors = []
+        self._local = threading.local()
+        self.started_at = datetime.datetime.now()
+
+    def timer(self, stage, **labels):
+        """阶段计时器，用法：with registry.timer('execute', db=name): ..."""
+        if not self.enabled:
+            return _null_timer
+        return _Timer(self, stage, labels)
+
+    def observe(self, stage, seconds, **labels):
+        """记录一次阶段耗时"""
+        if not self.enabled:
+            return
+        key = (stage, tuple(sorted(labels.items())))
+        job = getattr(self._local, 'job', None)
+        with self._lock:
+            entry = self._stages.get(key)
+            if entry is None:
+                entry = self._stages[key] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+            if job is not None:
+                timings = job.setdefault('_timings', {})
+                timings[stage] = timings.get(stage, 0.0) + seconds
+
+    def inc(self, name, value=1, **labels):
+        """计数器加 value"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """设置仪表的值"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    @contextlib.contextmanager
+    def bind(self, job):
+        """在当前线程中绑定作业，期间记录的阶段耗时累加到作业的 _timings 中。可以嵌套"""
+        if not self.enabled:
+            yield
+            return
+        previous = getattr(self._local, 'job', None)
+        self._local.job = job
+        try:
+            yield
+        finally:
+            self._local.job = previous
+
+    def record_job(self, job, status):
+        """作业完成时调用，report 为真时记录作业的各阶段耗时"""
+        if not self.report:
+            return
+        with self._lock:
+            self._jobs.append({
+                'job': job['_name'],
+                'section': job.get('_section', job['_name']),
+                'due_time': str(job['due_time']),
+                'launched_at': str(job.get('_launched_at')),
+                'finished_at': str(datetime.datetime.now()),
+                'status': status,
+                'retry': bool(job.get('_is_retry')),
+                'timings': dict(job.get('_timings', {})),
+            })
+
+    def add_collector(self, collector):
+        """注册采集函数，输出指标前调用"""
+        self._collectors.append(collector)
+
+    def render(self):
+        """以 Prometheus 文本格式输出所有指标"""
+        for collector in self._collectors:
+            try:
+                collector(self)
+            except Exception as e:
+                logger.warning('metrics collector failed: {}'.format(e))
+
+        with self._lock:
+            samples = {}
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append(('', labels, value))
+            for (name, labels), value in self._gauges.items():
+                samples.setdefault(name, []).append(('', labels, value))
+            for (stage, labels), (count, total, max_) in self._stages.items():
+                labels = (('stage', stage), ) + labels
+                samples.setdefault('data_monitor_stage_seconds', []).extend(
+                    [('_count', labels, count), ('_sum', labels, total)])
+                samples.setdefault('data_monitor_stage_seconds_max', []).append(('', labels, max_))
+
+        lines = []
+        for name in sorted(samples):
+            type_, help_ = METRIC_HELP.get(name, ('untyped', name))
+            lines.append('# HELP {} {}'.format(name, help_))
+            lines.append('# TYPE {} {}'.format(name, type_))
+            for suffix, labels, value in sorted(samples[name]):
+                lines.append('{}{}{} {}'.format(name, suffix, _format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """把指标写入文件（可用于 node_exporter 的 textfile 采集）。先写临时文件再重命名，避免读到不完整的内容"""
+        tmp_file = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_file, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp_file, path)
+
+    def write_report(self, path):
+        """输出本次运行的 JSON 报告：各阶段耗时汇总和每个作业的记录"""
+        with self._lock:
+            stages = [
+                dict(labels, stage=stage, count=count, sum=total, max=max_)
+                for (stage, labels), (count, total, max_) in sorted(self._stages.items())]
+            counters = [dict(labels, name=name, value=value) for (name, labels), value in sorted(self._counters.items())]
+            jobs = list(self._jobs)
+        report = {
+            'started_at': str(self.started_at),
+            'finished_at': str(datetime.datetime.now()),
+            'stages': stages,
+            'counters': counters,
+            'jobs': jobs,
+        }
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(registry, port, host=''):
+    """在后台线程中启动 HTTP 端点 /metrics，返回 HTTPServer"""
+    server = BaseHTTPServer.HTTPServer((host, port), _MetricsHandler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+# 全局的指标注册表
+registry = MetricsRegistry()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+"""
+@Author:      zhuhe212
+@Email:       zhuhe212@163.com
+@Description: 校验进程池。在独立子进程中执行 CPU 密集的校验表达式（如 claim、diff），
+              避免其长时间占用 GIL 拖慢其他作业的查询线程，并可对单个校验设置 CPU 和内存上限。
+@CreateAt:    2026-10-18
+"""
+
+
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import traceback
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from .util import ValidatorError
+
+
+# 校验子进程的默认运行时间上限（秒）。设置了 CPU 上限时，默认上限为 CPU 上限的 TIMEOUT_CPU_FACTOR 倍再加 TIMEOUT_GRACE 秒
+VALIDATOR_TIMEOUT = 600
+TIMEOUT_CPU_FACTOR = 2
+TIMEOUT_GRACE = 10
+
+
+def _get_vm_size():
+    """获取当前进程的虚拟内存大小（字节），无法获取时返回 None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _child_main(conn, func, args, cpu_limit, mem_limit):
+    """子进程入口：设置资源上限后执行 func，并把结果或异常堆栈发回父进程"""
+    if resource is not None:
+        if cpu_limit:
+            # 超过软限制时内核发送 SIGXCPU 终止进程
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 1))
+        if mem_limit:
+            # 子进程继承了父进程的地址空间，因此上限在当前大小的基础上增加
+            vm_size = _get_vm_size()
+            if vm_size is not None:
+                limit = vm_size + mem_limit * 1024 * 1024
+                resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    try:
+        message = ('ok', func(*args))
+    except BaseException:
+        message = ('error', traceback.format_exc())
+    try:
+        conn.send(message)
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+    conn.close()
+
+
+class ProcessPool(object):
+    """校验进程池，限制同时运行的校验子进程数量。
+    每次校验 fork 一个子进程执行：子进程直接继承父进程内存中的查询结果，无需序列化传输，
+    只有校验结果（通常是少量不合格的数据）通过管道传回。
+    校验超出 CPU 或内存上限时只有子进程被杀死，主程序不受影响。
+    子进程还有运行时间上限：从多线程的父进程 fork 出的子进程可能死锁在 fork 时被其他线程持有的锁上，
+    或者一直在等待 I/O，这些情况下不消耗 CPU，CPU 上限不会触发，超时后由父进程杀死子进程。
+    """
+
+    def __init__(self, max_processes=None, timeout=VALIDATOR_TIMEOUT):
+        self._slots = threading.BoundedSemaphore(max_processes or multiprocessing.cpu_count())
+        self.timeout = timeout
+
+    def _get_timeout(self, timeout, cpu_limit):
+        if timeout:
+            return timeout
+        if cpu_limit:
+            return cpu_limit * TIMEOUT_CPU_FACTOR + TIMEOUT_GRACE
+        return self.timeout
+
+    def run(self, func, args=(), cpu_limit=None, mem_limit=None, timeout=None):
+        """在子进程中执行 func(*args) 并返回其结果。
+        cpu_limit 为 CPU 时间上限（秒），mem_limit 为新增内存上限（MB），为空表示不限制。
+        timeout 为运行时间上限（秒），为空时根据 cpu_limit 或默认值确定。
+        子进程抛出异常、被杀死或超时时抛出 ValidatorError。
+        """
+        timeout = self._get_timeout(timeout, cpu_limit)
+        with self._slots:
+            reader, writer = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(
+                target=_child_main, args=(writer, func, args, cpu_limit, mem_limit))
+            process.daemon = True
+            process.start()
+            writer.close()
+            try:
+                if not self._poll(reader, process, timeout):
+                    os.kill(process.pid, signal.SIGKILL)
+                    process.join()
+                    raise ValidatorError(
+                        'validator process timed out after {}s and was killed'.format(timeout))
+                status, payload = reader.recv()
+            except EOFError:
+                process.join()
+                raise ValidatorError(
+                    'validator process was killed (exit code {}), it may have exceeded '
+                    'the cpu limit ({}) or memory limit ({})'.format(
+                        process.exitcode,
+                        '{}s'.format(cpu_limit) if cpu_limit else 'unlimited',
+                        '{}MB'.format(mem_limit) if mem_limit else 'unlimited'))
+            finally:
+                reader.close()
+            process.join()
+
+        if status == 'error':
+            raise ValidatorError(payload)
+        return payload
+
+    def _poll(self, reader, process, timeout):
+        """等待子进程发回结果或退出，超时时返回 False。
+        分段等待，子进程被内核杀死（管道关闭）时 poll 立即返回，随后 recv 抛出 EOFError
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if reader.poll(min(remaining, 1)):
+                return True
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+"""
+@Author:      zhuhe212
+@Email:       zhuhe212@163.com
+@Description: 作业剖析。对指定的作业按阶段（执行查询、读取结果、校验）分别剖析，用于在线排查变慢或内存暴涨的作业：
+              - 默认模式：每个阶段使用 cProfile 统计函数耗时，输出 .pstats 文件；同时统计阶段内的内存分配，
+                有 tracemalloc 时（Python 3）输出分配最多的代码行，否则输出新增最多的对象类型和进程的峰值内存；
+              - 采样模式：后台线程定时采集被剖析线程的调用栈，按作业汇总为折叠栈（可直接生成火焰图），
+                开销只与采样频率有关，可以在生产环境中常开。
+@CreateAt:    2026-10-18
+"""
+
+
+from collections import Counter
+import contextlib
+import cProfile
+import datetime
+import gc
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+logger = logging.getLogger(__name__)
+
+# 剖析结果的默认输出目录
+PROFILE_DIR = 'profiles'
+# 内存报告中每个阶段列出的条目数
+TOP_ALLOCATIONS = 20
+# tracemalloc 记录的调用栈深度
+TRACE_FRAMES = 1
+# 采样间隔（秒）
+SAMPLE_INTERVAL = 0.01
+# 采样时最多记录的栈深度（从最内层算起）
+MAX_STACK_DEPTH = 64
+
+
+class _NullStage(object):
+    """不剖析时使用的阶段，什么也不做"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+def _safe_name(name):
+    """作业名称转换为可以用作文件名的字符串"""
+    return re.sub(r'[^\w.-]', '_', name)
+
+
+def _memory_snapshot():
+    if tracemalloc is not None:
+        return tracemalloc.take_snapshot()
+    return Counter(type(o).__name__ for o in gc.get_objects())
+
+
+def _memory_report(before):
+    """阶段内的内存分配，返回文本行"""
+    if tracemalloc is not None:
+        diff = tracemalloc.take_snapshot().compare_to(before, 'lineno')
+        return [str(stat) for stat in diff[:TOP_ALLOCATIONS]]
+
+    # 没有 tracemalloc 时，统计 gc 跟踪的（容器）对象数量的变化
+    after = Counter(type(o).__name__ for o in gc.get_objects())
+    after.subtract(before)
+    lines = ['{}: {:+d} objects'.format(name, count) for name, count in after.most_common(TOP_ALLOCATIONS) if count]
+    if resource is not None:
+        lines.append('process max rss: {} KB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    return lines
+
+
+class _ProfiledStage(object):
+    """以 cProfile 剖析一个阶段，并统计阶段内的内存分配。
+    同一线程中同时只能有一个 cProfile 在运行，嵌套的阶段开始时暂停外层的剖析，结束后恢复，
+    因此外层阶段的统计不包含内层阶段。
+    """
+
+    def __init__(self, profiler, job, stage):
+        self._profiler = profiler
+        self._job = job
+        self._stage = stage
+
+    def __enter__(self):
+        stack = self._profiler._profile_stack()
+        if stack:
+            stack[-1].disable()
+        self._profile = cProfile.Profile()
+        self._memory = _memory_snapshot()
+        stack.append(self._profile)
+        self._profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._profile.disable()
+        stack = self._profiler._profile_stack()
+        stack.pop()
+        memory = _memory_report(self._memory)
+        self._profiler._add(self._job, self._stage, self._profile, memory)
+        if stack:
+            stack[-1].enable()
+        return False
+
+
+class StackSampler(object):
+    """调用栈采样器。后台线程每隔 interval 秒采集一次处于剖析阶段中的线程的调用栈，
+    按 (作业配置名, 折叠栈) 计数。折叠栈的格式为 “阶段;外层函数;...;内层函数”。
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        # 线程 ID -> (作业配置名, 阶段)
+        self._active = {}
+        # 作业配置名 -> Counter(折叠栈 -> 采样数)
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    @contextlib.contextmanager
+    def stage(self, key, stage):
+        ident = threading.current_thread().ident
+        previous = self._active.get(ident)
+        self._active[ident] = (key, stage)
+        try:
+            yield
+        finally:
+            if previous is None:
+                self._active.pop(ident, None)
+            else:
+                self._active[ident] = previous
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()
+            samples = []
+            for ident, (key, stage) in list(self._active.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    samples.append((key, _fold(stage, frame)))
+            del frames
+            if samples:
+                with self._lock:
+                    for key, stack in samples:
+                        self._counts.setdefault(key, Counter())[stack] += 1
+
+    def counts(self, key):
+        with self._lock:
+            return Counter(self._counts.get(key, ()))
+
+
+def _fold(stage, frame):
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    names.append(stage)
+    return ';'.join(reversed(names))
+
+
+class JobProfiler(object):
+    """作业剖析器。job_names 中的作业（或 all_jobs 为真时的所有作业）在各阶段被剖析，结果输出到 output_dir：
+    - 默认模式下每次执行输出 <作业名称>.<时间>.<阶段>.pstats 和 <作业名称>.<时间>.mem.txt。
+      tracemalloc 统计的是整个进程的内存分配，同时运行的其他作业的分配也会被计入；
+    - sampling 为真时使用采样模式，每个作业配置输出一个 <作业配置名>.folded，累计本次运行的所有采样，每次执行完成后更新。
+    剖析点通过 bind 绑定当前线程执行的作业，通过 stage 划分阶段。未开启时两者都直接返回。
+    在独立子进程中执行的校验表达式（validator_process）不在剖析范围内。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.job_names = set()
+        self.all_jobs = False
+        self.output_dir = PROFILE_DIR
+        self._sampler = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def configure(self, job_names=(), all_jobs=False, sampling=False, output_dir=PROFILE_DIR,
+                  interval=SAMPLE_INTERVAL):
+        self.job_names = set(job_names)
+        self.all_jobs = all_jobs
+        self.output_dir = output_dir
+        self.enabled = bool(self.job_names or all_jobs)
+        if not self.enabled:
+            return
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        if sampling:
+            self._sampler = StackSampler(interval).start()
+        elif tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+
+    def close(self):
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler = None
+
+    def wants(self, job):
+        return self.enabled and (self.all_jobs or job.get('_section', job['_name']) in self.job_names)
+
+    @contextlib.contextmanager
+    def bind(self, job):
+        """在当前线程中绑定作业，期间的阶段属于该作业。作业不需要剖析时什么也不做"""
+        if not self.wants(job):
+            yield
+            return
+        previous = getattr(self._local, 'job', None)
+        self._local.job = job
+        try:
+            yield
+        finally:
+            self._local.job = previous
+
+    def stage(self, stage):
+        """剖析当前线程所绑定作业的一个阶段，用法：with profiler.stage('validate'): ..."""
+        if not self.enabled:
+            return _null_stage
+        job = getattr(self._local, 'job', None)
+        if job is None:
+            return _null_stage
+        if self._sampler is not None:
+            return self._sampler.stage(job.get('_section', job['_name']), stage)
+        return _ProfiledStage(self, job, stage)
+
+    def _profile_stack(self):
+        stack = getattr(self._local, 'profiles', None)
+        if stack is None:
+            stack = self._local.profiles = []
+        return stack
+
+    def _add(self, job, stage, profile, memory):
+        # 异步引擎中同一作业的各阶段可能在不同线程中执行
+        with self._lock:
+            data = job.setdefault('_profile', {'stages': [], 'profiles': {}, 'memory': []})
+            if stage not in data['profiles']:
+                data['stages'].append(stage)
+            data['profiles'].setdefault(stage, []).append(profile)
+            data['memory'].append((stage, memory))
+
+    def dump(self, job):
+        """作业执行完成后调用，输出剖析结果，返回输出的文件路径"""
+        if not self.wants(job):
+            return []
+        try:
+            if self._sampler is not None:
+                return self._dump_samples(job.get('_section', job['_name']))
+            return self._dump_profiles(job)
+        except (IOError, OSError) as e:
+            logger.error('failed writing profile of job [{}]: {}'.format(job['_name'], e))
+            return []
+
+    def _dump_profiles(self, job):
+        with self._lock:
+            data = job.pop('_profile', None)
+        if not data:
+            return []
+        prefix = os.path.join(self.output_dir, '{}.{:%Y%m%d%H%M%S}'.format(
+            _safe_name(job['_name']), datetime.datetime.now()))
+        paths = []
+        for stage in data['stages']:
+            profiles = data['profiles'][stage]
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            path = '{}.{}.pstats'.format(prefix, stage)
+            stats.dump_stats(path)
+            paths.append(path)
+
+        path = prefix + '.mem.txt'
+        with open(path, 'w') as f:
+            f.write('memory allocations of job [{}] ({})\n'.format(
+                job['_name'], 'tracemalloc' if tracemalloc is not None else 'gc objects'))
+            for stage, lines in data['memory']:
+                f.write('\n[{}]\n'.format(stage))
+                for line in lines:
+                    f.write(line + '\n')
+        paths.append(path)
+        return paths
+
+    def _dump_samples(self, key):
+        counts = self._sampler.counts(key)
+        if not counts:
+            return []
+        path = os.path.join(self.output_dir, _safe_name(key) + '.folded')
+        tmp_file = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_file, 'w') as f:
+            for stack, count in sorted(counts.items()):
+                f.write('{} {}\n'.format(stack, count))
+        os.rename(tmp_file, path)
+        return [path]
+
+
+# 全局的作业剖析器
+profiler = JobProfiler()
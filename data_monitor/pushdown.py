@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+
+"""
+@Author:      zhuhe212
+@Email:       zhuhe212@163.com
+@Description: 校验下推。把简单的 claim、diff 校验改写为 SQL，在数据库中完成筛选，只取回不合格的行，
+              不必把整个查询结果读到监控程序中。
+@CreateAt:    2026-10-18
+"""
+
+
+import ast
+import datetime
+import decimal
+import inspect
+import logging
+import math
+import numbers
+import re
+import threading
+
+import pandas as pd
+
+from .context import compile_validator, get_base_validator_context
+from .db import ResultTooLarge, describe, normalize_col_names, query
+from .result import ResultSet, SampledFrame
+from .user.validators import PERIOD_UNITS, Predicate, claim, diff, _claim_result, _fill_gaps
+from .util import AlarmInfo
+
+
+logger = logging.getLogger(__name__)
+
+# 报警信息中最多包含的不合格行数。超出时只取回前若干行，总行数记录在报警信息中
+SAMPLE_ROWS = 1000
+
+# 下推计划的缓存容量，同 context.MAX_COMPILED_VALIDATORS
+MAX_PLANS = 4096
+
+# 可以下推的校验函数，以及各自的数据参数（result 的下标，None 表示 result 本身）
+_pushdown_funcs = {
+    'claim': (claim, [None]),
+    'diff': (diff, [0, 1]),
+}
+
+# 谓词中的比较运算对应的 SQL 运算符
+_sql_operators = {'gt': '>', 'ge': '>=', 'lt': '<', 'le': '<=', 'eq': '=', 'ne': '<>'}
+
+# 各驱动中 NULL 安全的等值比较（NULL 与 NULL 相等），与 pandas 合并时缺失值的 key 互相匹配一致
+_null_safe_eq = {'mysql': '{0} <=> {1}', 'sqlite': '{0} IS {1}'}
+
+# MySQL 数值类型的类型代码（MySQLdb.constants.FIELD_TYPE）：
+# DECIMAL, TINY, SHORT, LONG, FLOAT, DOUBLE, LONGLONG, INT24, YEAR, NEWDECIMAL
+_numeric_type_codes = {'mysql': frozenset([0, 1, 2, 3, 4, 5, 8, 9, 13, 246])}
+
+# 没有列类型的驱动中，统计一列中非数值（NULL 除外）的行数
+_count_non_numeric = {
+    'sqlite': "SUM(CASE WHEN typeof({}) IN ('integer', 'real', 'null') THEN 0 ELSE 1 END)",
+}
+
+# 右表独有的行中，左表这一标记列为 NULL
+_MATCHED = '_dm_matched'
+
+_plans = {}
+_lock = threading.Lock()
+
+re_select = re.compile(r'^\s*select\s', re.I)
+
+
+class _NotPushable(Exception):
+    """校验表达式无法改写为 SQL"""
+
+
+# 分析校验表达式
+# ------------------------------------------------------------------------------
+def get_plan(validator):
+    """分析校验表达式，返回下推计划 (校验函数名称, {参数名: 参数值})，无法下推时返回 None。
+    只有形如 claim(result, ...)、diff(result[0], result[1], ...) 的表达式可以下推，
+    其余参数必须能够脱离查询结果求值，谓词必须由 gt、ge、lt、le、eq、ne、ands、ors 组合而成。
+    分析结果按表达式缓存。
+    """
+    try:
+        return _plans[validator]
+    except KeyError:
+        pass
+
+    try:
+        plan = _make_plan(validator)
+    except _NotPushable as e:
+        logger.info('validator {!r} can not be pushed down ({}), fetching full results.'.format(validator, e))
+        plan = None
+
+    with _lock:
+        if len(_plans) >= MAX_PLANS:
+            _plans.clear()
+        _plans[validator] = plan
+    return plan
+
+
+def _result_index(node):
+    """数据参数在 result 中的下标：result 本身为 None，result[i] 为 i，其他表达式抛出 _NotPushable"""
+    if isinstance(node, ast.Name) and node.id == 'result':
+        return None
+    if (isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == 'result'
+            and isinstance(node.slice, ast.Index) and isinstance(node.slice.value, ast.Num)):
+        return node.slice.value.n
+    raise _NotPushable('data arguments should be `result` or `result[i]`')
+
+
+def _eval_node(node):
+    """在校验表达式的上下文中对参数求值，参数不能引用 result"""
+    code = compile(ast.Expression(node), '<validator>', 'eval')
+    try:
+        return eval(code, get_base_validator_context(), {})
+    except Exception as e:
+        raise _NotPushable('argument can not be evaluated without result: {}'.format(e))
+
+
+def _make_plan(validator):
+    # 检查表达式的安全性，与执行校验表达式时相同
+    compile_validator(validator)
+
+    node = ast.parse(validator.strip(), mode='eval').body
+    if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _pushdown_funcs):
+        raise _NotPushable('only a single call of {} is supported'.format(sorted(_pushdown_funcs)))
+    if getattr(node, 'starargs', None) or getattr(node, 'kwargs', None):
+        raise _NotPushable('*args and **kwargs are not supported')
+
+    func, indices = _pushdown_funcs[node.func.id]
+    if [_result_index(arg) for arg in node.args[:len(indices)]] != indices:
+        raise _NotPushable('data arguments should be {}'.format(
+            ', '.join('result' if i is None else 'result[{}]'.format(i) for i in indices)))
+
+    args = [_eval_node(arg) for arg in node.args[len(indices):]]
+    kwargs = {kw.arg: _eval_node(kw.value) for kw in node.keywords}
+    try:
+        callargs = inspect.getcallargs(func, *([None] * len(indices) + args), **kwargs)
+    except TypeError as e:
+        raise _NotPushable(e)
+
+    # 检查参数，参数不合法时交给原函数报错
+    if func is claim:
+        if callargs['pred'] is not None:
+            _pred_sql(callargs['pred'], '`x`')
+        if callargs['period'] not in PERIOD_UNITS:
+            raise _NotPushable('invalid period')
+    else:
+        if callargs['direction'] not in (-1, 0, 1):
+            raise _NotPushable('invalid direction')
+        _literal(callargs['threshold'])
+    return node.func.id, callargs
+
+
+# 生成 SQL
+# ------------------------------------------------------------------------------
+def _quote(name):
+    """引用列名。MySQL 和 sqlite 都支持反引号"""
+    return '`{}`'.format(name.replace('`', '``'))
+
+
+def _literal(value):
+    """把 Python 值转换为 SQL 常量"""
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (numbers.Integral, decimal.Decimal)):
+        return str(value)
+    if isinstance(value, numbers.Real):
+        if math.isnan(value) or math.isinf(value):
+            raise _NotPushable('{!r} can not be used in sql'.format(value))
+        return repr(float(value))
+    if isinstance(value, datetime.date):
+        value = str(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    # 各数据库对反斜杠的转义规则不同，不下推包含反斜杠的字符串
+    if isinstance(value, str) and '\\' not in value:
+        return "'{}'".format(value.replace("'", "''"))
+    raise _NotPushable('{!r} can not be used in sql'.format(value))
+
+
+def _pred_sql(pred, col):
+    """把谓词翻译为 SQL 条件，条件为真表示满足谓词。
+    与 pandas 的比较语义一致：NULL 不满足任何比较，ne 除外。
+    """
+    spec = pred.spec if isinstance(pred, Predicate) else None
+    if spec is None:
+        raise _NotPushable('predicate {!r} can not be translated to sql'.format(pred))
+    op, arg = spec
+    if op in ('and', 'or'):
+        if not arg:
+            raise _NotPushable('empty {}s()'.format(op))
+        return '({})'.format(' {} '.format(op.upper()).join(_pred_sql(p, col) for p in arg))
+    cond = '{} {} {}'.format(col, _sql_operators[op], _literal(arg))
+    if op == 'ne':
+        cond = '({} OR {} IS NULL)'.format(cond, col)
+    return cond
+
+
+def _subquery(sql):
+    """把作业的 SQL 包装为子查询。SQL 末尾可能有分号或行注释，因此去掉分号并在括号前换行"""
+    return '(\n{}\n)'.format(sql.strip().rstrip(';'))
+
+
+# 执行下推
+# ------------------------------------------------------------------------------
+def run_pushdown(job):
+    """以下推方式执行作业，返回值同 launch.run_job。
+    作业无法下推，或下推的 SQL 执行失败时返回 None，由调用方按普通方式执行。
+    """
+    plan = get_plan(job['validator'])
+    if plan is None:
+        return None
+    name, args = plan
+    db_confs, sqls = job['db_conf'], job['sql']
+    if not all(re_select.match(sql) for sql in sqls):
+        return None
+
+    try:
+        if name == 'claim' and len(sqls) == 1:
+            return _run_claim(job, db_confs[0], sqls[0], args)
+        if name == 'diff' and len(sqls) == 2 and _same_database(*db_confs):
+            return _run_diff(job, db_confs[0], sqls, args)
+    except ResultTooLarge:
+        raise
+    except _NotPushable:
+        pass
+    except Exception as e:
+        logger.warning('job [{}] push-down failed, fetching full results instead: {}'.format(job['_name'], e))
+    return None
+
+
+def _same_database(db_conf1, db_conf2):
+    return db_conf1['_name'] == db_conf2['_name'] and db_conf1.get('database') == db_conf2.get('database')
+
+
+def _columns(db_conf, source):
+    """查询结果的原始列名和类型代码。LIMIT 0 的查询只需要取得结果的结构，数据库不必执行（物化）子查询"""
+    columns, _ = describe(db_conf, 'SELECT * FROM {} t LIMIT 0'.format(source))
+    return [name for name, _ in columns], [type_code for _, type_code in columns]
+
+
+def _fetch_sample(job, db_conf, sql, total=None):
+    """执行查询不合格行的 SQL，最多取回 SAMPLE_ROWS 行，返回 DataFrame。
+    超出时返回 SampledFrame，在报警信息中给出不合格行的总数 total（为空时另外统计）
+    """
+    res = query(db_conf, 'SELECT * FROM {} v LIMIT {}'.format(_subquery(sql), SAMPLE_ROWS))
+    if len(res) < SAMPLE_ROWS:
+        return res.df
+    if total is None:
+        total = query(db_conf, 'SELECT COUNT(*) FROM {} v'.format(_subquery(sql)))
+    logger.warning('job [{}]: {} rows failed validation, only the first {} rows are included in the alarm.'.format(
+        job['_name'], total, SAMPLE_ROWS))
+    return _sampled(res.df, total)
+
+
+def _sampled(df, total):
+    """df 只是不合格数据的样本时，在其中记录不合格行的总数"""
+    if total <= len(df.index):
+        return df
+    df = SampledFrame(df)
+    df.total_rows = total
+    return df
+
+
+def _run_claim(job, db_conf, sql, args):
+    """在数据库中筛选不满足谓词的行；序列检查只取回序列列去重后的值。
+    总行数和不合格行数由一次聚合查询得到，没有不合格的行时不再查询样本
+    """
+    source = _subquery(sql)
+    names, _ = _columns(db_conf, source)
+    # 单列的结果可能只有一个值，claim 对其另有处理；重名的列无法在 SQL 中引用
+    if len(names) < 2 or len(set(names)) < len(names):
+        return None
+    col_names = normalize_col_names(names)
+
+    pred = args['pred']
+    bad = 'CASE WHEN {} THEN 0 ELSE 1 END'.format(_pred_sql(pred, _quote(names[-1]))) if pred is not None else '0'
+    _, (nrows, nbad) = describe(db_conf, 'SELECT COUNT(*), SUM({}) FROM {} t'.format(bad, source))
+    if not nrows:
+        return False, 'result is empty'
+    nbad = int(nbad or 0)
+
+    if nbad:
+        res = _fetch_sample(job, db_conf, 'SELECT * FROM {} t WHERE {} = 1'.format(source, bad), nbad)
+    else:
+        res = pd.DataFrame(columns=col_names)
+    nsample = len(res.index)
+
+    res['has_data'] = 'Yes'
+    if args['serial']:
+        max_rows = job.get('max_result_rows')
+        max_bytes = job['max_result_mb'] * 1024 * 1024 if job.get('max_result_mb') else None
+        keys = query(
+            db_conf, 'SELECT DISTINCT {} FROM {} t'.format(_quote(names[0]), source), max_rows, max_bytes)
+        # 只有一个值时 query 直接返回该值
+        values = keys.df.iloc[:, 0] if isinstance(keys, ResultSet) else [keys]
+        res = _fill_gaps(
+            res, pd.Series(values, name=col_names[0]), args['period'], args['start'], args['end'])
+        # 缺失的序列值也是不合格的行
+        res = _sampled(res, nbad + len(res.index) - nsample)
+    return _claim_result(res)
+
+
+def _run_diff(job, db_conf, sqls, args):
+    """在数据库中对两个查询做全外连接（LEFT JOIN 加上右表独有的行），只取回不一致的行。
+    结果的列与 diff 相同：key 用 NULL 安全的等值比较连接；两个 value 列都是数值类型时比较差值，否则比较是否相等。
+    """
+    driver = db_conf.get('driver', 'mysql')
+    if driver not in _null_safe_eq:
+        return None
+    sources = [_subquery(sql) for sql in sqls]
+    (names1, types1), (names2, types2) = [_columns(db_conf, source) for source in sources]
+    if len(names1) != len(names2) or len(names1) < 2 or len(set(names1)) < len(names1) or len(set(names2)) < len(names2):
+        return None
+    if _MATCHED in names1:
+        return None
+
+    # 一条语句判断两个查询是否为空。value 列的类型取自查询结果的结构，
+    # 驱动不提供列类型时，同时统计 value 列中非数值的行数
+    probes = ['(SELECT COUNT(*) FROM (SELECT 1 FROM {} t LIMIT 1) e)'.format(source) for source in sources]
+    numeric_codes = _numeric_type_codes.get(driver)
+    if numeric_codes is None:
+        if driver not in _count_non_numeric:
+            return None
+        probes.extend('(SELECT {} FROM {} t)'.format(_count_non_numeric[driver].format(_quote(names[-1])), source)
+                      for names, source in zip([names1, names2], sources))
+    _, row = describe(db_conf, 'SELECT ' + ', '.join(probes))
+    if not row[0]:
+        return False, 'data1 (the first table) is empty'
+    if not row[1]:
+        return False, 'data2 (the second table) is empty'
+    if numeric_codes is None:
+        numeric = not row[2] and not row[3]
+    else:
+        numeric = types1[-1] in numeric_codes and types2[-1] in numeric_codes
+
+    # 结果的列名与 diff 相同：左表各列、右表除同名 key 外的各列，其余重名的列加上后缀 _1, _2
+    col_names1, col_names2 = normalize_col_names(names1), normalize_col_names(names2)
+    shared_keys = set(k1 for k1, k2 in zip(col_names1[:-1], col_names2[:-1]) if k1 == k2)
+    overlap = (set(col_names1) & set(col_names2)) - shared_keys
+    columns = []
+    for i, col in enumerate(col_names1):
+        expr = 'a.' + _quote(names1[i])
+        if col in shared_keys:
+            expr = 'COALESCE({}, b.{})'.format(expr, _quote(names2[i]))
+        columns.append((expr, col + '_1' if col in overlap else col))
+    for i, col in enumerate(col_names2):
+        if col not in shared_keys:
+            columns.append(('b.' + _quote(names2[i]), col + '_2' if col in overlap else col))
+
+    v1, v2 = 'a.' + _quote(names1[-1]), 'b.' + _quote(names2[-1])
+    if numeric:
+        diff_expr = {0: 'ABS({0} - {1})', -1: '{0} - {1}', 1: '{1} - {0}'}[args['direction']].format(v1, v2)
+        columns.append((diff_expr, 'diff'))
+        bad = '({0} > {1} OR {0} IS NULL)'.format(diff_expr, _literal(args['threshold']))
+    else:
+        bad = '(NOT ({0} = {1}) OR {0} IS NULL OR {1} IS NULL)'.format(v1, v2)
+    if len(set(alias for _, alias in columns)) < len(columns):
+        return None
+
+    select = ', '.join('{} AS {}'.format(expr, _quote(alias)) for expr, alias in columns)
+    on = ' AND '.join(_null_safe_eq[driver].format('a.' + _quote(k1), 'b.' + _quote(k2))
+                      for k1, k2 in zip(names1[:-1], names2[:-1]))
+    sql = (
+        'SELECT {select} FROM {s1} a LEFT JOIN {s2} b ON {on} WHERE {bad}\n'
+        'UNION ALL\n'
+        # 右表独有的行：key 可能为 NULL，因此用左表的标记列判断连接是否成功
+        'SELECT {select} FROM {s2} b LEFT JOIN (SELECT 1 AS {matched}, t.* FROM {s1} t) a ON {on} '
+        'WHERE a.{matched} IS NULL'
+    ).format(select=select, s1=sources[0], s2=sources[1], on=on, bad=bad, matched=_MATCHED)
+
+    res = _fetch_sample(job, db_conf, sql)
+    if len(res.index) == 0:
+        return True
+    res.reset_index(inplace=True, drop=True)
+    return False, AlarmInfo('diff', res)
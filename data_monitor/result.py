@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""
+@Author:      zhuhe212
+@Email:       zhuhe212@163.com
+@Description: 列式查询结果。查询结果直接按列存储为 pandas.DataFrame，不再为每一行创建 namedtuple 对象。
+@CreateAt:    2026-10-18
+"""
+
+
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+class ResultSet(object):
+    """列式存储的查询结果，兼容原来的 namedtuple 列表：
+    - len(result)、result[i]、result[i].col、result[i][j]、for row in result 等用法不变，
+      行对象在访问时才创建；
+    - result._fields 为列名；
+    - result.df 为存储数据的 DataFrame（不复制），result.columns 为列名到 numpy 数组的有序字典。
+    result.df 可能被多个作业共享（见查询缓存），使用方不应修改它。
+    注意整数列中有 NULL 时会被转换为浮点数，NULL 表示为 NaN。
+    """
+
+    def __init__(self, df):
+        self._df = df
+        self._fields = tuple(df.columns)
+        self._row_type = None
+
+    @classmethod
+    def from_columns(cls, fields, columns):
+        """由列名和各列的值构造结果集"""
+        # 按位置构造后再设置列名，允许重复的列名
+        df = pd.DataFrame(OrderedDict(enumerate(columns)), columns=range(len(fields)))
+        df.columns = list(fields)
+        return cls(df)
+
+    @property
+    def df(self):
+        return self._df
+
+    @property
+    def columns(self):
+        return OrderedDict((name, self._df.iloc[:, i].values) for i, name in enumerate(self._fields))
+
+    def _get_row_type(self):
+        if self._row_type is None:
+            self._row_type = namedtuple('RowType', self._fields)
+        return self._row_type
+
+    def __len__(self):
+        return len(self._df.index)
+
+    def __iter__(self):
+        RowType = self._get_row_type()
+        for values in self._df.itertuples(index=False, name=None):
+            yield RowType(*values)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ResultSet(self._df.iloc[index].reset_index(drop=True))
+        # 按列取值，不能先取出整行：整行为一个 Series，混合整数和浮点数的行会被统一转换为浮点数。
+        # numpy 标量转换为 Python 对象，与迭代时得到的值一致
+        return self._get_row_type()(*[
+            _to_python(self._df.iat[index, i]) for i in range(len(self._fields))])
+
+    def __getstate__(self):
+        # 动态创建的行类型无法被 pickle
+        return {'_df': self._df, '_fields': self._fields, '_row_type': None}
+
+    def __repr__(self):
+        return repr(self._df)
+
+
+def _to_python(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class SampledFrame(pd.DataFrame):
+    """不合格数据的样本（见 pushdown 模块）：只取回了前若干行，total_rows 为不合格数据的总行数，用于报警信息"""
+
+    _metadata = ['total_rows']
+
+    @property
+    def _constructor(self):
+        return SampledFrame
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""
+@Author:      zhuhe212
+@Email:       zhuhe212@163.com
+@Description: 事件驱动的作业调度器。使用堆维护待执行作业，通过条件变量等待下一个到期时刻
+              或作业完成回调，取代轮询。
+@CreateAt:    2026-10-18
+"""
+
+
+import collections
+import datetime
+import heapq
+import itertools
+import threading
+
+
+class Scheduler(object):
+    """作业调度器。
+    - 待执行作业保存在堆中，排序键为 (due_time, -priority(job), sequence)，sequence 为单调递增的序号，
+      保证到期时间相同的作业先按优先级（如预计耗时，耗时长的作业先启动）、再按入队顺序出队，
+      且永远不会比较 job 本身。未提供 priority 时只按入队顺序。
+    - 已提交的作业通过 future.add_done_callback 回收，完成时唤醒调度线程，无需轮询。
+    - 调度线程只在一个条件变量上等待：直到最近一个作业到期、有作业完成，或被显式唤醒。
+    - 周期性作业（如小时级作业）以生成器的形式加入，队列中只保留其最近的一次执行，
+      该次执行被取出后才从生成器中取下一次执行。
+    - 分发时可以提供准入函数，暂不允许运行的到期作业（如数据库并发已满）被暂缓，
+      在下一次分发时优先重新检查。
+    """
+
+    # 单次等待的最长时间（秒）。Python 2 中不带超时的 Condition.wait 无法被信号中断，
+    # 因此总是带上一个较长的超时时间
+    max_wait = 60
+
+    def __init__(self, exit_event=None, priority=None):
+        self._heap = []
+        self._priority = priority
+        self._counter = itertools.count()
+        # 默认使用 RLock，信号处理函数在主线程中调用 wakeup 时不会死锁
+        self._cond = threading.Condition()
+        self._running = {}
+        self._done = collections.deque()
+        self._blocked = collections.deque()
+        self._exit_event = exit_event
+
+    @property
+    def npending(self):
+        """排队中的作业数（周期性作业只计算最近的一次执行）"""
+        return len(self._heap) + len(self._blocked)
+
+    @property
+    def nrunning(self):
+        """运行中（已提交但尚未被回收）的作业数"""
+        return len(self._running)
+
+    def _rank(self, job):
+        return -self._priority(job) if self._priority is not None else 0
+
+    def push(self, due_time, job):
+        """将作业加入队列"""
+        rank = self._rank(job)
+        with self._cond:
+            heapq.heappush(self._heap, (due_time, rank, next(self._counter), job, None))
+            self._cond.notify()
+
+    def push_occurrences(self, occurrences):
+        """加入一个作业的执行序列。occurrences 是按到期时间先后产生作业的迭代器，
+        此处只取出第一次执行，后续执行在前一次被取出时再产生。
+        序列为空时返回 False。
+        """
+        job = next(occurrences, None)
+        if job is None:
+            return False
+        rank = self._rank(job)
+        with self._cond:
+            heapq.heappush(self._heap, (job['due_time'], rank, next(self._counter), job, occurrences))
+            self._cond.notify()
+        return True
+
+    def peek(self):
+        """返回最近到期的 (due_time, job)，队列为空时返回 None"""
+        with self._cond:
+            if not self._heap:
+                return None
+            due_time, _, _, job, _ = self._heap[0]
+            return due_time, job
+
+    def pop_due(self, now=None, admit=None):
+        """弹出所有已到期的作业，按到期先后顺序返回。
+        admit 不为空时，admit(job) 返回 False 的作业暂缓分发，下次调用时优先重新检查。
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        jobs = []
+        with self._cond:
+            candidates, self._blocked = self._blocked, collections.deque()
+        while True:
+            if not candidates:
+                with self._cond:
+                    if not (self._heap and self._heap[0][0] <= now):
+                        break
+                    _, _, _, job, occurrences = heapq.heappop(self._heap)
+                # 在锁外产生下一次执行，避免渲染配置时阻塞其他线程
+                if occurrences is not None:
+                    self.push_occurrences(occurrences)
+            else:
+                job = candidates.popleft()
+
+            if admit is None or admit(job):
+                jobs.append(job)
+            else:
+                with self._cond:
+                    self._blocked.append(job)
+        return jobs
+
+    def discard(self, pred):
+        """从队列中移除所有满足 pred(job) 的作业，返回移除的数量"""
+        with self._cond:
+            size = self.npending
+            self._heap = [entry for entry in self._heap if not pred(entry[3])]
+            heapq.heapify(self._heap)
+            self._blocked = collections.deque(job for job in self._blocked if not pred(job))
+            return size - self.npending
+
+    def track(self, future, job):
+        """登记一个已提交的作业，作业完成后由回调放入完成队列并唤醒调度线程"""
+        with self._cond:
+            self._running[future] = job
+        future.add_done_callback(self._on_done)
+
+    def _on_done(self, future):
+        with self._cond:
+            self._done.append(future)
+            self._cond.notify()
+
+    def wakeup(self):
+        """唤醒等待中的调度线程，例如收到退出信号时"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def wait(self, until=None):
+        """阻塞直到有作业完成、最近的作业到期、到达 until 时刻或被唤醒。
+        返回已完成作业的列表，每个元素为 (future, job)。
+        """
+        with self._cond:
+            while not self._done:
+                if self._exit_event is not None and self._exit_event.is_set():
+                    break
+                deadline = until
+                if self._heap and (deadline is None or self._heap[0][0] < deadline):
+                    deadline = self._heap[0][0]
+                if deadline is None:
+                    # 既没有待执行作业，也没有运行中的作业，无事可等
+                    if not self._running:
+                        break
+                    timeout = self.max_wait
+                else:
+                    timeout = (deadline - datetime.datetime.now()).total_seconds()
+                    if timeout <= 0:
+                        break
+                # 被唤醒后重新检查所有条件，因此不必区分唤醒原因
+                self._cond.wait(min(timeout, self.max_wait))
+
+            completed = []
+            while self._done:
+                future = self._done.popleft()
+                completed.append((future, self._running.pop(future)))
+            return completed
+
+
+def _get_cost(cost, resource):
+    return cost.get(resource, 1) if isinstance(cost, dict) else cost
+
+
+class ResourceLimiter(object):
+    """按资源（如数据库）限制并发作业。
+    每个作业占用若干资源，同一资源上运行中作业的开销之和不能超过该资源的上限。
+    为避免开销过大的作业永远无法运行，资源空闲时总是允许一个作业运行。
+    开销可以是浮点数（如预计耗时），累加和扣减的舍入误差在 epsilon 以内时忽略，
+    避免资源全部释放后仍残留极小的占用，或开销恰好达到上限时被误判为超出。
+    仅由调度线程调用，不需要加锁。
+    """
+
+    epsilon = 1e-9
+
+    def __init__(self):
+        self._usage = collections.defaultdict(float)
+
+    def acquire(self, limits, cost=1):
+        """尝试占用资源，limits 为 {资源: 上限}，cost 为作业在每个资源上的开销，
+        可以是一个数值，也可以是 {资源: 开销}（未列出的资源开销为 1）。
+        成功时返回 True，否则不占用任何资源并返回 False
+        """
+        for resource, limit in limits.items():
+            usage = self._usage[resource]
+            if usage > self.epsilon and usage + _get_cost(cost, resource) > limit + self.epsilon:
+                return False
+        for resource in limits:
+            self._usage[resource] += _get_cost(cost, resource)
+        return True
+
+    def release(self, limits, cost=1):
+        """释放 acquire 占用的资源，参数与 acquire 相同"""
+        for resource in limits:
+            usage = self._usage[resource] - _get_cost(cost, resource)
+            self._usage[resource] = usage if usage > self.epsilon else 0.0
+
+    def usage(self, resource):
+        """资源当前被占用的开销"""
+        return self._usage.get(resource, 0)
@@ -7,14 +7,24 @@
 @CreateAt:    2019-03-31
 """
 
+import bisect
 import dateutil
 import datetime
-from functools import partial
+import itertools
 import operator
-
+import os
+import shutil
+import tempfile
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import numpy as np
 import pandas as pd
 
 from ..context import register_validator
+from ..result import ResultSet
 from ..util import AlarmInfo
 
 
@@ -40,8 +50,12 @@ def claim(data, pred=None, serial=True, period='day', start=None, end=None):
     当监控连续序列开启时，程序会认为 data 的第一列为要监控的序列。
     """
 
+    # 流式结果逐批聚合，不在内存中保留全部数据
+    if _is_stream(data):
+        return _claim_stream(data, pred, serial, period, start, end)
+
     # 如果 data 是单个值且设定了谓词函数，直接判定。否则将单个值包装成嵌套列表，按照一般流程处理。
-    if not isinstance(data, (tuple, list)):
+    if not isinstance(data, (tuple, list, ResultSet)):
         if pred is not None:
             ok = pred(data)
             return ok
@@ -58,22 +72,32 @@ def claim(data, pred=None, serial=True, period='day', start=None, end=None):
         except AttributeError:
             return ['col' + str(i) for i in range(len(data[0]))]
 
-    col_names = get_fields(data)
-    df = pd.DataFrame(data, columns=col_names)
+    # 查询结果可能被多个作业共享，下面的步骤只修改筛选出的行，不修改 df 本身，因此无需复制
+    if isinstance(data, ResultSet):
+        col_names = list(data._fields)
+        df = data.df
+    else:
+        col_names = get_fields(data)
+        df = pd.DataFrame(data, columns=col_names)
+
+    # 执行数据检查，选出不满足条件的行
+    if pred is not None:
+        res = df.loc[~_apply_pred(pred, df[col_names[-1]]), :].copy()
+    else:
+        res = df.iloc[:0].copy()
 
     # 增加一个 flag 列，以便判断哪些行缺数
-    df['has_data'] = 'Yes'
+    res['has_data'] = 'Yes'
 
-    # 如果要检查序列，则生成一个完整序列，并与 data 做 left join
+    # 如果要检查序列，则找出序列中缺失的周期，作为缺数的行加入结果
     if serial:
-        df = _sequenced(df, col_names[0], period, start, end)
+        res = _fill_gaps(res, df[col_names[0]], period, start, end)
+
+    return _claim_result(res)
 
-    # 执行数据检查，选出缺数的行以及不满足条件的行
-    index = df['has_data'].isna()
-    if pred is not None:
-        index = index | (~df[col_names[-1]].apply(pred))
-    res = df.loc[index, :].copy()
 
+def _claim_result(res):
+    """根据不合格的行生成 claim 的返回值"""
     if len(res.index) == 0:
         return True
     res.reset_index(inplace=True, drop=True)
@@ -81,91 +105,155 @@ def claim(data, pred=None, serial=True, period='day', start=None, end=None):
     return False, AlarmInfo('claim', res)
 
 
-def _sequenced(df, serial_col, period, start, end):
-    """填充 DataFrame 的 serial 列，使之连续，其余列会自动填充 NaN。"""
+def _is_stream(data):
+    """data 是否为流式查询结果（见 db.StreamingResult）"""
+    return hasattr(data, 'chunks')
 
-    # 解析 period 参数
-    if period not in ('year', 'month', 'week', 'day', 'hour'):
-        raise ValueError('argument "period" should be one of (year, month, week, day, hour), but {!r} got'.format(period))
 
-    # 解析 start、end 参数
-    if start is not None:
-        try:
-            start = dateutil.parser.parse(start)
-        except:
-            raise ValueError('argument "start" ({!r}) can not be parsed as datetime'.format(start))
-    if end is not None:
-        try:
-            end = dateutil.parser.parse(end)
-        except:
-            raise ValueError('argument "end" ({!r}) can not be parsed as datetime'.format(end))
+def _claim_stream(data, pred, serial, period, start, end):
+    """claim 的流式版本。逐批检查数据，只保留不满足谓词的行，以及序列检查所需的 key 集合"""
+    col_names = list(data._fields)
+    bad_frames = []
+    keys = set()
+    nrows = 0
+    for chunk in data.chunks():
+        nrows += len(chunk)
+        df = chunk.df
+        if serial:
+            keys.update(df[col_names[0]])
+        if pred is not None:
+            bad_frames.append(df.loc[~_apply_pred(pred, df[col_names[-1]]), :])
 
-    # 有些数据库中使用整数、字符串等类型存储日期，需要转化一下
-    if not isinstance(df[serial_col][0], datetime.date):
-        df[serial_col] = df[serial_col].astype(basestring)
-        try:
-            df[serial_col] = df[serial_col].apply(dateutil.parser.parse)
-        except:
-            raise ValueError('the serial column can not be parsed as datetime:\n{}'.format(df[serial_col].head(20)))
+    if nrows == 0:
+        return False, 'result is empty'
+
+    res = pd.concat(bad_frames, ignore_index=True) if bad_frames else pd.DataFrame(columns=col_names)
+    res['has_data'] = 'Yes'
+    if serial:
+        res = _fill_gaps(res, pd.Series(list(keys), name=col_names[0]), period, start, end)
+    return _claim_result(res)
 
+
+# 各周期对应的 numpy datetime64 单位，以及连续序列中相邻两项相差的单位数
+PERIOD_UNITS = {'year': ('Y', 1), 'month': ('M', 1), 'week': ('D', 7), 'day': ('D', 1), 'hour': ('h', 1)}
+
+# 报警信息中各周期的显示格式
+PERIOD_FORMATS = {'year': '%Y', 'month': '%Y-%m', 'week': '%Y-%m-%d', 'day': '%Y-%m-%d', 'hour': '%Y-%m-%d %H'}
+
+
+def _parse_bound(value, name):
+    """解析 start、end 参数"""
+    if value is None or isinstance(value, datetime.date):
+        return value
+    try:
+        return dateutil.parser.parse(value)
+    except:
+        raise ValueError('argument "{}" ({!r}) can not be parsed as datetime'.format(name, value))
+
+
+def _to_datetime(values):
+    """把序列列转换为 datetime64 类型的 Series"""
+    if values.dtype.kind == 'M':
+        return values
+
+    # 有些数据库中使用整数、字符串等类型存储日期，需要先转化为字符串再解析
+    sample = values.dropna()
+    if len(sample.index) and not isinstance(sample.iloc[0], datetime.date):
+        if sample.dtype.kind == 'f':
+            sample = sample.astype('int64')
+        values = sample.astype(unicode).reindex(values.index)
+    try:
+        return pd.to_datetime(values)
+    except (ValueError, TypeError, OverflowError):
+        raise ValueError('the serial column can not be parsed as datetime:\n{}'.format(values.head(20)))
+
+
+def _to_buckets(values, period):
+    """把 datetime64 数组转换为周期编号（整数），同一周期内的时间编号相同"""
+    unit, _ = PERIOD_UNITS[period]
+    return values.astype('datetime64[{}]'.format(unit)).astype('int64')
+
+
+def _find_gaps(values, period, start, end):
+    """找出 [start, end] 区间的连续序列中，values (datetime64 Series) 没有覆盖到的周期。
+    序列从 start 开始，每次增加一个周期，直到超过 end。返回缺失周期的起始时间（DatetimeIndex）。
+    """
+    unit, step = PERIOD_UNITS[period]
+    values = values.dropna()
     if start is None:
-        start = df[serial_col].min()
-        # 从数据库直接读取的值可能是 date 类型，需要转化为 datetime 类型
-        if not isinstance(start, datetime.datetime):
-            start = datetime.datetime.combine(start, datetime.datetime.min.time())
+        start = values.min()
     if end is None:
-        end = df[serial_col].max()
-        if not isinstance(end, datetime.datetime):
-            end = datetime.datetime.combine(end, datetime.datetime.min.time())
+        end = values.max()
+    if start is None or end is None or pd.isna(start) or pd.isna(end):
+        return pd.DatetimeIndex([])
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+
+    # 计算序列的项数，与逐项累加周期直到超过 end 的结果一致
+    first, last = _to_buckets(np.array([start.to_datetime64(), end.to_datetime64()]), period)
+    if period in ('year', 'month'):
+        n = (last - first) // step + 1
+        if n > 0 and start + dateutil.relativedelta.relativedelta(**{period + 's': n - 1}) > end:
+            n -= 1
+    else:
+        delta = pd.Timedelta(hours=1) if period == 'hour' else pd.Timedelta(days=step)
+        n = (end - start) // delta + 1
+    expected = first + step * np.arange(max(n, 0), dtype='int64')
+
+    buckets = _to_buckets(values.values, period)
+    if len(buckets) > 1 and (buckets[1:] >= buckets[:-1]).all():
+        # 有序的数据：二分查找每个周期是否出现过，不需要建立哈希表
+        pos = np.searchsorted(buckets, expected)
+        found = (pos < len(buckets)) & (buckets[np.minimum(pos, len(buckets) - 1)] == expected)
+    else:
+        found = pd.Index(expected).isin(buckets)
+    missing = expected[~found]
+    return pd.DatetimeIndex(missing.astype('datetime64[{}]'.format(unit)).astype('datetime64[ns]'))
 
-    def gen_sequence(start, end, period):
-        """根据起止时间和周期，产生完整的日期时间序列"""
-        params = {period + 's': 1}
-        delta = dateutil.relativedelta.relativedelta(**params)
-        while start <= end:
-            yield start
-            start = start + delta
 
-    sequence = list(gen_sequence(start, end, period))
-    baseline = pd.DataFrame({serial_col: sequence})
+def _fill_gaps(res, keys, period, start, end):
+    """检查连续序列，把缺失的周期作为缺数的行（has_data 为空）加入 res。
+    res 为不合格的行，keys 为全部数据的序列列（第一列）。结果按序列先后排列，序列列格式化为周期的字符串。
+    """
+    if period not in PERIOD_UNITS:
+        raise ValueError('argument "period" should be one of (year, month, week, day, hour), but {!r} got'.format(period))
+    start = _parse_bound(start, 'start')
+    end = _parse_bound(end, 'end')
 
-    # 根据 period 转化为对应的 format
-    format_map = {'year': '%Y', 'month': '%Y-%m', 'day': '%Y-%m-%d', 'hour': '%Y-%m-%d %H'}
-    format_map['week'] = format_map['day']
-    format_ = format_map[period]
-    df[serial_col] = df[serial_col].apply(lambda dt: dt.strftime(format_))
-    baseline[serial_col] = baseline[serial_col].apply(lambda dt: dt.strftime(format_))
+    serial_col = keys.name
+    missing = _find_gaps(_to_datetime(keys), period, start, end)
 
-    df = pd.merge(baseline, df, how='outer', on=serial_col)
-    return df
+    res[serial_col] = _to_datetime(res[serial_col])
+    gaps = pd.DataFrame({serial_col: missing}, columns=res.columns)
+    res = pd.concat([res, gaps], ignore_index=True)
+    res = res.sort_values(serial_col, kind='mergesort')
+    res[serial_col] = res[serial_col].dt.strftime(PERIOD_FORMATS[period])
+    return res
 
 
 @register_validator
-def diff(data1, data2, threshold=1e-6, direction=0):
+def diff(data1, data2, threshold=1e-6, direction=0, mode='merge', partitions=16):
     """diff 两组数据。
     每组数据可包含多列，程序会假定最后一列为 value，前面所有列为 key。
     threshold 为警报阈值：diff 列中任意一值超过 threshold 即触发报警（一边为 NULL 值同样触发报警）
     direction 为 diff 的方向：-1 代表左表减右表，1 代表右表减左表，0 代表两表之差取绝对值。默认为 0。
+    mode 为 diff 的执行方式，数据量很大时（通常与作业选项 stream = true 配合）可选用后两种方式：
+    - merge: 默认。两组数据全部载入内存后做外连接；
+    - sorted: 两组数据都已按 key 列排序（SQL 中使用 ORDER BY key 列），按 key 的顺序逐批归并，
+      内存中只保留当前批次和不一致的行。数据未排序时抛出异常；
+    - hash: 按 key 的哈希值把两组数据分别写入 partitions 个临时文件，再逐个分区做 diff，
+      内存中只保留一个分区，适用于无法排序的数据。
     """
     if direction not in (-1, 0, 1):
         raise ValueError('invalid argument "direction={!r}", should be one value in [-1, 0, 1]'.format(direction))
+    if mode not in ('merge', 'sorted', 'hash'):
+        raise ValueError('invalid argument "mode={!r}", should be one value in [merge, sorted, hash]'.format(mode))
 
-    if len(data1) == 0:
-        return False, 'data1 (the first table) is empty'
-    if len(data2) == 0:
-        return False, 'data2 (the second table) is empty'
-
-    def get_fields(data):
-        """尝试获取 data(SQL 查询结果) 的字段列表"""
-        try:
-            return data[0]._fields
-        except (IndexError, AttributeError):
-            return None
-
-    col_names1 = get_fields(data1)
-    col_names2 = get_fields(data2)
+    col_names1 = _get_diff_fields(data1)
+    col_names2 = _get_diff_fields(data2)
 
     if col_names1 is None and col_names2 is None:
+        if len(data1) == 0:
+            return False, 'data1 (the first table) is empty'
         col_names = ['col' + str(i) for i in range(len(data1[0]))]
         col_names1 = col_names
         col_names2 = col_names
@@ -175,14 +263,79 @@ def diff(data1, data2, threshold=1e-6, direction=0):
         if col_names2 is None:
             col_names2 = col_names1
 
-    df1 = pd.DataFrame(data1, columns=col_names1)
-    df2 = pd.DataFrame(data2, columns=col_names2)
+    # 逐批产生数据，先取出第一批以判断数据是否为空
+    frames1 = _iter_frames(data1, col_names1)
+    first1 = next(frames1, None)
+    if first1 is None:
+        return False, 'data1 (the first table) is empty'
+    frames2 = _iter_frames(data2, col_names2)
+    first2 = next(frames2, None)
+    if first2 is None:
+        return False, 'data2 (the second table) is empty'
+    frames1 = itertools.chain([first1], frames1)
+    frames2 = itertools.chain([first2], frames2)
+
+    if mode == 'sorted':
+        res = _diff_sorted(frames1, frames2, col_names1, col_names2, threshold, direction)
+    elif mode == 'hash':
+        res = _diff_hash(frames1, frames2, col_names1, col_names2, threshold, direction, partitions)
+    else:
+        res = _diff_frames(_concat_frames(frames1), _concat_frames(frames2), col_names1, col_names2, threshold, direction)
+
+    if len(res.index) == 0:
+        return True
+
+    res.reset_index(inplace=True, drop=True)
+    info = AlarmInfo('diff', res)
+    return False, info
+
+
+def _get_diff_fields(data):
+    """尝试获取 data(SQL 查询结果) 的字段列表"""
+    if _is_stream(data) or isinstance(data, ResultSet):
+        return list(data._fields)
+    if isinstance(data, pd.DataFrame):
+        return data.columns.tolist()
+    try:
+        return data[0]._fields
+    except (IndexError, AttributeError):
+        return None
+
+
+def _iter_frames(data, col_names):
+    """把数据逐批转换为 DataFrame，跳过空的批次。查询结果的 DataFrame 直接使用，无需复制（diff 不会修改它）"""
+    if _is_stream(data):
+        frames = (chunk.df for chunk in data.chunks())
+    elif isinstance(data, ResultSet):
+        frames = [data.df]
+    elif isinstance(data, pd.DataFrame):
+        frames = [data]
+    else:
+        frames = [pd.DataFrame(data, columns=col_names)] if len(data) else []
+    return (df for df in frames if len(df.index))
+
+
+def _concat_frames(frames):
+    frames = list(frames)
+    return frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
 
-    df_all = df1.merge(
-        df2, how='outer', left_on=col_names1[:-1], right_on=col_names2[:-1],
-        suffixes=('_1', '_2'))
+def _diff_frames(df1, df2, col_names1, col_names2, threshold, direction):
+    """对两个 DataFrame 做外连接，返回 value 不一致的行"""
+    keys1, keys2 = col_names1[:-1], col_names2[:-1]
+    df_all = df1.merge(df2, how='outer', left_on=keys1, right_on=keys2, suffixes=('_1', '_2'))
 
-    col1, col2 = df_all.columns.tolist()[-2:]
+    # 某一边为空时，merge 结果的列顺序会改变，此处按正常的顺序排列：左表各列、右表除同名 key 外的各列
+    shared_keys = set(k1 for k1, k2 in zip(keys1, keys2) if k1 == k2)
+    overlap = (set(col_names1) & set(col_names2)) - shared_keys
+    columns = [c + '_1' if c in overlap else c for c in col_names1]
+    columns += [c + '_2' if c in overlap else c for c in col_names2 if c not in shared_keys]
+    # value 列为左表的最后一列和右表的最后一列（两表的 key 列名不同时，左表的 value 列不是倒数第二列）
+    if set(columns) == set(df_all.columns):
+        df_all = df_all[columns]
+        col1, col2 = columns[len(col_names1) - 1], columns[-1]
+    else:
+        col1, col2 = df_all.columns.tolist()[-2:]
     try:
         diff = df_all[col1] - df_all[col2]
         diff = abs(diff) if direction == 0 else diff if direction == -1 else -diff
@@ -192,46 +345,194 @@ def diff(data1, data2, threshold=1e-6, direction=0):
         index = df_all[col1] != df_all[col2]
 
     res = df_all.loc[index, :]
-    if len(res.index) == 0:
-        return True
-
     if diff is not None:
-        res = res.assign(diff=diff)
-    res.reset_index(inplace=True, drop=True)
-    info = AlarmInfo('diff', res)
-    return False, info
+        res = res.assign(diff=diff[index])
+    return res
+
+
+def _get_keys(df, key_cols):
+    """取出每一行的 key，key 为各 key 列的值组成的 tuple"""
+    return list(zip(*[df[col].tolist() for col in key_cols]))
+
+
+class _SortedInput(object):
+    """sorted 方式的 diff 中一组数据的读取缓冲区，保存已读取但尚未参与 diff 的行"""
+
+    def __init__(self, frames, key_cols, name):
+        self._frames = frames
+        self._key_cols = key_cols
+        self._name = name
+        self.df = None
+        self.keys = []
+        self.exhausted = False
+
+    def pull(self):
+        """读取下一批数据，并检查数据是否按 key 排序"""
+        df = next(self._frames, None)
+        if df is None:
+            self.exhausted = True
+            return
+        keys = _get_keys(df, self._key_cols)
+        seq = self.keys[-1:] + keys
+        if any(b < a for a, b in zip(seq, seq[1:])):
+            raise ValueError(
+                '{} is not sorted by key columns {!r}, add "ORDER BY" to the sql or use mode="hash"'.format(
+                    self._name, list(self._key_cols)))
+        self.df = df if self.df is None or len(self.df.index) == 0 else pd.concat([self.df, df], ignore_index=True)
+        self.keys.extend(keys)
+
+    def fill(self):
+        """缓冲区为空时读取数据，直到有数据或读取完毕"""
+        while not self.keys and not self.exhausted:
+            self.pull()
+
+    def count_below(self, bound):
+        """缓冲区中 key 小于 bound 的行数，bound 为 None 时表示全部"""
+        return len(self.keys) if bound is None else bisect.bisect_left(self.keys, bound)
+
+    def take(self, n):
+        """取出缓冲区的前 n 行"""
+        df, self.df = self.df.iloc[:n], self.df.iloc[n:]
+        del self.keys[:n]
+        return df
+
+
+def _diff_sorted(frames1, frames2, col_names1, col_names2, threshold, direction):
+    """按 key 顺序归并两组有序数据。
+    每一轮以两边已读取数据的最大 key 中较小者为界，小于该界的 key 在两边都不会再出现，
+    可以立即 diff 并丢弃；等于该界的行留到下一轮，以免同一个 key 的行被拆到两轮中。
+    """
+    inputs = [_SortedInput(frames1, col_names1[:-1], 'data1'), _SortedInput(frames2, col_names2[:-1], 'data2')]
+    results = []
+    while True:
+        for input_ in inputs:
+            input_.fill()
+        pending = [input_ for input_ in inputs if not input_.exhausted]
+        bound = min(input_.keys[-1] for input_ in pending) if pending else None
+        counts = [input_.count_below(bound) for input_ in inputs]
+        if not any(counts):
+            if bound is None:
+                break
+            # 缓冲区中剩下的行的 key 都等于界，需要读取更多数据
+            for input_ in pending:
+                if input_.keys[-1] == bound:
+                    input_.pull()
+            continue
+        res = _diff_frames(
+            inputs[0].take(counts[0]), inputs[1].take(counts[1]), col_names1, col_names2, threshold, direction)
+        if len(res.index):
+            results.append(res)
+
+    return pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+
+
+def _diff_hash(frames1, frames2, col_names1, col_names2, threshold, direction, partitions):
+    """按 key 的哈希值把两组数据分区写入临时文件，再逐个分区 diff"""
+    tmp_dir = tempfile.mkdtemp(prefix='data_monitor_diff_')
+    try:
+        empty = []
+        for side, frames, col_names in ((1, frames1, col_names1), (2, frames2, col_names2)):
+            for df in frames:
+                if len(empty) < side:
+                    # 保留一个空的 DataFrame，用于数据为空的分区，以保持各列的类型
+                    empty.append(df.iloc[:0])
+                # 使用 Python 的 hash，数值相等的 key（如 1, 1.0, Decimal(1)）总是分到同一个分区
+                parts = np.array([hash(key) % partitions for key in _get_keys(df, col_names[:-1])])
+                for part, piece in df.groupby(parts):
+                    with open(os.path.join(tmp_dir, '{}_{}'.format(side, part)), 'ab') as f:
+                        pickle.dump(piece, f, pickle.HIGHEST_PROTOCOL)
+
+        results = []
+        for part in range(partitions):
+            df1 = _load_partition(os.path.join(tmp_dir, '1_{}'.format(part)), empty[0])
+            df2 = _load_partition(os.path.join(tmp_dir, '2_{}'.format(part)), empty[1])
+            if len(df1.index) == 0 and len(df2.index) == 0:
+                continue
+            res = _diff_frames(df1, df2, col_names1, col_names2, threshold, direction)
+            if len(res.index):
+                results.append(res)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+
+
+def _load_partition(path, empty):
+    """读取一个分区的全部数据，分区文件不存在时返回 empty"""
+    if not os.path.exists(path):
+        return empty
+    pieces = []
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                pieces.append(pickle.load(f))
+            except EOFError:
+                break
+    return _concat_frames(pieces)
 
 
 # 注册一些基本的谓词函数（predicate function），如大于、小于等，以便用户在校验表达式中使用。
+# 这些函数返回 Predicate 对象，claim 可以将其一次性作用于整列数据，而不必逐行调用。
+class Predicate(object):
+    """可向量化的谓词。
+    - pred(x): 作用于单个值，返回布尔值，与普通的谓词函数用法相同；
+    - pred.evaluate(values): 作用于整列数据（pandas.Series），返回布尔 Series。
+    evaluate 不提供时使用 func，适用于本身就支持 Series 的函数（如比较运算）。
+    spec 描述谓词的结构，用于把谓词翻译成 SQL 条件（见 pushdown 模块），格式为 (操作, 参数)：
+    比较运算为 ('gt', b) 等，组合谓词为 ('and', [子谓词...]) 或 ('or', [子谓词...])。
+    为 None 时表示谓词无法翻译成 SQL。
+    """
+
+    def __init__(self, func, evaluate=None, spec=None):
+        self._func = func
+        self._evaluate = evaluate or func
+        self.spec = spec
+
+    def __call__(self, x):
+        return self._func(x)
+
+    def evaluate(self, values):
+        return self._evaluate(values)
+
+
+def _apply_pred(pred, values):
+    """对整列数据执行谓词，返回布尔 Series。
+    Predicate 直接作用于整列；用户自定义的普通函数，或列中的数据类型无法整体比较时，逐个元素调用。
+    """
+    if isinstance(pred, Predicate):
+        try:
+            return pred.evaluate(values).astype(bool)
+        except TypeError:
+            pass
+    return values.apply(pred).astype(bool)
+
+
+def _compare(op, b):
+    return Predicate(lambda a: op(a, b), spec=(op.__name__, b))
+
 @register_validator
 def gt(b):
-    meth = lambda a, b: operator.gt(a, b)
-    return partial(meth, b=b)
+    return _compare(operator.gt, b)
 
 @register_validator
 def ge(b):
-    meth = lambda a, b: operator.ge(a, b)
-    return partial(meth, b=b)
+    return _compare(operator.ge, b)
 
 @register_validator
 def lt(b):
-    meth = lambda a, b: operator.lt(a, b)
-    return partial(meth, b=b)
+    return _compare(operator.lt, b)
 
 @register_validator
 def le(b):
-    meth = lambda a, b: operator.le(a, b)
-    return partial(meth, b=b)
+    return _compare(operator.le, b)
 
 @register_validator
 def eq(b):
-    meth = lambda a, b: operator.eq(a, b)
-    return partial(meth, b=b)
+    return _compare(operator.eq, b)
 
 @register_validator
 def ne(b):
-    meth = lambda a, b: operator.ne(a, b)
-    return partial(meth, b=b)
+    return _compare(operator.ne, b)
 
 # 支持多谓词组合
 @register_validator
@@ -239,11 +540,15 @@ def ands(*args):
     """把多个谓词取且，得到一个联合谓词"""
     def combined_fun(x):
         return all(pred(x) for pred in args)
-    return combined_fun
+    def combined_evaluate(values):
+        return reduce(operator.and_, (_apply_pred(pred, values) for pred in args))
+    return Predicate(combined_fun, combined_evaluate, spec=('and', args))
 
 @register_validator
 def ors(*args):
     """把多个谓词取或，得到一个联合谓词"""
     def combined_fun(x):
         return any(pred(x) for pred in args)
-    return combined_fun
+    def combined_evaluate(values):
+        return reduce(operator.or_, (_apply_pred(pred, values) for pred in args))
+    return Predicate(combined_fun, combined_evaluate, spec=('or', args))
@@ -9,8 +9,18 @@
 
 
 from collections import namedtuple
+import sys
 
 
 AlarmInfo = namedtuple('AlarmInfo', ['type', 'content'])
 
 class ValidatorError(ValueError): pass
+
+
+def set_future_exception(future):
+    """把当前正在处理的异常（连同堆栈）设置到 concurrent.futures.Future 上"""
+    _, exc, tb = sys.exc_info()
+    if hasattr(future, 'set_exception_info'):
+        future.set_exception_info(exc, tb)
+    else:
+        future.set_exception(exc)
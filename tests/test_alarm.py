@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""报警消息的生成"""
+
+import datetime
+import gzip
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import pandas as pd
+
+from data_monitor import alarm
+from data_monitor.alarm import format_text, render_email, write_attachment
+from data_monitor.util import AlarmInfo
+
+
+def make_job(**kwargs):
+    job = {
+        '_name': 'demo',
+        'desc': '演示',
+        'due_time': datetime.datetime(2026, 10, 18),
+        'validator': u'claim(result, gt(0))',
+        'sql': ['SELECT city, cnt FROM t'],
+        'db_conf': [{'_name': 'db1'}],
+        'alarm_email': ['a'],
+    }
+    job.update(kwargs)
+    return job
+
+
+def make_frame(nrows):
+    return pd.DataFrame({u'城市': [u'北京{}'.format(i) for i in range(nrows)], 'cnt': range(nrows)},
+                        columns=[u'城市', 'cnt'])
+
+
+class FormatAlarmTest(unittest.TestCase):
+
+    def test_text_with_non_ascii_keys_above_threshold(self):
+        msg = format_text(make_job(), AlarmInfo('claim', make_frame(200)))
+        self.assertIn('不合格的数据共 200 行，第一列 `城市` 的首行值为 北京0，末行值为 北京199', msg)
+
+    def test_email_with_non_ascii_keys_above_max_rows(self):
+        msg, attachments = render_email(make_job(alarm_max_rows=50), AlarmInfo('diff', make_frame(200)))
+        self.assertIn('不合格的数据共 200 行', msg)
+        self.assertIn('以下仅列出前 50 行', msg)
+        self.assertEqual(len(attachments), 1)
+        for path in attachments:
+            os.remove(path)
+
+    def test_byte_string_values(self):
+        df = pd.DataFrame({'city': ['上海{}'.format(i) for i in range(20)]})
+        msg = format_text(make_job(), AlarmInfo('claim', df))
+        self.assertIn('首行值为 上海0', msg)
+
+
+
+class AttachmentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.attachment_dir, alarm.ATTACHMENT_DIR = alarm.ATTACHMENT_DIR, os.path.join(self.tmp_dir, 'attachments')
+
+    def tearDown(self):
+        alarm.ATTACHMENT_DIR = self.attachment_dir
+        shutil.rmtree(self.tmp_dir)
+
+    def test_attachment_is_private(self):
+        path = write_attachment(make_job(), make_frame(3))
+        self.assertEqual(stat.S_IMODE(os.stat(alarm.ATTACHMENT_DIR).st_mode), 0o700)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+        with gzip.open(path) as f:
+            self.assertEqual(f.read().decode('utf8').splitlines()[:2], [u'城市,cnt', u'北京0,0'])
+
+    def test_loose_permissions_are_tightened(self):
+        os.mkdir(alarm.ATTACHMENT_DIR)
+        os.chmod(alarm.ATTACHMENT_DIR, 0o777)
+        write_attachment(make_job(), make_frame(3))
+        self.assertEqual(stat.S_IMODE(os.stat(alarm.ATTACHMENT_DIR).st_mode), 0o700)
+
+    def test_directory_of_other_user_is_rejected(self):
+        if os.getuid() != 0:
+            self.skipTest('changing the owner of the directory requires root')
+        os.mkdir(alarm.ATTACHMENT_DIR)
+        os.chown(alarm.ATTACHMENT_DIR, 1, -1)
+        with self.assertRaises(OSError):
+            write_attachment(make_job(), make_frame(3))
+        self.assertEqual(os.listdir(alarm.ATTACHMENT_DIR), [])
+
+    def test_symlink_is_rejected(self):
+        target = os.path.join(self.tmp_dir, 'target')
+        os.mkdir(target, 0o700)
+        os.symlink(target, alarm.ATTACHMENT_DIR)
+        with self.assertRaises(OSError):
+            write_attachment(make_job(), make_frame(3))
+
+
+if __name__ == '__main__':
+    unittest.main()
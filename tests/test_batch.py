@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""单值查询批处理，使用临时的 sqlite 数据库"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from data_monitor import batch
+from data_monitor.batch import ScalarBatcher, is_batchable
+from data_monitor.db import query
+
+
+class ScalarBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(self.tmp_dir, 'test.db')
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE t (v INTEGER)')
+        conn.executemany('INSERT INTO t VALUES (?)', [(i, ) for i in range(10)])
+        conn.commit()
+        conn.close()
+        self.db_conf = {'_name': 'batch_test', 'driver': 'sqlite', 'database': path}
+
+        # 记录合并语句的执行次数
+        self.statements = []
+        self.query = batch.query
+
+        def counting_query(db_conf, sql, *args):
+            self.statements.append(sql)
+            return self.query(db_conf, sql, *args)
+
+        batch.query = counting_query
+
+    def tearDown(self):
+        batch.query = self.query
+        shutil.rmtree(self.tmp_dir)
+
+    def make_batch(self, *sqls):
+        jobs = [{'_name': 'job{}'.format(i), 'db_conf': [self.db_conf], 'sql': [sql]} for i, sql in enumerate(sqls)]
+        batcher = ScalarBatcher()
+        batcher.open(jobs[0])
+        for job in jobs[1:]:
+            self.assertTrue(batcher.join(job))
+        batcher.close_round()
+        return jobs
+
+    def fetch(self, job):
+        sql = job['sql'][0]
+        return job['_batch'].fetch(sql, lambda: query(self.db_conf, sql))
+
+    def test_batched_in_one_statement(self):
+        jobs = self.make_batch(
+            'SELECT count(1) FROM t', 'SELECT count(1) FROM t WHERE v > 5', 'SELECT count(1) FROM t')
+        self.assertEqual([self.fetch(job) for job in jobs], [10, 4, 10])
+        self.assertEqual(len(self.statements), 1)
+
+    def test_falls_back_to_single_queries_when_union_fails(self):
+        jobs = self.make_batch(
+            'SELECT count(1) FROM t', 'SELECT count(1) FROM missing', 'SELECT count(1) FROM t WHERE v < 3')
+        self.assertEqual(self.fetch(jobs[0]), 10)
+        # 出错的查询只影响自己的作业
+        with self.assertRaises(sqlite3.OperationalError):
+            self.fetch(jobs[1])
+        self.assertEqual(self.fetch(jobs[2]), 3)
+        # 合并语句只执行一次
+        self.assertEqual(len(self.statements), 1)
+
+    def test_queries_without_exactly_one_row_are_not_batched(self):
+        # HAVING、GROUP BY、LIMIT 使结果可能为空或有多行
+        for sql in ['SELECT count(1) FROM t HAVING count(1) > 100',
+                    'SELECT count(1) FROM t GROUP BY v',
+                    'SELECT count(1) FROM t LIMIT 0']:
+            self.assertFalse(is_batchable({'db_conf': [self.db_conf], 'sql': [sql]}), sql)
+            self.assertNotEqual(len(query(self.db_conf, sql)), 1)
+        self.assertTrue(is_batchable({'db_conf': [self.db_conf], 'sql': ['SELECT count(1) FROM t WHERE v > 5']}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""作业配置的载入与作业配置清单"""
+
+import datetime
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from data_monitor.config import ConfigError, JobConfLoader
+
+
+DB_CONFIG = """[db1]
+driver = sqlite
+database = {path}
+password = secret-password
+"""
+
+JOB_CONFIG = """[DEFAULT]
+period = day
+is_active = true
+retry_times = 0
+retry_interval = 00:00:01
+
+[demo]
+desc = demo
+due_time = {BASETIME}
+db_conf = db1
+sql = SELECT 1
+validator = result > 0
+alarm_email = a
+"""
+
+
+class ConfigTestCase(unittest.TestCase):
+    """在临时目录中准备数据库配置和作业配置文件"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_config_file = os.path.join(self.tmp_dir, 'database.cfg')
+        self.job_config_file = os.path.join(self.tmp_dir, 'job.cfg')
+        self.manifest_file = os.path.join(self.tmp_dir, 'manifest')
+        with open(self.db_config_file, 'w') as f:
+            f.write(DB_CONFIG.format(path=os.path.join(self.tmp_dir, 'test.db')))
+        with open(self.job_config_file, 'w') as f:
+            f.write(JOB_CONFIG)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def load(self):
+        loader = JobConfLoader(self.db_config_file, [self.job_config_file], [], manifest_file=self.manifest_file)
+        job_confs, _ = loader.load()
+        return loader, job_confs
+
+    def restore(self):
+        """新的载入器从清单文件恢复检查结果"""
+        loader = JobConfLoader(self.db_config_file, [self.job_config_file], [], manifest_file=self.manifest_file)
+        loader._day = datetime.date.today()
+        loader._restore_manifest()
+        return loader
+
+
+class ManifestTest(ConfigTestCase):
+
+    def test_manifest_is_private_and_has_no_credentials(self):
+        self.load()
+        self.assertEqual(stat.S_IMODE(os.stat(self.manifest_file).st_mode), 0o600)
+        with open(self.manifest_file, 'rb') as f:
+            self.assertNotIn(b'secret-password', f.read())
+
+    def test_restored_manifest_resolves_db_conf(self):
+        self.load()
+        loader = self.restore()
+        self.assertIn('demo', loader._checked)
+        db_conf = loader._checked['demo'][1]['db_conf'][0]
+        self.assertEqual(db_conf['_name'], 'db1')
+        self.assertEqual(db_conf['password'], 'secret-password')
+
+    def test_manifest_of_other_user_is_ignored(self):
+        if os.getuid() != 0:
+            self.skipTest('changing the owner of the manifest requires root')
+        self.load()
+        os.chown(self.manifest_file, 1, -1)
+        loader = self.restore()
+        self.assertEqual(loader._checked, {})
+
+
+
+class ReloadTest(ConfigTestCase):
+
+    def check_reload_error(self, modify, message):
+        loader, job_confs = self.load()
+        self.assertEqual(list(job_confs), ['demo'])
+        modify()
+        with self.assertRaises(ConfigError) as cm:
+            loader.load()
+        self.assertIn(message, str(cm.exception))
+        self.assertIn(self.job_config_file, str(cm.exception))
+
+        # 之前载入的作业的收件人收到报警
+        loader.add_reload_alarm(cm.exception)
+        alarms = loader.pop_config_alarms()
+        self.assertEqual(len(alarms), 1)
+        self.assertEqual(alarms[0][0], ['a'])
+        self.assertIn('demo', alarms[0][1])
+
+    def test_missing_job_config_file(self):
+        self.check_reload_error(
+            lambda: os.rename(self.job_config_file, self.job_config_file + '.bak'), 'failed reading job config file')
+
+    def test_broken_job_config_file(self):
+        def modify():
+            with open(self.job_config_file, 'a') as f:
+                f.write('this line is not an option\n')
+
+        self.check_reload_error(modify, 'failed parsing job config file')
+
+
+
+class ValidatorProcessTest(ConfigTestCase):
+
+    def test_validator_process_is_opt_in(self):
+        with open(self.job_config_file, 'a') as f:
+            f.write('\n[claim_default]\ndesc = demo\ndue_time = {BASETIME}\ndb_conf = db1\n'
+                    'sql = SELECT 1, 2\nvalidator = claim(result)\nalarm_email = a\n')
+            f.write('\n[claim_auto]\nvalidator_process = auto\ndesc = demo\ndue_time = {BASETIME}\n'
+                    'db_conf = db1\nsql = SELECT 1, 2\nvalidator = claim(result)\nalarm_email = a\n')
+            f.write('\n[limited]\nvalidator_cpu_limit = 10\ndesc = demo\ndue_time = {BASETIME}\n'
+                    'db_conf = db1\nsql = SELECT 1\nvalidator = result > 0\nalarm_email = a\n')
+        _, job_confs = self.load()
+        self.assertEqual(
+            {name: job_conf['validator_process'] for name, job_conf in job_confs.items()},
+            {'demo': False, 'claim_default': False, 'claim_auto': True, 'limited': True})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""报警去重与汇总"""
+
+import datetime
+import unittest
+
+from data_monitor.digest import AlarmDigester
+from data_monitor.util import AlarmInfo
+
+
+class FakeDispatcher(object):
+
+    def __init__(self):
+        self.alarms = []
+        self.digests = []
+
+    def send_alarm(self, job, info):
+        self.alarms.append((job['_name'], info))
+
+    def submit(self, to_users, msg):
+        self.digests.append((to_users, msg))
+
+    def post(self, channel, urls, text, job=None):
+        self.digests.append((urls, text))
+
+
+def make_job(name):
+    return {'_name': name, 'alarm_email': ['a']}
+
+
+class AlarmDigesterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = FakeDispatcher()
+        self.digester = AlarmDigester(self.dispatcher, window=60, interval=60)
+
+    def test_duplicate_alarm_is_suppressed(self):
+        info = AlarmInfo('claim', 'result is empty')
+        self.digester.submit(make_job('a'), info)
+        self.digester.submit(make_job('a'), info)
+        self.assertEqual(len(self.dispatcher.alarms), 1)
+        self.assertEqual(self.digester.nsuppressed, 1)
+
+        self.digester.flush(force=True)
+        self.assertEqual(len(self.dispatcher.digests), 1)
+        self.assertIsNone(self.digester.deadline())
+
+    def test_expired_fingerprints_pruned_without_digest(self):
+        for i in range(3):
+            self.digester.submit(make_job('job{}'.format(i)), AlarmInfo('claim', 'result is empty'))
+        self.assertEqual(len(self.digester._sent), 3)
+        # 没有被压制的报警，因此没有待发送的摘要
+        self.assertIsNone(self.digester.deadline())
+
+        past = datetime.datetime.now() - datetime.timedelta(seconds=120)
+        self.digester._sent = dict.fromkeys(self.digester._sent, past)
+        self.digester._next_prune = past
+        self.digester.flush()
+        self.assertEqual(self.digester._sent, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
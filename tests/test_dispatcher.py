@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+"""报警分发器与各报警渠道。
+邮件发送到本机的 smtpd 接收端（在后台线程中运行），HTTP 请求由假的传输适配器应答，均不访问外部网络
+"""
+
+import asyncore
+import json
+import smtpd
+import threading
+import time
+import unittest
+
+import requests
+from requests.adapters import BaseAdapter
+
+from data_monitor.alarm import ChatBotSink, WebhookSink
+from data_monitor.dispatcher import AlarmDispatcher, SMTPPool
+
+URL = 'http://alarm.example.com/hook'
+
+
+class FakeAdapter(BaseAdapter):
+    """按顺序返回预设的应答：(状态码, 响应体) 或异常，记录收到的请求体"""
+
+    def __init__(self, replies):
+        super(FakeAdapter, self).__init__()
+        self.replies = list(replies)
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        with self._lock:
+            self.requests.append(json.loads(request.body))
+            reply = self.replies.pop(0) if self.replies else (200, {})
+        if isinstance(reply, Exception):
+            raise reply
+        status, body = reply
+        response = requests.Response()
+        response.status_code = status
+        response.reason = 'fake'
+        response._content = json.dumps(body).encode('utf8')
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def make_sink(sink_type, replies):
+    sink = sink_type()
+    adapter = FakeAdapter(replies)
+    sink.session.mount('http://', adapter)
+    return sink, adapter
+
+
+def post(channel, sink, job=None):
+    """通过报警分发器发送一条报警，返回 (发送成功数, 发送失败数)"""
+    dispatcher = AlarmDispatcher(workers=1, max_retries=2, backoff=0)
+    dispatcher._sinks[channel] = sink
+    with dispatcher:
+        dispatcher.post(channel, [URL], u'数据异常', job)
+    return dispatcher.nsent, dispatcher.nfailed
+
+
+class WebhookSinkTest(unittest.TestCase):
+
+    def test_payload_is_posted_as_json(self):
+        sink, adapter = make_sink(WebhookSink, [])
+        self.assertEqual(post('webhook', sink, {'_name': 'demo'}), (1, 0))
+        self.assertEqual(adapter.requests, [{'title': u'数据监控警报', 'job': 'demo', 'text': u'数据异常'}])
+
+    def test_retry_on_server_error_and_connection_error(self):
+        sink, adapter = make_sink(WebhookSink, [(503, {}), requests.ConnectionError('refused'), (200, {})])
+        self.assertEqual(post('webhook', sink), (1, 0))
+        self.assertEqual(len(adapter.requests), 3)
+
+    def test_client_error_is_not_retried(self):
+        sink, adapter = make_sink(WebhookSink, [(400, {})])
+        self.assertEqual(post('webhook', sink), (0, 1))
+        self.assertEqual(len(adapter.requests), 1)
+
+    def test_gives_up_after_max_retries(self):
+        sink, adapter = make_sink(WebhookSink, [(502, {})] * 5)
+        self.assertEqual(post('webhook', sink), (0, 1))
+        self.assertEqual(len(adapter.requests), 3)
+
+
+class ChatBotSinkTest(unittest.TestCase):
+
+    def test_text_message(self):
+        sink, adapter = make_sink(ChatBotSink, [(200, {'errcode': 0})])
+        self.assertEqual(post('chatbot', sink), (1, 0))
+        self.assertEqual(adapter.requests, [{'msgtype': 'text', 'text': {'content': u'数据异常'}}])
+
+    def test_retry_on_errcode(self):
+        sink, adapter = make_sink(ChatBotSink, [(200, {'errcode': 130101}), (200, {'errcode': 0})])
+        self.assertEqual(post('chatbot', sink), (1, 0))
+        self.assertEqual(len(adapter.requests), 2)
+
+
+
+def _move_channel(channel, socket_map):
+    """把 asyncore 的 channel 从全局的 socket map 移到 socket_map 中"""
+    fd = channel._fileno
+    channel.del_channel()
+    channel._fileno = fd
+    channel._map = socket_map
+    channel.add_channel(socket_map)
+
+
+class SMTPSink(smtpd.SMTPServer):
+    """本机的 SMTP 接收端，记录连接数和收到的邮件。
+    replies 为预设的应答（如 '451 ...'、'550 ...'），按顺序用于收到的邮件，用完后正常接收。
+    """
+
+    def __init__(self, replies=()):
+        self.map = {}
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        # 使用独立的 socket map，不影响其他 asyncore 使用者
+        _move_channel(self, self.map)
+        self.port = self.socket.getsockname()[1]
+        self.replies = list(replies)
+        self.messages = []
+        self.nconnections = 0
+        self._drop = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.nconnections += 1
+            _move_channel(smtpd.SMTPChannel(self, *pair), self.map)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if self.replies:
+            return self.replies.pop(0)
+        self.messages.append((rcpttos, data))
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            if self._drop.is_set():
+                # 服务器主动断开所有已建立的连接
+                for obj in list(self.map.values()):
+                    if obj is not self:
+                        obj.close()
+                self._drop.clear()
+            asyncore.loop(timeout=0.05, map=self.map, count=1)
+
+    def drop_connections(self):
+        self._drop.set()
+        while self._drop.is_set():
+            time.sleep(0.01)
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        asyncore.close_all(self.map)
+
+
+class SMTPTestCase(unittest.TestCase):
+
+    replies = ()
+
+    def setUp(self):
+        self.sink = SMTPSink(self.replies)
+
+    def tearDown(self):
+        self.sink.stop()
+
+    def make_dispatcher(self, max_idle=60, **kwargs):
+        kwargs.setdefault('backoff', 0)
+        return AlarmDispatcher(pool=SMTPPool('127.0.0.1', self.sink.port, max_idle=max_idle), workers=1, **kwargs)
+
+    def send(self, dispatcher, n=1):
+        """通过报警分发器发送 n 封邮件，返回 (发送成功数, 发送失败数)"""
+        with dispatcher:
+            for i in range(n):
+                dispatcher.submit(['a'], '报警 {}'.format(i))
+        return dispatcher.nsent, dispatcher.nfailed
+
+
+class SMTPPoolTest(SMTPTestCase):
+
+    def test_connection_is_reused(self):
+        self.assertEqual(self.send(self.make_dispatcher(), 3), (3, 0))
+        self.assertEqual(len(self.sink.messages), 3)
+        self.assertEqual(self.sink.nconnections, 1)
+
+    def test_idle_connection_is_replaced(self):
+        pool = SMTPPool('127.0.0.1', self.sink.port, max_idle=0)
+        for _ in range(2):
+            with pool.connection() as server:
+                server.noop()
+            time.sleep(0.01)
+        pool.close()
+        self.assertEqual(self.sink.nconnections, 2)
+
+    def test_reconnect_after_dropped_connection(self):
+        dispatcher = self.make_dispatcher()
+        with dispatcher:
+            dispatcher.submit(['a'], '第一封')
+            while dispatcher.nsent < 1:
+                time.sleep(0.01)
+            # 池中的连接已被服务器断开，发送失败后重试时重新连接
+            self.sink.drop_connections()
+            dispatcher.submit(['a'], '第二封')
+        self.assertEqual((dispatcher.nsent, dispatcher.nfailed), (2, 0))
+        self.assertEqual(len(self.sink.messages), 2)
+        self.assertEqual(self.sink.nconnections, 2)
+
+
+class SMTPTemporaryFailureTest(SMTPTestCase):
+
+    replies = ['451 try again later'] * 2
+
+    def test_retried_until_sent(self):
+        self.assertEqual(self.send(self.make_dispatcher(max_retries=2)), (1, 0))
+        self.assertEqual(len(self.sink.messages), 1)
+
+    def test_gives_up_after_max_retries(self):
+        self.assertEqual(self.send(self.make_dispatcher(max_retries=1)), (0, 1))
+        self.assertEqual(self.sink.messages, [])
+
+
+class SMTPPermanentFailureTest(SMTPTestCase):
+
+    replies = ['550 mailbox unavailable']
+
+    def test_not_retried(self):
+        dispatcher = self.make_dispatcher(max_retries=3)
+        self.assertEqual(self.send(dispatcher), (0, 1))
+        # 第二封邮件正常发送，说明第一封没有被重试
+        self.assertEqual(self.send(self.make_dispatcher()), (1, 0))
+        self.assertEqual(len(self.sink.messages), 1)
+
+
+class SMTPDrainTest(SMTPTestCase):
+
+    replies = ['451 try again later'] * 100
+
+    def test_queue_drained_on_shutdown(self):
+        self.sink.replies = []
+        self.assertEqual(self.send(self.make_dispatcher(), 20), (20, 0))
+        self.assertEqual(len(self.sink.messages), 20)
+
+    def test_abandoned_after_drain_timeout_when_interrupted(self):
+        exit_event = threading.Event()
+        exit_event.set()
+        dispatcher = self.make_dispatcher(max_retries=10, backoff=60, exit_event=exit_event, drain_timeout=0.5)
+        start = time.time()
+        self.assertEqual(self.send(dispatcher, 2)[0], 0)
+        # 正在退避的重试被放弃，不会等满退避时间
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(self.sink.messages, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
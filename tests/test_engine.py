@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""作业执行引擎"""
+
+import threading
+import time
+import unittest
+
+from data_monitor.engine import AsyncEngine
+
+TIMEOUT = 10
+
+
+def make_job(name, *db_names, **kwargs):
+    job = {
+        '_name': name,
+        'db_conf': [{'_name': db_name, 'max_concurrency': 1} for db_name in db_names],
+        'sql': ['SELECT {}'.format(i) for i in range(len(db_names))],
+    }
+    job.update(kwargs)
+    return job
+
+
+def fetch(job, db_conf, sql):
+    return (db_conf['_name'], sql)
+
+
+def validate(job, results):
+    return job['_name'], results
+
+
+class AsyncEngineTest(unittest.TestCase):
+
+    def test_jobs_complete_with_all_results(self):
+        with AsyncEngine(fetch, validate, max_workers=2) as engine:
+            futures = [engine.submit(make_job('job{}'.format(i), 'db1', 'db2')) for i in range(10)]
+            for i, future in enumerate(futures):
+                self.assertEqual(future.result(TIMEOUT), (
+                    'job{}'.format(i), [('db1', 'SELECT 0'), ('db2', 'SELECT 1')]))
+
+    def test_query_exception_propagates(self):
+        def failing_fetch(job, db_conf, sql):
+            if db_conf['_name'] == 'bad':
+                raise RuntimeError('query failed')
+            return fetch(job, db_conf, sql)
+
+        validated = []
+        with AsyncEngine(failing_fetch, lambda job, results: validated.append(job)) as engine:
+            future = engine.submit(make_job('demo', 'good', 'bad'))
+            with self.assertRaises(RuntimeError) as cm:
+                future.result(TIMEOUT)
+        self.assertIn('query failed', str(cm.exception))
+        self.assertEqual(validated, [])
+
+    def test_validator_exception_propagates(self):
+        def failing_validate(job, results):
+            raise ValueError('validator failed')
+
+        with AsyncEngine(fetch, failing_validate) as engine:
+            with self.assertRaises(ValueError):
+                engine.submit(make_job('demo', 'db1')).result(TIMEOUT)
+
+    def test_queries_limited_by_database_concurrency(self):
+        lock = threading.Lock()
+        active, peak = [0], [0]
+
+        def slow_fetch(job, db_conf, sql):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+            return sql
+
+        with AsyncEngine(slow_fetch, validate, max_workers=8) as engine:
+            futures = [engine.submit(make_job('job{}'.format(i), 'db1')) for i in range(5)]
+            for future in futures:
+                future.result(TIMEOUT)
+        # db1 的 max_concurrency 为 1
+        self.assertEqual(peak[0], 1)
+
+    def test_pushdown_result_or_fallback(self):
+        def pushdown(job):
+            return True if job['_name'] == 'pushed' else None
+
+        with AsyncEngine(fetch, validate, pushdown=pushdown) as engine:
+            pushed = engine.submit(make_job('pushed', 'db1', pushdown=True))
+            fallback = engine.submit(make_job('fallback', 'db1', pushdown=True))
+            self.assertIs(pushed.result(TIMEOUT), True)
+            self.assertEqual(fallback.result(TIMEOUT), ('fallback', [('db1', 'SELECT 0')]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+"""作业执行历史"""
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from data_monitor.history import HistoryStore
+
+
+def make_job(name):
+    return {'_name': name, 'due_time': datetime.datetime(2026, 10, 18)}
+
+
+class HistoryStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'history')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_estimate_follows_new_runs(self):
+        history = HistoryStore(self.path, runs=3)
+        job = make_job('demo')
+        self.assertIsNone(history.estimate(job))
+        for duration in (1, 2, 30):
+            history.record(job, duration, 0, 0, 'ok')
+        self.assertEqual(history.estimate(job), 2)
+        # 出错的执行不参与估计
+        history.record(job, 0.1, 0, 0, 'error')
+        self.assertEqual(history.estimate(job), 2)
+        history.record(job, 40, 0, 0, 'alarm')
+        self.assertEqual(history.estimate(job), 30)
+        history.close()
+
+        history = HistoryStore(self.path, runs=3)
+        self.assertEqual(history.estimate(job), 30)
+        self.assertIsNone(history.estimate(make_job('other')))
+        history.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""校验进程池"""
+
+import threading
+import time
+import unittest
+
+from data_monitor.process import ProcessPool
+from data_monitor.util import ValidatorError
+
+
+_lock = threading.Lock()
+
+
+def _sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def _acquire_inherited_lock():
+    # fork 时锁被父进程的其他线程持有，子进程中永远无法获得
+    with _lock:
+        return True
+
+
+def _fail():
+    raise ValueError('boom')
+
+
+class ProcessPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ProcessPool(max_processes=2)
+
+    def test_result(self):
+        self.assertEqual(self.pool.run(_sleep, (0, )), 0)
+
+    def test_exception(self):
+        with self.assertRaises(ValidatorError) as cm:
+            self.pool.run(_fail)
+        self.assertIn('boom', str(cm.exception))
+
+    def test_sleeping_child_times_out(self):
+        start = time.time()
+        with self.assertRaises(ValidatorError) as cm:
+            self.pool.run(_sleep, (60, ), timeout=1)
+        self.assertIn('timed out', str(cm.exception))
+        self.assertLess(time.time() - start, 10)
+
+    def test_deadlocked_child_times_out(self):
+        held, released = threading.Event(), threading.Event()
+
+        def hold():
+            with _lock:
+                held.set()
+                released.wait()
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        # 子进程必须在锁被持有时 fork
+        held.wait()
+        try:
+            with self.assertRaises(ValidatorError):
+                # 设置了 CPU 上限也不会触发，由运行时间上限兜底
+                self.pool.run(_acquire_inherited_lock, cpu_limit=1, timeout=1)
+        finally:
+            released.set()
+            holder.join()
+
+    def test_slot_released_after_timeout(self):
+        for _ in range(3):
+            with self.assertRaises(ValidatorError):
+                self.pool.run(_sleep, (60, ), timeout=0.5)
+        self.assertEqual(self.pool.run(_sleep, (0, )), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""在数据库中执行的校验（下推），使用临时的 sqlite 数据库"""
+
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from data_monitor import pushdown
+from data_monitor.alarm import format_text
+
+
+class PushdownTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(self.tmp_dir, 'test.db')
+        conn = sqlite3.connect(path)
+        # 2026-09-01 起的 40 天，缺少第 10 天；偶数天的 cnt 为 0
+        start = datetime.date(2026, 9, 1)
+        conn.execute('CREATE TABLE t (day TEXT, cnt INTEGER)')
+        conn.executemany('INSERT INTO t VALUES (?, ?)', [
+            (str(start + datetime.timedelta(days=i)), i % 2) for i in range(40) if i != 10])
+        conn.execute('CREATE TABLE empty (day TEXT, cnt INTEGER)')
+        # key 含 NULL 的表；第一行的 value 为 NULL
+        conn.execute('CREATE TABLE nulls (k TEXT, v INTEGER)')
+        conn.executemany('INSERT INTO nulls VALUES (?, ?)', [('a', None), (None, 1), ('b', 2)])
+        # 没有声明类型的 value 列，第一行为数值，其余为字符串
+        conn.execute('CREATE TABLE mixed1 (k TEXT, v)')
+        conn.executemany('INSERT INTO mixed1 VALUES (?, ?)', [('a', 1), ('b', 'x')])
+        conn.execute('CREATE TABLE mixed2 (k TEXT, v)')
+        conn.executemany('INSERT INTO mixed2 VALUES (?, ?)', [('a', 1), ('b', 'y')])
+        conn.commit()
+        conn.close()
+        self.db_conf = {'_name': 'pushdown_test', 'driver': 'sqlite', 'database': path}
+
+        # 记录执行的语句
+        self.statements = []
+        self.describe, self.query = pushdown.describe, pushdown.query
+
+        def describe(db_conf, sql):
+            self.statements.append(sql)
+            return self.describe(db_conf, sql)
+
+        def query(db_conf, sql, *args):
+            self.statements.append(sql)
+            return self.query(db_conf, sql, *args)
+
+        pushdown.describe, pushdown.query = describe, query
+        self.sample_rows, pushdown.SAMPLE_ROWS = pushdown.SAMPLE_ROWS, 5
+
+    def tearDown(self):
+        pushdown.describe, pushdown.query = self.describe, self.query
+        pushdown.SAMPLE_ROWS = self.sample_rows
+        shutil.rmtree(self.tmp_dir)
+
+    def run_job(self, validator, *sqls):
+        job = {'_name': 'demo', 'desc': '演示', 'due_time': datetime.datetime(2026, 10, 18), 'validator': validator,
+               'sql': list(sqls), 'db_conf': [self.db_conf] * len(sqls)}
+        return job, pushdown.run_pushdown(job)
+
+    def test_claim_passes_with_two_statements(self):
+        _, res = self.run_job(u'claim(result, ge(0), serial=False)', 'SELECT day, cnt FROM t')
+        self.assertIs(res, True)
+        # 取列名的 LIMIT 0 查询和一次聚合查询，不再查询样本
+        self.assertEqual(len(self.statements), 2)
+        self.assertIn('LIMIT 0', self.statements[0])
+
+    def test_claim_empty_result(self):
+        _, res = self.run_job(u'claim(result, ge(0))', 'SELECT day, cnt FROM empty')
+        self.assertEqual(res, (False, 'result is empty'))
+
+    def test_claim_sample_carries_total(self):
+        job, (ok, info) = self.run_job(u'claim(result, gt(0), serial=False)', 'SELECT day, cnt FROM t')
+        self.assertFalse(ok)
+        self.assertEqual(len(info.content.index), 5)
+        self.assertEqual(info.content.total_rows, 19)
+        # 总行数来自聚合查询，不再单独执行 COUNT(*)
+        self.assertEqual(len(self.statements), 3)
+        self.assertIn('不合格的数据共 19 行（仅取回了前 5 行）', format_text(job, info))
+
+    def test_claim_serial_counts_gaps(self):
+        job, (ok, info) = self.run_job(u'claim(result, gt(0))', 'SELECT day, cnt FROM t')
+        self.assertFalse(ok)
+        # 样本中的 5 行加上缺失的 1 天
+        self.assertEqual(len(info.content.index), 6)
+        self.assertEqual(info.content.total_rows, 20)
+        self.assertEqual(len(self.statements), 4)
+
+    def test_diff_sample_carries_total(self):
+        job, (ok, info) = self.run_job(
+            u'diff(result[0], result[1])', 'SELECT day, cnt FROM t', 'SELECT day, cnt + 1 AS cnt FROM t')
+        self.assertFalse(ok)
+        self.assertEqual(len(info.content.index), 5)
+        self.assertEqual(info.content.total_rows, 39)
+        self.assertIn('不合格的数据共 39 行（仅取回了前 5 行）', format_text(job, info))
+
+    def test_diff_empty_tables(self):
+        _, res = self.run_job(
+            u'diff(result[0], result[1])', 'SELECT day, cnt FROM empty', 'SELECT day, cnt FROM t')
+        self.assertEqual(res, (False, 'data1 (the first table) is empty'))
+        _, res = self.run_job(
+            u'diff(result[0], result[1])', 'SELECT day, cnt FROM t', 'SELECT day, cnt FROM empty')
+        self.assertEqual(res, (False, 'data2 (the second table) is empty'))
+
+    def test_diff_matches_null_keys(self):
+        job, (ok, info) = self.run_job(
+            u'diff(result[0], result[1])', 'SELECT k, v FROM nulls', 'SELECT k, v FROM nulls')
+        # 只有 value 为 NULL 的一行不一致，key 为 NULL 的行互相匹配
+        self.assertFalse(ok)
+        self.assertEqual(info.content['k'].tolist(), ['a'])
+        self.assertEqual(info.content.columns.tolist(), ['k', 'v_1', 'v_2', 'diff'])
+
+    def test_diff_right_only_row_with_null_key(self):
+        job, (ok, info) = self.run_job(
+            u'diff(result[0], result[1])', 'SELECT k, v FROM nulls WHERE k IS NOT NULL', 'SELECT k, v FROM nulls')
+        self.assertFalse(ok)
+        self.assertEqual(len(info.content.index), 2)
+        self.assertEqual(info.content['v_2'].tolist()[-1], 1)
+
+    def test_diff_value_type_from_all_rows(self):
+        # value 列不全是数值时比较是否相等，而不是按第一行判断为数值后相减
+        job, (ok, info) = self.run_job(
+            u'diff(result[0], result[1])', 'SELECT k, v FROM mixed1', 'SELECT k, v FROM mixed2')
+        self.assertFalse(ok)
+        self.assertEqual(info.content['k'].tolist(), ['b'])
+        self.assertNotIn('diff', info.content.columns)
+
+
+if __name__ == '__main__':
+    unittest.main()
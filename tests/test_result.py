@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+"""列式查询结果"""
+
+import unittest
+
+import pandas as pd
+
+from data_monitor.result import ResultSet
+
+
+class ResultSetTest(unittest.TestCase):
+
+    def setUp(self):
+        df = pd.DataFrame({'city': ['a', 'b'], 'cnt': [1, 2], 'ratio': [0.5, 1.5]}, columns=['city', 'cnt', 'ratio'])
+        self.result = ResultSet(df)
+
+    def test_mixed_dtype_row_keeps_types(self):
+        row = self.result[0]
+        self.assertEqual(row, ('a', 1, 0.5))
+        self.assertIs(type(row.cnt), int)
+        self.assertIs(type(row.ratio), float)
+        self.assertEqual(self.result[-1], ('b', 2, 1.5))
+
+    def test_numeric_row_is_not_upcast(self):
+        row = ResultSet.from_columns(['cnt', 'ratio'], [[7], [0.25]])[0]
+        self.assertEqual(repr(row.cnt), '7')
+        self.assertIs(type(row.cnt), int)
+
+    def test_row_matches_iteration(self):
+        self.assertEqual([self.result[i] for i in range(len(self.result))], list(self.result))
+
+    def test_index_out_of_range(self):
+        with self.assertRaises(IndexError):
+            self.result[2]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+"""作业调度器"""
+
+import datetime
+import unittest
+
+from data_monitor.scheduler import Scheduler
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_blocked_jobs_are_rechecked_first_in_order(self):
+        scheduler = Scheduler()
+        now = datetime.datetime.now()
+        for i in range(5):
+            scheduler.push(now, {'_name': 'job{}'.format(i)})
+
+        # 第一轮只允许偶数号作业运行
+        jobs = scheduler.pop_due(now, admit=lambda job: int(job['_name'][-1]) % 2 == 0)
+        self.assertEqual([job['_name'] for job in jobs], ['job0', 'job2', 'job4'])
+        self.assertEqual(scheduler.npending, 2)
+
+        scheduler.push(now, {'_name': 'job5'})
+        jobs = scheduler.pop_due(now, admit=lambda job: True)
+        self.assertEqual([job['_name'] for job in jobs], ['job1', 'job3', 'job5'])
+        self.assertEqual(scheduler.npending, 0)
+
+    def test_discard_blocked_jobs(self):
+        scheduler = Scheduler()
+        now = datetime.datetime.now()
+        for i in range(3):
+            scheduler.push(now, {'_name': 'job{}'.format(i)})
+        scheduler.pop_due(now, admit=lambda job: False)
+        self.assertEqual(scheduler.discard(lambda job: job['_name'] != 'job1'), 2)
+        self.assertEqual([job['_name'] for job in scheduler.pop_due(now)], ['job1'])
+
+
+if __name__ == '__main__':
+    unittest.main()